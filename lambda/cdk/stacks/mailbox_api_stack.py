@@ -13,8 +13,41 @@ from aws_cdk import (
     aws_logs as logs,
     aws_sns as sns,
     aws_sns_subscriptions as subs,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_apigatewayv2 as apigwv2,
+    aws_apigatewayv2_integrations as integrations,
+    triggers,
 )
 
+def _python_code() -> lambda_.Code:
+    """The lambda/ directory with its requirements installed; every function runs main.py from it"""
+    return lambda_.Code.from_asset(
+        os.path.join(os.path.dirname(__file__), "..", ".."),
+        exclude=[
+            # Exclude CDK source and its output directory to prevent recursive asset packaging
+            "cdk",
+            "cdk/*",
+            "cdk/**",
+            "cdk.out",
+            "cdk.out/**",
+            "**/.venv/**",
+            "**/__pycache__/**",
+            # Exclude tests
+            "tests",
+            "tests/**",
+        ],
+        bundling=BundlingOptions(
+            image=lambda_.Runtime.PYTHON_3_11.bundling_image,
+            command=[
+                "bash",
+                "-c",
+                # Install runtime requirements and copy project excluding CDK dir to avoid recursive copy
+                "pip install --no-cache-dir -r requirements.txt -t /asset-output && rsync -av --exclude 'cdk/**' --exclude '.venv/**' --exclude '__pycache__/**' ./ /asset-output",
+            ],
+        ),
+    )
+
 class MailboxApiStack(Stack):
     def __init__(self, scope: Construct, id: str, **kwargs):
         super().__init__(scope, id, **kwargs)
@@ -36,6 +69,15 @@ class MailboxApiStack(Stack):
                     abort_incomplete_multipart_upload_after=Duration.days(7),
                 )
             ],
+            # Presigned image mode: devices PUT and browsers GET directly against the bucket
+            cors=[
+                s3.CorsRule(
+                    allowed_methods=[s3.HttpMethods.GET, s3.HttpMethods.PUT],
+                    allowed_origins=["*"],
+                    allowed_headers=["*"],
+                    max_age=3000,
+                )
+            ],
             removal_policy=RemovalPolicy.RETAIN,  # keep data if stack is deleted
         )
 
@@ -44,31 +86,7 @@ class MailboxApiStack(Stack):
             "MailboxApiHandler",
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="main.handler",
-            code=lambda_.Code.from_asset(
-                os.path.join(os.path.dirname(__file__), "..", ".."),
-                exclude=[
-                    # Exclude CDK source and its output directory to prevent recursive asset packaging
-                    "cdk",
-                    "cdk/*",
-                    "cdk/**",
-                    "cdk.out",
-                    "cdk.out/**",
-                    "**/.venv/**",
-                    "**/__pycache__/**",
-                    # Exclude tests
-                    "tests",
-                    "tests/**",
-                ],
-                bundling=BundlingOptions(
-                    image=lambda_.Runtime.PYTHON_3_11.bundling_image,
-                    command=[
-                        "bash",
-                        "-c",
-                        # Install runtime requirements and copy project excluding CDK dir to avoid recursive copy
-                        "pip install --no-cache-dir -r requirements.txt -t /asset-output && rsync -av --exclude 'cdk/**' --exclude '.venv/**' --exclude '__pycache__/**' ./ /asset-output",
-                    ],
-                ),
-            ),
+            code=_python_code(),
             architecture=lambda_.Architecture.ARM_64,
             memory_size=1024,  # Increase from default 128MB to 1024MB for better performance
             ephemeral_storage_size=Size.mebibytes(1024),  # Increase from default 512MB
@@ -81,8 +99,9 @@ class MailboxApiStack(Stack):
                 "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", ""),
                 "MYSQL_SSL_CA": os.getenv("MYSQL_SSL_CA", ""),
                 "S3_BUCKET": bucket.bucket_name,
-                # Performance optimization - disable schema init on Lambda
-                "INIT_SCHEMA": "false",
+                "IMAGE_DELIVERY_MODE": os.getenv("IMAGE_DELIVERY_MODE", "proxy"),
+                # Only compare schema_version; SchemaMigration below applies migrations
+                "INIT_SCHEMA": "check",
                 # MailerSend API configuration
                 "MAIL_API": os.getenv("mail_api", ""),
                 "mail_username": os.getenv("mail_username", ""),
@@ -122,29 +141,7 @@ class MailboxApiStack(Stack):
             "NotificationProcessor",
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="main.process_notification",
-            code=lambda_.Code.from_asset(
-                os.path.join(os.path.dirname(__file__), "..", ".."),
-                exclude=[
-                    # Exclude CDK source and its output directory
-                    "cdk",
-                    "cdk/*",
-                    "cdk/**",
-                    "cdk.out",
-                    "cdk.out/**",
-                    "**/.venv/**",
-                    "**/__pycache__/**",
-                    "tests",
-                    "tests/**",
-                ],
-                bundling=BundlingOptions(
-                    image=lambda_.Runtime.PYTHON_3_11.bundling_image,
-                    command=[
-                        "bash",
-                        "-c",
-                        "pip install --no-cache-dir -r requirements.txt -t /asset-output && rsync -av --exclude 'cdk/**' --exclude '.venv/**' --exclude '__pycache__/**' ./ /asset-output",
-                    ],
-                ),
-            ),
+            code=_python_code(),
             architecture=lambda_.Architecture.ARM_64,
             memory_size=1024,  # Increase from default 128MB to 1024MB for better performance
             ephemeral_storage_size=Size.mebibytes(1024),  # Increase from default 512MB
@@ -155,18 +152,158 @@ class MailboxApiStack(Stack):
                 "MYSQL_PASSWORD": os.getenv("MYSQL_PASSWORD", ""),
                 "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", ""),
                 "MYSQL_SSL_CA": os.getenv("MYSQL_SSL_CA", ""),
-                # Performance optimization - disable schema init on Lambda
-                "INIT_SCHEMA": "false",
+                # Only compare schema_version; SchemaMigration below applies migrations
+                "INIT_SCHEMA": "check",
                 # MailerSend API configuration
                 "MAIL_API": os.getenv("mail_api", ""),
                 "mail_username": os.getenv("mail_username", ""),
                 "mail_from_name": os.getenv("mail_from_name", ""),
+                # Per-device email coalescing window and digest mode
+                "NOTIFY_COALESCE_SECONDS": os.getenv("NOTIFY_COALESCE_SECONDS", "0"),
+                "NOTIFY_DIGEST": os.getenv("NOTIFY_DIGEST", "false"),
             },
             timeout=Duration.seconds(60),
         )
         # Subscribe the notification processor to the SNS topic
         topic.add_subscription(subs.LambdaSubscription(notification_fn))
 
+        # Scheduled maintenance: roll event/notification partitions forward and apply retention
+        maintenance_fn = lambda_.Function(
+            self,
+            "MaintenanceJob",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="main.run_maintenance",
+            code=_python_code(),
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=256,
+            environment={
+                "MYSQL_HOST": os.getenv("MYSQL_HOST", ""),
+                "MYSQL_PORT": os.getenv("MYSQL_PORT", ""),
+                "MYSQL_USER": os.getenv("MYSQL_USER", ""),
+                "MYSQL_PASSWORD": os.getenv("MYSQL_PASSWORD", ""),
+                "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", ""),
+                "MYSQL_SSL_CA": os.getenv("MYSQL_SSL_CA", ""),
+                "INIT_SCHEMA": "true",
+                "EVENT_RETENTION_DAYS": os.getenv("EVENT_RETENTION_DAYS", "365"),
+                "NOTIFICATION_RETENTION_DAYS": os.getenv("NOTIFICATION_RETENTION_DAYS", "365"),
+                "ROLLUP_HOURLY_RETENTION_DAYS": os.getenv("ROLLUP_HOURLY_RETENTION_DAYS", "90"),
+                "TELEMETRY_RETENTION_DAYS": os.getenv("TELEMETRY_RETENTION_DAYS", "30"),
+                "TELEMETRY_ROLLUP_RETENTION_DAYS": os.getenv("TELEMETRY_ROLLUP_RETENTION_DAYS", "0"),
+                "S3_BUCKET": bucket.bucket_name,
+                "IMAGE_GC_INTERVAL_DAYS": os.getenv("IMAGE_GC_INTERVAL_DAYS", "7"),
+                # Held notification digests are sent from here
+                "NOTIFY_COALESCE_SECONDS": os.getenv("NOTIFY_COALESCE_SECONDS", "0"),
+                "NOTIFY_DIGEST": os.getenv("NOTIFY_DIGEST", "false"),
+                "MAIL_API": os.getenv("mail_api", ""),
+                "mail_username": os.getenv("mail_username", ""),
+                "mail_from_name": os.getenv("mail_from_name", ""),
+            },
+            timeout=Duration.minutes(5),
+        )
+        # Image garbage collection lists the bucket and batch-deletes orphaned objects
+        bucket.grant_read(maintenance_fn)
+        bucket.grant_delete(maintenance_fn)
+        # Run once a day, well before the next month's partition is needed
+        events.Rule(
+            self,
+            "MaintenanceSchedule",
+            schedule=events.Schedule.cron(minute="15", hour="3"),
+            targets=[targets.LambdaFunction(maintenance_fn)],
+        )
+        # Orphaned image cleanup, same function with a job selector. Runs daily so a pass too
+        # large for one invocation resumes the next day; a new pass starts every
+        # IMAGE_GC_INTERVAL_DAYS and the runs in between return at once.
+        events.Rule(
+            self,
+            "ImageGcSchedule",
+            schedule=events.Schedule.cron(minute="45", hour="3"),
+            targets=[
+                targets.LambdaFunction(
+                    maintenance_fn,
+                    event=events.RuleTargetInput.from_object({"job": "image_gc"}),
+                )
+            ],
+        )
+
+        # Deliver held notification digests once their coalescing window has closed
+        if int(os.getenv("NOTIFY_COALESCE_SECONDS", "0") or 0) > 0:
+            events.Rule(
+                self,
+                "NotificationDigestSchedule",
+                schedule=events.Schedule.rate(Duration.minutes(1)),
+                targets=[
+                    targets.LambdaFunction(
+                        maintenance_fn,
+                        event=events.RuleTargetInput.from_object({"job": "notification_digest"}),
+                    )
+                ],
+            )
+
+        # Dashboard push: browsers hold a WebSocket on API Gateway; connect/disconnect are
+        # recorded by this function and the API function posts new rows to the connections.
+        # Nothing runs while a dashboard is idle.
+        websocket_fn = lambda_.Function(
+            self,
+            "DashboardSocketHandler",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="main.handle_websocket",
+            code=_python_code(),
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=256,
+            environment={
+                "MYSQL_HOST": os.getenv("MYSQL_HOST", ""),
+                "MYSQL_PORT": os.getenv("MYSQL_PORT", ""),
+                "MYSQL_USER": os.getenv("MYSQL_USER", ""),
+                "MYSQL_PASSWORD": os.getenv("MYSQL_PASSWORD", ""),
+                "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", ""),
+                "MYSQL_SSL_CA": os.getenv("MYSQL_SSL_CA", ""),
+                "INIT_SCHEMA": "check",
+            },
+            timeout=Duration.seconds(10),
+        )
+        socket_integration = integrations.WebSocketLambdaIntegration("DashboardSocketIntegration", websocket_fn)
+        socket_api = apigwv2.WebSocketApi(
+            self,
+            "DashboardSocket",
+            connect_route_options=apigwv2.WebSocketRouteOptions(integration=socket_integration),
+            disconnect_route_options=apigwv2.WebSocketRouteOptions(integration=socket_integration),
+            default_route_options=apigwv2.WebSocketRouteOptions(integration=socket_integration),
+        )
+        socket_stage = apigwv2.WebSocketStage(
+            self,
+            "DashboardSocketStage",
+            web_socket_api=socket_api,
+            stage_name="live",
+            auto_deploy=True,
+        )
+        # The API function posts to connections through the management API
+        socket_api.grant_manage_connections(fn)
+        fn.add_environment("DASHBOARD_PUSH_ENDPOINT", socket_stage.callback_url)
+
+        # Apply schema migrations at deploy time, before the API and notification functions
+        # update, instead of in their 60 s cold start. Re-runs whenever the bundled code
+        # changes; a failed migration fails the deployment.
+        triggers.TriggerFunction(
+            self,
+            "SchemaMigration",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="main.run_migrations",
+            code=_python_code(),
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=256,
+            environment={
+                "MYSQL_HOST": os.getenv("MYSQL_HOST", ""),
+                "MYSQL_PORT": os.getenv("MYSQL_PORT", ""),
+                "MYSQL_USER": os.getenv("MYSQL_USER", ""),
+                "MYSQL_PASSWORD": os.getenv("MYSQL_PASSWORD", ""),
+                "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", ""),
+                "MYSQL_SSL_CA": os.getenv("MYSQL_SSL_CA", ""),
+                "INIT_SCHEMA": "true",
+            },
+            timeout=Duration.minutes(5),
+            execute_before=[fn, notification_fn, websocket_fn],
+        )
+
         # Reduce CloudWatch Logs retention to cut log storage costs
         logs.LogRetention(
             self,
@@ -178,4 +315,5 @@ class MailboxApiStack(Stack):
         fn_url = fn.add_function_url(
             auth_type=lambda_.FunctionUrlAuthType.NONE,
         )
-        CfnOutput(self, "MailboxFunctionUrl", value=fn_url.url) 
\ No newline at end of file
+        CfnOutput(self, "MailboxFunctionUrl", value=fn_url.url)
+        CfnOutput(self, "DashboardSocketUrl", value=socket_stage.url)
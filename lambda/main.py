@@ -1,19 +1,30 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+import asyncio
+import base64
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Literal, Optional, Tuple
 import mysql.connector
 from mysql.connector import pooling
+import mysql.connector.aio as mysql_aio
 from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Response
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
-from pydantic import BaseModel
-import boto3
+from contextlib import asynccontextmanager, contextmanager
+from pydantic import BaseModel, Field, ValidationError
 from mangum import Mangum
 import dotenv
 import logging
 import json
-from mailersend import emails
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from io import BytesIO
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,12 +34,14 @@ logger = logging.getLogger(__name__)
 dotenv.load_dotenv(override=True)
 
 # Log environment variables (excluding sensitive ones)
-logger.info(f"MYSQL_HOST: {os.getenv('MYSQL_HOST')}")
-logger.info(f"MYSQL_PORT: {os.getenv('MYSQL_PORT')}")
-logger.info(f"MYSQL_DATABASE: {os.getenv('MYSQL_DATABASE')}")
-logger.info(f"MYSQL_SSL_CA defined: {os.getenv('MYSQL_SSL_CA') is not None}")
-if os.getenv('MYSQL_SSL_CA'):
-    logger.info(f"MYSQL_SSL_CA file exists: {os.path.exists(os.getenv('MYSQL_SSL_CA'))}")
+logger.debug(f"MYSQL_HOST: {os.getenv('MYSQL_HOST')}")
+logger.debug(f"MYSQL_PORT: {os.getenv('MYSQL_PORT')}")
+logger.debug(f"MYSQL_DATABASE: {os.getenv('MYSQL_DATABASE')}")
+
+# "lazy" (default) imports boto3, mailersend and requests on first use, so requests that never
+# touch S3, SNS or email don't pay for them on a cold start. "eager" loads them and creates the
+# AWS clients while the module is imported (Lambda's init phase) instead.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy").lower()
 
 DB = {
     "host": os.getenv("MYSQL_HOST"),
@@ -48,15 +61,705 @@ else:
     logger.warning(f"SSL certificate not found at {ssl_ca}, connecting without SSL verification")
 
 POOL: Optional[pooling.MySQLConnectionPool] = None
+ASYNC_POOL: Optional["AsyncConnectionPool"] = None
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE") or 5)
+# How pooled connections are validated when checked out:
+#   "reset" - reset the session each time (the connector's default behaviour)
+#   "ping"  - ping only connections idle for DB_PING_IDLE_SECONDS or more, e.g. after a thaw
+#   "trust" - never validate; a dead connection is reconnected when its first statement fails
+# ping/trust only change the async pool. mysql-connector's sync pool pings on every checkout
+# and its cursor() pings again, whatever the policy; for it the policy only decides between
+# a session reset and a rollback when the connection is returned.
+DB_VALIDATION_POLICY = os.getenv("DB_VALIDATION_POLICY", "ping").lower()
+DB_PING_IDLE_SECONDS = int(os.getenv("DB_PING_IDLE_SECONDS") or 30)
+# Client errors meaning the server side of the connection is gone
+DB_DISCONNECT_ERRNOS = {2006, 2013, 2055, 4031}
+# How often each validation path runs in this container per pool, see GET /metrics/db.
+# Sync pings are the driver's own: one per checkout plus one per cursor opened.
+DB_METRICS = {
+    pool: {"checkouts": 0, "resets": 0, "rollbacks": 0, "pings": 0, "dead_connections": 0, "reconnects": 0, "retries": 0}
+    for pool in ("sync", "async")
+}
 
 # Global clients to reuse across invocations
 s3_client = None
 sns_client = None
+apigw_client = None
+mail_client = None  # MailerSend client, builds message bodies
+mail_session = None  # requests.Session kept alive to the MailerSend API
 
-# Simple in-memory cache for dashboard data
-dashboard_cache = {}
-settings_cache = {}  # Cache for device settings
 CACHE_TTL_SECONDS = 30  # Cache expiry in seconds - keep this relatively short to ensure data freshness
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES") or 1000)  # Per cache, least recently used entries go first
+
+class TTLCache:
+    """Bounded in-memory cache with per-entry expiry, LRU eviction and single-flight loading.
+
+    Entries are dicts holding 'data' and 'expires_at' so handlers can report cache headers.
+    Expired entries are swept at most once per TTL whenever something is stored, so keys
+    that are never read again do not pin memory in a warm container.
+
+    Sync handlers run in the threadpool and invalidate keys while the event loop reads
+    and sweeps the same cache, so every access to the maps holds a lock (never across an await).
+    """
+
+    def __init__(self, name: str, ttl_seconds: int, max_entries: int):
+        self.name = name
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._next_sweep = datetime.utcnow() + self.ttl
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if datetime.utcnow() >= entry['expires_at']:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, data: Any) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        entry = {'data': data, 'expires_at': now + self.ttl}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if now >= self._next_sweep:
+                self.purge_expired(now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def pop(self, key: str) -> bool:
+        """Drop a key, including any load in flight for it. Returns True if an entry was cached."""
+        with self._lock:
+            self._inflight.pop(key, None)
+            return self._entries.pop(key, None) is not None
+
+    def purge_expired(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.utcnow()
+        with self._lock:
+            expired = [k for k, entry in self._entries.items() if now >= entry['expires_at']]
+            for k in expired:
+                del self._entries[k]
+            self._next_sweep = now + self.ttl
+        return len(expired)
+
+    async def get_or_load(self, key: str, loader) -> Tuple[Dict[str, Any], str]:
+        """Return (entry, status) where status is HIT, MISS or COALESCED.
+
+        Concurrent misses for the same key share a single call to `loader`. A result
+        whose key was invalidated while it was loading is returned but not cached.
+        """
+        with self._lock:
+            entry = self.get(key)
+            if entry is not None:
+                return entry, "HIT"
+            pending = self._inflight.get(key)
+            if pending is None:
+                fut = asyncio.get_running_loop().create_future()
+                # Mark the exception as retrieved when nobody else was waiting on this load
+                fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+                self._inflight[key] = fut
+        if pending is not None:
+            return await asyncio.shield(pending), "COALESCED"
+
+        try:
+            data = await loader()
+        except BaseException as e:
+            with self._lock:
+                if self._inflight.get(key) is fut:
+                    del self._inflight[key]
+            if isinstance(e, Exception):
+                fut.set_exception(e)
+            else:
+                fut.cancel()
+            raise
+
+        with self._lock:
+            current = self._inflight.get(key) is fut
+            if current:
+                del self._inflight[key]
+                entry = self.set(key, data)
+        if not current:
+            entry = {'data': data, 'expires_at': datetime.utcnow() + self.ttl}
+        fut.set_result(entry)
+        return entry, "MISS"
+
+dashboard_cache = TTLCache("dashboard", CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+settings_cache = TTLCache("settings", CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)  # Cache for device settings
+
+# Write-behind batching for mailbox events. EVENT_ACK_MODE decides when a report is acknowledged:
+#   direct   - one transaction (two round trips, see _write_event_batch) and commit per request
+#   commit   - events are buffered and the request returns once its batch has been committed
+#   buffered - the request returns 202 as soon as the event is queued; the buffer is flushed
+#              on size/time thresholds and always before the invocation ends
+# Batching across requests only happens in a long-running server handling many requests at
+# once (uvicorn main:app). On Lambda a container serves one request at a time and Mangum runs
+# the lifespan shutdown (which drains the buffer) before the response is returned, so commit
+# would only add the timer wait and buffered would give no earlier ack; there the setting is
+# ignored and events are written directly. Only POST /mailbox/events/batch batches on Lambda.
+EVENT_ACK_MODE = os.getenv("EVENT_ACK_MODE", "direct").lower()
+if EVENT_ACK_MODE != "direct" and os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    logger.warning(f"EVENT_ACK_MODE={EVENT_ACK_MODE} has no effect on Lambda, writing events directly")
+    EVENT_ACK_MODE = "direct"
+EVENT_BATCH_MAX_SIZE = int(os.getenv("EVENT_BATCH_MAX_SIZE") or 100)
+EVENT_BATCH_MAX_WAIT_MS = int(os.getenv("EVENT_BATCH_MAX_WAIT_MS") or 50)
+EVENT_BATCH_LIMIT = 500  # Maximum number of events accepted by POST /mailbox/events/batch
+# Fire-and-forget events survive this many failed flushes (database unreachable and the like),
+# and at most this many of them are held for retry; anything beyond that is logged and dropped
+EVENT_FLUSH_MAX_RETRIES = int(os.getenv("EVENT_FLUSH_MAX_RETRIES") or 3)
+EVENT_BUFFER_MAX_ROWS = int(os.getenv("EVENT_BUFFER_MAX_ROWS") or 5000)
+# Health samples are batched across reports by telemetry_buffer in a long-running server. On
+# Lambda that buffer would flush once per request anyway (see above), so each sample is written
+# in its report's own transaction and a failed write fails the request.
+TELEMETRY_WRITE_BEHIND = not os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+
+# Keyset pagination for list endpoints
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 500
+
+# Retention for time-partitioned tables (0 keeps data forever). mailbox_events and notifications
+# are range-partitioned by month so expired months are dropped instead of DELETEd.
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS") or 365)
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS") or 365)
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv("ROLLUP_HOURLY_RETENTION_DAYS") or 90)
+# Raw health samples are short-lived (partitioned like events); their hourly rollups are tiny
+TELEMETRY_RETENTION_DAYS = int(os.getenv("TELEMETRY_RETENTION_DAYS") or 30)
+TELEMETRY_ROLLUP_RETENTION_DAYS = int(os.getenv("TELEMETRY_ROLLUP_RETENTION_DAYS") or 0)
+PARTITION_MONTHS_AHEAD = 2  # Future monthly partitions kept ready by run_maintenance
+RETENTION_DELETE_CHUNK = 5000  # Rows per DELETE when a table is not partitioned
+
+# Image delivery: "proxy" streams bytes through the function, "presigned" redirects
+# viewers to short-lived S3 URLs and lets devices PUT straight to the bucket
+IMAGE_DELIVERY_MODE = os.getenv("IMAGE_DELIVERY_MODE", "proxy").lower()
+IMAGE_URL_EXPIRY_SECONDS = int(os.getenv("IMAGE_URL_EXPIRY_SECONDS") or 300)
+
+# Proxy uploads go to S3 from the spooled request file, as multipart once a frame exceeds the
+# chunk size (S3 needs parts of at least 5 MB). Behind Mangum on a Function URL the request
+# body is capped at 6 MB and already held in memory whole, so multipart rarely triggers there
+# and memory still grows with the frame; large frames should use the presigned PUT
+# (POST /mailbox/images/upload-url), which never passes through the function.
+IMAGE_UPLOAD_CHUNK_MB = max(int(os.getenv("IMAGE_UPLOAD_CHUNK_MB") or 8), 5)
+IMAGE_UPLOAD_CONCURRENCY = int(os.getenv("IMAGE_UPLOAD_CONCURRENCY") or 2)
+
+# Thumbnails live next to the original under <device_id>/_derived/<size>/ and are made on
+# first request (and on upload when IMAGE_THUMBNAIL_ON_UPLOAD is set). Only these sizes
+# (longest edge in px) and formats are served so callers can't fill the bucket with variants.
+IMAGE_THUMBNAIL_SIZES = [int(v) for v in (os.getenv("IMAGE_THUMBNAIL_SIZES") or "160,320,640").split(",") if v.strip()]
+IMAGE_THUMBNAIL_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+IMAGE_THUMBNAIL_ON_UPLOAD = os.getenv("IMAGE_THUMBNAIL_ON_UPLOAD", "false").lower() == "true"
+derivative_cache = TTLCache("derivatives", 3600, CACHE_MAX_ENTRIES)  # Derived keys known to exist
+
+# Upload deduplication. An exact (SHA-256) repeat of a device's image reuses the stored object;
+# one arriving within IMAGE_DEDUP_RETRY_SECONDS is treated as a client retry and returns the
+# original row. IMAGE_PERCEPTUAL_DEDUP_DISTANCE > 0 also reuses the latest object when the new
+# frame's 64-bit difference hash is within that many bits (near-identical empty-mailbox shots).
+IMAGE_DEDUP_RETRY_SECONDS = int(os.getenv("IMAGE_DEDUP_RETRY_SECONDS") or 300)
+IMAGE_PERCEPTUAL_DEDUP_DISTANCE = int(os.getenv("IMAGE_PERCEPTUAL_DEDUP_DISTANCE") or 0)
+
+S3_DELETE_BATCH = 1000  # Keys per delete_objects call (the S3 maximum)
+IMAGE_BULK_DELETE_LIMIT = 1000  # Image ids per bulk delete request / transaction
+# Objects newer than this are never garbage collected: a presigned upload may not be registered yet
+IMAGE_GC_MIN_AGE_HOURS = int(os.getenv("IMAGE_GC_MIN_AGE_HOURS") or 24)
+# A GC pass that would run into the function timeout stops this long before it and the next
+# run resumes after the last key it checked. A new pass starts IMAGE_GC_INTERVAL_DAYS after
+# the previous one finished, so a bucket too large for one run is covered over several.
+IMAGE_GC_TIME_MARGIN_SECONDS = 30
+IMAGE_GC_INTERVAL_DAYS = int(os.getenv("IMAGE_GC_INTERVAL_DAYS") or 7)
+
+# Dashboard push. Dashboards open a WebSocket to the API Gateway WebSocket API with
+# ?clerk_id=... (handle_websocket records the connection); new events, images and notifications
+# are then posted to the owner's connections as they are written. DASHBOARD_PUSH_ENDPOINT is
+# that API's https callback URL (set by the CDK stack); without it nothing is pushed.
+DASHBOARD_PUSH_ENDPOINT = os.getenv("DASHBOARD_PUSH_ENDPOINT")
+
+# Notification coalescing. With NOTIFY_COALESCE_SECONDS > 0 a device gets at most one email per
+# window: the first event is sent at once and later ones are held and sent together when the
+# window closes. NOTIFY_DIGEST=true holds the first event too, so every burst becomes one digest.
+# Held notifications are delivered by run_maintenance({"job": "notification_digest"}).
+NOTIFY_COALESCE_SECONDS = int(os.getenv("NOTIFY_COALESCE_SECONDS") or 0)
+NOTIFY_DIGEST = os.getenv("NOTIFY_DIGEST", "false").lower() == "true"
+
+# Email dispatch: sends run concurrently on a shared session and retry 429/5xx/network errors
+# with exponential backoff (honouring Retry-After)
+EMAIL_MAX_CONCURRENCY = int(os.getenv("EMAIL_MAX_CONCURRENCY") or 8)
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS") or 4)
+EMAIL_BACKOFF_BASE_SECONDS = 0.5
+EMAIL_BACKOFF_MAX_SECONDS = 8.0
+EMAIL_TIMEOUT_SECONDS = 10
+email_executor = ThreadPoolExecutor(max_workers=EMAIL_MAX_CONCURRENCY, thread_name_prefix="email")
+# Device email addresses, shared by warm notification invocations; a changed address is
+# picked up once its entry expires
+RECIPIENT_CACHE_SECONDS = int(os.getenv("RECIPIENT_CACHE_SECONDS") or 60)
+recipient_cache = TTLCache("recipients", RECIPIENT_CACHE_SECONDS, CACHE_MAX_ENTRIES)
+# Serial number -> device, for devices activating on boot. Deleting a device drops its entry.
+DEVICE_LOOKUP_CACHE_SECONDS = int(os.getenv("DEVICE_LOOKUP_CACHE_SECONDS") or 300)
+device_lookup_cache = TTLCache("device_lookup", DEVICE_LOOKUP_CACHE_SECONDS, CACHE_MAX_ENTRIES)
+
+class _RetryingCursor:
+    """Cursor wrapper that reconnects and retries the first statement of a checkout once.
+
+    Only the first statement is safe to replay: nothing has run on the connection yet, so a
+    socket that died while the container was frozen can't have lost part of a transaction.
+    """
+
+    def __init__(self, conn, **options):
+        self._conn = conn
+        self._options = options
+        self._first = True
+        DB_METRICS["sync"]["pings"] += 1  # cursor() checks is_connected() first
+        try:
+            self._cur = conn.cursor(**options)
+        except mysql.connector.OperationalError as e:
+            # cursor() refuses a connection that no longer answers a ping
+            self._reconnect(e)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def execute(self, *args, **kwargs):
+        return self._run("execute", args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._run("executemany", args, kwargs)
+
+    def _reconnect(self, error: Exception) -> None:
+        logger.warning(f"Connection lost before first statement ({error}), reconnecting")
+        DB_METRICS["sync"]["dead_connections"] += 1
+        self._conn.reconnect()
+        DB_METRICS["sync"]["reconnects"] += 1
+        DB_METRICS["sync"]["pings"] += 1
+        self._cur = self._conn.cursor(**self._options)
+
+    def _run(self, method: str, args: tuple, kwargs: dict):
+        first, self._first = self._first, False
+        try:
+            return getattr(self._cur, method)(*args, **kwargs)
+        except mysql.connector.Error as e:
+            if not first or e.errno not in DB_DISCONNECT_ERRNOS:
+                raise
+            self._reconnect(e)
+            DB_METRICS["sync"]["retries"] += 1
+            return getattr(self._cur, method)(*args, **kwargs)
+
+def _schema_ddl() -> Dict[str, str]:
+    """CREATE TABLE statements for the baseline schema, keyed by table"""
+    return {
+        "devices": """
+          CREATE TABLE IF NOT EXISTS devices (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            clerk_id VARCHAR(255) NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            location VARCHAR(255),
+            is_active BOOLEAN NOT NULL DEFAULT TRUE,
+            last_seen DATETIME,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            mail_delivered_notify BOOLEAN DEFAULT TRUE,
+            mailbox_opened_notify BOOLEAN DEFAULT TRUE,
+            mail_removed_notify BOOLEAN DEFAULT TRUE,
+            battery_low_notify BOOLEAN DEFAULT TRUE,
+            push_notifications BOOLEAN DEFAULT TRUE,
+            email_notifications BOOLEAN DEFAULT FALSE,
+            check_interval INT DEFAULT 15,
+            battery_threshold INT DEFAULT 20,
+            capture_image_on_open BOOLEAN DEFAULT TRUE,
+            capture_image_on_delivery BOOLEAN DEFAULT TRUE,
+            UNIQUE KEY uq_devices_clerk_id (clerk_id)
+          ) ENGINE=InnoDB;
+        """,
+        # Partitioned tables cannot carry foreign keys, delete_device cleans these up itself
+        "mailbox_events": f"""
+          CREATE TABLE IF NOT EXISTS mailbox_events (
+            id INT AUTO_INCREMENT,
+            device_id INT NOT NULL,
+            event_type ENUM('open','close') NOT NULL,
+            occurred_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, occurred_at)
+          ) ENGINE=InnoDB
+          PARTITION BY RANGE (TO_DAYS(occurred_at)) ({_initial_partitions()});
+        """,
+        "images": """
+          CREATE TABLE IF NOT EXISTS images (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            device_id INT NOT NULL,
+            image_url VARCHAR(2083) NOT NULL,
+            captured_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            content_sha256 CHAR(64) NULL,
+            perceptual_hash BIGINT UNSIGNED NULL,
+            FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+          ) ENGINE=InnoDB;
+        """,
+        "notifications": f"""
+          CREATE TABLE IF NOT EXISTS notifications (
+            id INT AUTO_INCREMENT,
+            device_id INT NOT NULL,
+            notification_type VARCHAR(50) NOT NULL,
+            sent_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, sent_at)
+          ) ENGINE=InnoDB
+          PARTITION BY RANGE (TO_DAYS(sent_at)) ({_initial_partitions()});
+        """,
+        "device_summary": """
+          CREATE TABLE IF NOT EXISTS device_summary (
+            device_id INT PRIMARY KEY,
+            recent_events JSON,
+            last_image_id INT,
+            last_image_url VARCHAR(2083),
+            last_image_at DATETIME,
+            notification_count INT NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+          ) ENGINE=InnoDB;
+        """,
+        "event_rollups_hourly": """
+          CREATE TABLE IF NOT EXISTS event_rollups_hourly (
+            device_id INT NOT NULL,
+            bucket DATETIME NOT NULL,
+            event_type ENUM('open','close') NOT NULL,
+            event_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (device_id, bucket, event_type),
+            FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+          ) ENGINE=InnoDB;
+        """,
+        "notification_dispatch": """
+          CREATE TABLE IF NOT EXISTS notification_dispatch (
+            device_id INT PRIMARY KEY,
+            last_sent_at DATETIME NULL,
+            pending_since DATETIME NULL,
+            pending JSON NULL,
+            INDEX idx_dispatch_pending (pending_since),
+            FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+          ) ENGINE=InnoDB;
+        """,
+        "event_rollups_daily": """
+          CREATE TABLE IF NOT EXISTS event_rollups_daily (
+            device_id INT NOT NULL,
+            bucket DATE NOT NULL,
+            event_type ENUM('open','close') NOT NULL,
+            event_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (device_id, bucket, event_type),
+            FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+          ) ENGINE=InnoDB;
+        """,
+    }
+
+# Schema migrations. Each entry is (version, description, steps) and runs once, in order;
+# schema_version records what has been applied. A step is a SQL statement or a callable
+# taking a cursor. DDL commits implicitly in MySQL, so an interrupted migration is simply
+# run again: "already exists" errors from its statements are ignored.
+SCHEMA_VERSION_DDL = """
+  CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+  ) ENGINE=InnoDB;
+"""
+SCHEMA_LOCK_NAME = "mailbox_schema_migration"
+SCHEMA_LOCK_TIMEOUT_SECONDS = 60
+# Table (1050), column (1060) or index (1061) already exists, or the index to drop is gone (1091)
+SCHEMA_EXISTS_ERRNOS = {1050, 1060, 1061, 1091}
+
+def _backfill_if_empty(table: str, statements: List[str]):
+    """Migration step running a one-off backfill only while `table` has no rows"""
+    def step(cur) -> None:
+        cur.execute(f"SELECT EXISTS(SELECT 1 FROM {table})")
+        if not cur.fetchone()[0]:
+            logger.info(f"Backfilling {table}")
+            for stmt in statements:
+                cur.execute(stmt)
+    return step
+
+def _table_exists(cur, table: str) -> bool:
+    cur.execute(
+        "SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s",
+        (DB['database'], table),
+    )
+    return cur.fetchone()[0] > 0
+
+def _column_exists(cur, table: str, column: str) -> bool:
+    cur.execute(
+        "SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME=%s",
+        (DB['database'], table, column),
+    )
+    return cur.fetchone()[0] > 0
+
+def _unique_index_on(cur, table: str, column: str) -> Optional[str]:
+    """Name of a single-column unique index on table.column, if there is one"""
+    cur.execute(
+        """
+        SELECT INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s
+        GROUP BY INDEX_NAME HAVING COUNT(*) = 1 AND MAX(COLUMN_NAME) = %s AND MAX(NON_UNIQUE) = 0
+        """,
+        (DB['database'], table, column),
+    )
+    row = cur.fetchone()
+    cur.fetchall()
+    return row[0] if row else None
+
+# What the firmware sends as its serial (DEVICE_SERIAL, e.g. "ESP32_001")
+SERIAL_NUMBER_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{2,63}")
+
+def _add_serial_number_column(cur) -> None:
+    """Add devices.serial_number with a unique index, unless the table already has them.
+
+    The Next.js init-db route creates devices with serial_number VARCHAR(255) UNIQUE (plus a
+    foreign key to device_serials); another unique index on that column would be redundant.
+    """
+    if not _column_exists(cur, "devices", "serial_number"):
+        cur.execute("ALTER TABLE devices ADD COLUMN serial_number VARCHAR(64) NULL")
+    existing = _unique_index_on(cur, "devices", "serial_number")
+    if existing:
+        logger.info(f"devices.serial_number is already unique ({existing})")
+        return
+    cur.execute("CREATE UNIQUE INDEX uq_devices_serial_number ON devices(serial_number)")
+
+def _backfill_serial_numbers(cur) -> None:
+    """Give devices without a serial_number the serial their name held.
+
+    Devices used to be found with name LIKE '%serial%'. When device_serials exists (the Next.js
+    schema, whose foreign key only accepts registered serials) a registered serial contained in
+    the name is adopted; otherwise a name that is itself serial-shaped is. A serial is only set
+    when it is unambiguous: one candidate for the device, one device for the serial, and no
+    other device already has it. The devices left without one are logged.
+    """
+    if _table_exists(cur, "device_serials"):
+        cur.execute(
+            """
+            SELECT d.id, s.serial_number FROM devices d
+            JOIN device_serials s ON LOCATE(s.serial_number, d.name) > 0
+            WHERE d.serial_number IS NULL
+            """
+        )
+        candidates = cur.fetchall()
+    else:
+        cur.execute("SELECT id, name FROM devices WHERE serial_number IS NULL")
+        candidates = [(device_id, name) for device_id, name in cur.fetchall()
+                      if SERIAL_NUMBER_PATTERN.fullmatch(name)]
+    cur.execute("SELECT serial_number FROM devices WHERE serial_number IS NOT NULL")
+    taken = {r[0] for r in cur.fetchall()}
+
+    per_device: Dict[int, List[str]] = {}
+    per_serial: Dict[str, List[int]] = {}
+    for device_id, serial in candidates:
+        per_device.setdefault(device_id, []).append(serial)
+        per_serial.setdefault(serial, []).append(device_id)
+    updates = [
+        (serials[0], device_id) for device_id, serials in per_device.items()
+        if len(serials) == 1 and len(per_serial[serials[0]]) == 1 and serials[0] not in taken
+    ]
+    if updates:
+        cur.executemany("UPDATE devices SET serial_number=%s WHERE id=%s AND serial_number IS NULL", updates)
+    logger.info(f"Backfilled serial numbers for {len(updates)} devices")
+
+    cur.execute("SELECT id FROM devices WHERE serial_number IS NULL ORDER BY id")
+    missing = [r[0] for r in cur.fetchall()]
+    if missing:
+        logger.warning(f"{len(missing)} devices have no serial number and can't be found by "
+                       f"/device/lookup until one is set: ids {missing[:50]}")
+
+def _migrations() -> List[Tuple[int, str, List[Any]]]:
+    """All schema migrations, oldest first. Append new ones; never edit one that has shipped."""
+    ddl = _schema_ddl()
+    return [
+        # Adopts databases created by the ad-hoc init_pool from before schema_version existed
+        (1, "baseline schema", [
+            ddl["devices"],
+            ddl["mailbox_events"],
+            ddl["images"],
+            ddl["notifications"],
+            ddl["device_summary"],
+            ddl["event_rollups_hourly"],
+            ddl["event_rollups_daily"],
+            ddl["notification_dispatch"],
+            "CREATE INDEX idx_devices_clerk_id ON devices(clerk_id)",
+            "CREATE INDEX idx_events_device_id ON mailbox_events(device_id)",
+            "CREATE INDEX idx_events_event_type ON mailbox_events(event_type)",
+            "CREATE INDEX idx_images_device_id ON images(device_id)",
+            "CREATE INDEX idx_images_device_captured ON images(device_id, captured_at)",
+            "CREATE INDEX idx_notifs_device_id ON notifications(device_id)",
+            "CREATE INDEX idx_notifs_type ON notifications(notification_type)",
+            # Columns added to devices and images after their tables first shipped
+            "ALTER TABLE devices ADD COLUMN clerk_id VARCHAR(255) NOT NULL",
+            "ALTER TABLE devices ADD COLUMN email VARCHAR(255) NOT NULL",
+            "ALTER TABLE images ADD COLUMN content_sha256 CHAR(64) NULL",
+            "ALTER TABLE images ADD COLUMN perceptual_hash BIGINT UNSIGNED NULL",
+            "CREATE INDEX idx_images_device_hash ON images(device_id, content_sha256)",
+            _backfill_if_empty("device_summary", SUMMARY_BACKFILL_SQL),
+            _backfill_if_empty("event_rollups_daily", ROLLUP_BACKFILL_SQL),
+        ]),
+        # Also runs on databases created by the Next.js init-db route, which already have the
+        # column and index; only serial-shaped or registered names are backfilled
+        (2, "device serial numbers", [
+            _add_serial_number_column,
+            _backfill_serial_numbers,
+        ]),
+        # Match the hot query shapes: filter on a key, newest first by timestamp (InnoDB appends
+        # the primary key, which covers the id tiebreak). Indexes that became a prefix of a
+        # composite one are dropped to save write amplification. Checked by explain_hot_queries.
+        (3, "composite indexes for hot queries", [
+            "CREATE INDEX idx_events_device_occurred ON mailbox_events(device_id, occurred_at)",
+            "DROP INDEX idx_events_device_id ON mailbox_events",
+            "CREATE INDEX idx_notifs_device_sent ON notifications(device_id, sent_at)",
+            "DROP INDEX idx_notifs_device_id ON notifications",
+            "CREATE INDEX idx_images_device_hash_captured ON images(device_id, content_sha256, captured_at)",
+            "DROP INDEX idx_images_device_hash ON images",
+            "CREATE INDEX idx_devices_name_created ON devices(name, created_at)",
+            # Duplicates uq_devices_clerk_id
+            "DROP INDEX idx_devices_clerk_id ON devices",
+        ]),
+        (4, "device telemetry", [
+            "ALTER TABLE devices ADD COLUMN firmware_version VARCHAR(32) NULL",
+            # Narrow columns: percent, dBm and tenths of a degree. Clustered by device and time,
+            # so a device's samples are appended and read back as one contiguous range.
+            f"""
+            CREATE TABLE IF NOT EXISTS device_telemetry (
+              device_id INT NOT NULL,
+              recorded_at DATETIME NOT NULL,
+              battery_level TINYINT UNSIGNED NULL,
+              signal_strength SMALLINT NULL,
+              temperature_dc SMALLINT NULL,
+              PRIMARY KEY (device_id, recorded_at)
+            ) ENGINE=InnoDB
+            PARTITION BY RANGE (TO_DAYS(recorded_at)) ({_initial_partitions()});
+            """,
+            # Sums and counts rather than averages, so hourly rows merge and re-aggregate exactly
+            """
+            CREATE TABLE IF NOT EXISTS telemetry_rollups_hourly (
+              device_id INT NOT NULL,
+              bucket DATETIME NOT NULL,
+              battery_min TINYINT UNSIGNED NULL,
+              battery_max TINYINT UNSIGNED NULL,
+              battery_sum INT UNSIGNED NOT NULL DEFAULT 0,
+              battery_count SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+              signal_min SMALLINT NULL,
+              signal_max SMALLINT NULL,
+              signal_sum INT NOT NULL DEFAULT 0,
+              signal_count SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+              temperature_min SMALLINT NULL,
+              temperature_max SMALLINT NULL,
+              temperature_sum INT NOT NULL DEFAULT 0,
+              temperature_count SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+              PRIMARY KEY (device_id, bucket),
+              FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
+            ) ENGINE=InnoDB;
+            """,
+        ]),
+        # Progress of scheduled jobs that take more than one invocation (run_image_gc)
+        (5, "maintenance job state", [
+            """
+            CREATE TABLE IF NOT EXISTS maintenance_state (
+              job VARCHAR(64) PRIMARY KEY,
+              resume_after VARCHAR(1024) NULL,
+              last_completed_at DATETIME NULL
+            ) ENGINE=InnoDB;
+            """,
+        ]),
+        # Open dashboard WebSockets, by owner (see _push_to_dashboards)
+        (6, "dashboard push connections", [
+            """
+            CREATE TABLE IF NOT EXISTS dashboard_connections (
+              connection_id VARCHAR(128) PRIMARY KEY,
+              clerk_id VARCHAR(255) NOT NULL,
+              connected_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              INDEX idx_dashboard_connections_clerk (clerk_id)
+            ) ENGINE=InnoDB;
+            """,
+        ]),
+    ]
+
+def _schema_version(cur) -> int:
+    """Highest applied migration, 0 for a database that has never been migrated"""
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+    except mysql.connector.Error as e:
+        if e.errno != 1146:  # Table doesn't exist
+            raise
+        return 0
+    return cur.fetchone()[0] or 0
+
+def _apply_migration_step(cur, step) -> None:
+    if callable(step):
+        step(cur)
+        return
+    try:
+        cur.execute(step)
+    except mysql.connector.Error as e:
+        if e.errno not in SCHEMA_EXISTS_ERRNOS:
+            raise
+        logger.info(f"Already applied, continuing: {' '.join(step.split())[:80]}")
+
+def migrate_schema(conn) -> int:
+    """Bring the schema up to the latest migration and return the version it is at.
+
+    When the schema is current this is a single primary-key read of schema_version. Otherwise
+    a named lock keeps concurrently starting containers from migrating at the same time.
+    """
+    migrations = _migrations()
+    latest = migrations[-1][0]
+    cur = _RetryingCursor(conn)
+    current = _schema_version(cur)
+    if current >= latest:
+        return current
+
+    cur.execute("SELECT GET_LOCK(%s, %s)", (SCHEMA_LOCK_NAME, SCHEMA_LOCK_TIMEOUT_SECONDS))
+    if cur.fetchone()[0] != 1:
+        raise RuntimeError(f"Timed out waiting for the {SCHEMA_LOCK_NAME} lock")
+    try:
+        cur.execute(SCHEMA_VERSION_DDL)  # Commits, so the re-read below sees other containers' work
+        current = _schema_version(cur)
+        for version, description, steps in migrations:
+            if version <= current:
+                continue
+            logger.info(f"Applying schema migration {version}: {description}")
+            for step in steps:
+                _apply_migration_step(cur, step)
+            cur.execute("INSERT INTO schema_version(version, description) VALUES (%s,%s)",
+                        (version, description))
+            conn.commit()
+            current = version
+    finally:
+        cur.execute("SELECT RELEASE_LOCK(%s)", (SCHEMA_LOCK_NAME,))
+        cur.fetchone()
+    logger.info(f"Schema migrated to version {current}")
+    return current
+
+def check_schema(conn) -> int:
+    """Return the version the schema is at without migrating it.
+
+    A schema behind the code is logged rather than raised: the functions serving requests
+    keep running on it while run_migrations (deploy time) catches it up.
+    """
+    latest = _migrations()[-1][0]
+    current = _schema_version(_RetryingCursor(conn))
+    if current < latest:
+        logger.error(f"Schema is at version {current}, expected {latest}; run the migrate job")
+    return current
+
+def _create_database() -> None:
+    """Create the configured database on a server that doesn't have it yet"""
+    db_params = {k: v for k, v in DB.items() if k != "database"}
+    logger.info(f"Connecting to MySQL server at {DB['host']}:{DB['port']}")
+    with mysql.connector.connect(**db_params) as root:
+        root.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {DB['database']}")
+        logger.info(f"Created database {DB['database']}")
+
+def _create_pool() -> pooling.MySQLConnectionPool:
+    return pooling.MySQLConnectionPool(
+        pool_name="mailbox_pool", 
+        pool_size=5,  # Reduced pool size for Lambda (which has limited connections)
+        pool_reset_session=DB_VALIDATION_POLICY == "reset",
+        **DB
+    )
 
 def init_pool():
     global POOL
@@ -64,8 +767,10 @@ def init_pool():
         try:
             logger.info("Attempting to connect to database...")
             
-            # Skip heavy schema validation for Lambda cold starts
-            should_init_schema = os.getenv("INIT_SCHEMA", "true").lower() == "true"
+            # INIT_SCHEMA=true migrates, check only compares schema_version with the latest
+            # migration (deployed functions, see run_migrations), false skips even that
+            schema_mode = os.getenv("INIT_SCHEMA", "true").lower()
+            should_init_schema = schema_mode == "true"
             
             # First check if the SSL certificate exists 
             ssl_ca = DB.get("ssl_ca")
@@ -79,183 +784,28 @@ def init_pool():
                     if os.path.exists(dir_path):
                         logger.info(f"Files in directory {dir_path}: {os.listdir(dir_path)}")
             
-            # Connect to server without specifying database first
-            # Skip this for Lambda if we're not initializing schema
-            try:
-                if should_init_schema:
-                    db_params = {k: v for k, v in DB.items() if k != "database"}
-                    logger.info(f"Connecting to MySQL server at {DB['host']}:{DB['port']}")
-                    with mysql.connector.connect(**db_params) as root:
-                        logger.info("Successfully connected to database server")
-                        try:
-                            root.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {DB['database']}")
-                            logger.info(f"Ensured database {DB['database']} exists")
-                        except mysql.connector.Error as e:
-                            logger.error(f"Error creating database: {e}")
-                            raise
-                else:
-                    logger.info("Skipping schema initialization for faster Lambda startup")
-            except mysql.connector.Error as e:
-                logger.error(f"Failed to connect to MySQL server: {e}")
-                raise
-            
-            # Now create connection pool with database specified
+            # Create the connection pool; the database itself is only created when it is missing
             try:
                 logger.info("Creating connection pool...")
-                POOL = pooling.MySQLConnectionPool(
-                    pool_name="mailbox_pool", 
-                    pool_size=5,  # Reduced pool size for Lambda (which has limited connections)
-                    pool_reset_session=True,  # Reset session for each connection to avoid stale connections
-                    **DB
-                )
+                try:
+                    POOL = _create_pool()
+                except mysql.connector.Error as e:
+                    if e.errno != 1049 or not should_init_schema:  # Unknown database
+                        raise
+                    _create_database()
+                    POOL = _create_pool()
                 logger.info("Connection pool created successfully")
             except mysql.connector.Error as e:
                 logger.error(f"Failed to create connection pool: {e}")
                 raise
             
-            # Skip table creation for Lambda cold starts unless explicitly requested
-            if not should_init_schema:
-                logger.info("Skipping table creation for faster Lambda startup")
+            if schema_mode not in ("true", "check"):
+                logger.info("Skipping schema check")
                 return
             
-            ddl = {
-                "devices": """
-                  CREATE TABLE IF NOT EXISTS devices (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    clerk_id VARCHAR(255) NOT NULL,
-                    email VARCHAR(255) NOT NULL,
-                    name VARCHAR(255) NOT NULL,
-                    location VARCHAR(255),
-                    is_active BOOLEAN NOT NULL DEFAULT TRUE,
-                    last_seen DATETIME,
-                    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                    mail_delivered_notify BOOLEAN DEFAULT TRUE,
-                    mailbox_opened_notify BOOLEAN DEFAULT TRUE,
-                    mail_removed_notify BOOLEAN DEFAULT TRUE,
-                    battery_low_notify BOOLEAN DEFAULT TRUE,
-                    push_notifications BOOLEAN DEFAULT TRUE,
-                    email_notifications BOOLEAN DEFAULT FALSE,
-                    check_interval INT DEFAULT 15,
-                    battery_threshold INT DEFAULT 20,
-                    capture_image_on_open BOOLEAN DEFAULT TRUE,
-                    capture_image_on_delivery BOOLEAN DEFAULT TRUE,
-                    UNIQUE KEY uq_devices_clerk_id (clerk_id)
-                  ) ENGINE=InnoDB;
-                """,
-                "devices_indices": """
-                  CREATE INDEX idx_devices_clerk_id ON devices(clerk_id);
-                """,
-                "mailbox_events": """
-                  CREATE TABLE IF NOT EXISTS mailbox_events (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    device_id INT NOT NULL,
-                    event_type ENUM('open','close') NOT NULL,
-                    occurred_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
-                  ) ENGINE=InnoDB;
-                """,
-                "events_indices": """
-                  CREATE INDEX idx_events_device_id ON mailbox_events(device_id);
-                  CREATE INDEX idx_events_event_type ON mailbox_events(event_type);
-                """,
-                "images": """
-                  CREATE TABLE IF NOT EXISTS images (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    device_id INT NOT NULL,
-                    image_url VARCHAR(2083) NOT NULL,
-                    captured_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
-                  ) ENGINE=InnoDB;
-                """,
-                "images_indices": """
-                  CREATE INDEX idx_images_device_id ON images(device_id);
-                """,
-                "notifications": """
-                  CREATE TABLE IF NOT EXISTS notifications (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    device_id INT NOT NULL,
-                    notification_type VARCHAR(50) NOT NULL,
-                    sent_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
-                  ) ENGINE=InnoDB;
-                """,
-                "notifs_indices": """
-                  CREATE INDEX idx_notifs_device_id ON notifications(device_id);
-                  CREATE INDEX idx_notifs_type ON notifications(notification_type);
-                """,
-            }
-            
-            # First create all base tables
-            with mysql.connector.connect(**DB) as conn:
-                c = conn.cursor()
-                
-                # Create tables first - in order to avoid foreign key constraint issues
-                for table_name in ["devices", "mailbox_events", "images", "notifications"]:
-                    try:
-                        logger.info(f"Creating table {table_name} if not exists")
-                        c.execute(ddl[table_name])
-                    except mysql.connector.Error as e:
-                        # Ignore duplicate table errors
-                        if e.errno != 1050:  # Table already exists
-                            logger.error(f"Error creating table {table_name}: {e}")
-                            raise
-                        
-                # Now create indices
-                for index_name in ["devices_indices", "events_indices", "images_indices", "notifs_indices"]:
-                    # Split the multi-statement DDL into individual CREATE INDEX statements
-                    index_statements = [
-                        stmt.strip() 
-                        for stmt in ddl[index_name].split(';') 
-                        if stmt.strip()
-                    ]
-                    
-                    for stmt in index_statements:
-                        try:
-                            logger.info(f"Creating index: {stmt}")
-                            c.execute(stmt)
-                        except mysql.connector.Error as e:
-                            # Ignore duplicate index errors (1061)
-                            if e.errno != 1061:  # Index already exists 
-                                logger.error(f"Error creating index {stmt}: {e}")
-                                raise
-                            else:
-                                logger.info(f"Index already exists, continuing: {stmt}")
-                
-                conn.commit()
-                logger.info("Base tables and indices created successfully")
-
-            # Check for column existence rather than trying to add directly
-            with mysql.connector.connect(**DB) as conn:
-                c = conn.cursor()
-                
-                # Check if clerk_id column exists
-                c.execute("""
-                    SELECT COUNT(*) 
-                    FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_SCHEMA = %s 
-                    AND TABLE_NAME = 'devices' 
-                    AND COLUMN_NAME = 'clerk_id'
-                """, (DB['database'],))
-                
-                if c.fetchone()[0] == 0:
-                    logger.info("Adding clerk_id column to devices table")
-                    c.execute("ALTER TABLE devices ADD COLUMN clerk_id VARCHAR(255) NOT NULL")
-                
-                # Check if email column exists
-                c.execute("""
-                    SELECT COUNT(*) 
-                    FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_SCHEMA = %s 
-                    AND TABLE_NAME = 'devices' 
-                    AND COLUMN_NAME = 'email'
-                """, (DB['database'],))
-                
-                if c.fetchone()[0] == 0:
-                    logger.info("Adding email column to devices table")
-                    c.execute("ALTER TABLE devices ADD COLUMN email VARCHAR(255) NOT NULL")
-                
-                conn.commit()
+            with _pool() as conn:
+                version = migrate_schema(conn) if should_init_schema else check_schema(conn)
+            logger.info(f"Schema is at version {version}")
                 
         except mysql.connector.Error as e:
             logger.error(f"Database connection error: {e}")
@@ -266,20 +816,39 @@ def init_pool():
         else:
             logger.info("Database initialization completed successfully")
 
+@contextmanager
 def _pool():
+    """Check out a sync connection. Unless the pool resets sessions, a connection returned
+    mid-transaction (a plain SELECT opens one, autocommit is off) is rolled back so its
+    read snapshot doesn't carry over to the next request."""
     try:
         if POOL is None:
             logger.error("Database pool not initialized")
             raise HTTPException(500, "Database connection pool not initialized")
-        return POOL.get_connection()
+        conn = POOL.get_connection()
     except mysql.connector.Error as e:
         logger.error(f"MySQL pool error: {e}")
         raise HTTPException(500, f"MySQL pool error: {e}")
+    metrics = DB_METRICS["sync"]
+    metrics["checkouts"] += 1
+    metrics["pings"] += 1  # get_connection() checks is_connected()
+    try:
+        yield conn
+    finally:
+        try:
+            if DB_VALIDATION_POLICY == "reset":
+                metrics["resets"] += 1
+            elif conn.in_transaction:
+                metrics["rollbacks"] += 1
+                conn.rollback()
+        except mysql.connector.Error:
+            pass  # Dead connection, the pool reconnects it on its next checkout
+        conn.close()
 
 def _insert(sql: str, params: tuple) -> Dict[str, int]:
     with _pool() as conn:
         try:
-            cur = conn.cursor()
+            cur = _RetryingCursor(conn)
             cur.execute(sql, params)
             conn.commit()
             return {"id": cur.lastrowid}
@@ -290,17 +859,1184 @@ def _insert(sql: str, params: tuple) -> Dict[str, int]:
 def _select(sql: str, params: tuple) -> List[Dict[str, Any]]:
     with _pool() as conn:
         try:
-            cur = conn.cursor(dictionary=True)
+            cur = _RetryingCursor(conn, dictionary=True)
             cur.execute(sql, params)
             return cur.fetchall()
         except mysql.connector.Error as e:
             logger.error(f"Select error: {sql} - {e}")
             raise HTTPException(500, f"Database error: {e}")
 
+@contextmanager
+def _transaction():
+    """Unit of work: run several statements on one pooled connection with a single commit.
+
+    Yields a dictionary cursor. Everything is rolled back if the block raises.
+    """
+    with _pool() as conn:
+        cur = _RetryingCursor(conn, dictionary=True)
+        try:
+            yield cur
+            conn.commit()
+        except mysql.connector.Error as e:
+            conn.rollback()
+            logger.error(f"Transaction error: {e}")
+            raise HTTPException(500, f"Database error: {e}")
+        except BaseException:
+            conn.rollback()
+            raise
+
+def _encode_cursor(ts: datetime, row_id: int) -> str:
+    """Opaque page cursor for the (timestamp, id) position of the last row returned"""
+    raw = json.dumps([ts.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, row_id = json.loads(raw)
+        return datetime.fromisoformat(ts), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _page_sql(table: str, ts_column: str, clauses: List[str]) -> str:
+    return (f"SELECT * FROM {table} WHERE {' AND '.join(clauses)} "
+            f"ORDER BY {ts_column} DESC, id DESC LIMIT %s")
+
+def _page_cursor_clause(ts_column: str) -> str:
+    return f"({ts_column} < %s OR ({ts_column} = %s AND id < %s))"
+
+def _select_page(table: str, ts_column: str, where: str, params: tuple, response: Response,
+                 limit: int, cursor: Optional[str], since: Optional[datetime],
+                 until: Optional[datetime]) -> List[Dict[str, Any]]:
+    """Newest-first keyset pagination on (ts_column, id).
+
+    Reads at most limit + 1 rows; when more rows exist the cursor for the next page
+    is returned in the X-Next-Cursor header.
+    """
+    clauses = [where]
+    args = list(params)
+    if since:
+        clauses.append(f"{ts_column} >= %s")
+        args.append(since)
+    if until:
+        clauses.append(f"{ts_column} < %s")
+        args.append(until)
+    if cursor:
+        ts, row_id = _decode_cursor(cursor)
+        clauses.append(_page_cursor_clause(ts_column))
+        args.extend([ts, ts, row_id])
+
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    args.append(limit + 1)
+    rows = _select(_page_sql(table, ts_column, clauses), tuple(args))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1][ts_column], rows[-1]["id"])
+    return rows
+
+def _json_etag(data: Any) -> str:
+    """Strong ETag for a JSON payload: identical content always gives the same tag"""
+    body = json.dumps(data, sort_keys=True, default=str, separators=(",", ":"))
+    return '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+def _cached_etag(entry: Dict[str, Any]) -> str:
+    """ETag of a TTLCache entry, computed once and kept with the entry"""
+    if "etag" not in entry:
+        entry["etag"] = _json_etag(entry["data"])
+    return entry["etag"]
+
+def _http_date(ts: datetime) -> str:
+    # Stored timestamps are naive UTC
+    return format_datetime(ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts, usegmt=True)
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when no If-None-Match was sent"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        # HTTP dates have one-second resolution
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def _not_modified_response(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
+
+class AsyncConnectionPool:
+    """Small asyncio connection pool on top of mysql.connector.aio.
+
+    Connections are opened lazily up to `size`. When all of them are in use,
+    callers wait for one to be released instead of failing like the sync pool does.
+    Idle connections are validated on checkout according to DB_VALIDATION_POLICY.
+    """
+
+    def __init__(self, size: int, **config):
+        self.size = size
+        self._config = config
+        self._idle: List[Tuple[Any, float]] = []  # (connection, released at)
+        self._slots = asyncio.Semaphore(size)
+        self.loop = asyncio.get_running_loop()
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self._slots:
+            cnx = await self._checkout()
+            try:
+                yield cnx
+            finally:
+                await self._release(cnx)
+
+    async def _checkout(self):
+        DB_METRICS["async"]["checkouts"] += 1
+        if not self._idle:
+            return await mysql_aio.connect(**self._config)
+        cnx, released_at = self._idle.pop()
+        try:
+            if DB_VALIDATION_POLICY == "reset":
+                DB_METRICS["async"]["resets"] += 1
+                await cnx.reset_session()
+            elif DB_VALIDATION_POLICY == "ping" and time.time() - released_at >= DB_PING_IDLE_SECONDS:
+                DB_METRICS["async"]["pings"] += 1
+                await cnx.ping()
+            return cnx
+        except mysql.connector.Error as e:
+            logger.warning(f"Pooled connection idle for {time.time() - released_at:.0f}s is gone ({e}), reconnecting")
+            DB_METRICS["async"]["dead_connections"] += 1
+            await self._discard(cnx)
+            DB_METRICS["async"]["reconnects"] += 1
+            return await mysql_aio.connect(**self._config)
+
+    async def _release(self, cnx) -> None:
+        # Never hand a connection with an open transaction (or read snapshot) back to the pool
+        try:
+            if cnx.in_transaction:
+                DB_METRICS["async"]["rollbacks"] += 1
+                await cnx.rollback()
+        except Exception:
+            await self._discard(cnx)
+            return
+        self._idle.append((cnx, time.time()))
+
+    async def _discard(self, cnx) -> None:
+        try:
+            await cnx.close()
+        except Exception:
+            pass
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for cnx, _ in idle:
+            await self._discard(cnx)
+
+class _AsyncRetryingCursor:
+    """Async counterpart of _RetryingCursor, create it with `await _AsyncRetryingCursor.open(conn)`."""
+
+    def __init__(self, conn, cur, options: Dict[str, Any]):
+        self._conn = conn
+        self._cur = cur
+        self._options = options
+        self._first = True
+
+    @classmethod
+    async def open(cls, conn, **options) -> "_AsyncRetryingCursor":
+        try:
+            return cls(conn, await conn.cursor(**options), options)
+        except mysql.connector.OperationalError as e:
+            # cursor() refuses a connection whose socket is already closed
+            self = cls(conn, None, options)
+            await self._reconnect(e)
+            return self
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    async def execute(self, *args, **kwargs):
+        return await self._run("execute", args, kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._run("executemany", args, kwargs)
+
+    async def _run(self, method: str, args: tuple, kwargs: dict):
+        first, self._first = self._first, False
+        try:
+            return await getattr(self._cur, method)(*args, **kwargs)
+        except mysql.connector.Error as e:
+            if not first or e.errno not in DB_DISCONNECT_ERRNOS:
+                raise
+            await self._reconnect(e)
+            DB_METRICS["async"]["retries"] += 1
+            return await getattr(self._cur, method)(*args, **kwargs)
+
+    async def _reconnect(self, error: Exception) -> None:
+        logger.warning(f"Connection lost before first statement ({error}), reconnecting")
+        DB_METRICS["async"]["dead_connections"] += 1
+        await self._conn.reconnect()
+        DB_METRICS["async"]["reconnects"] += 1
+        self._cur = await self._conn.cursor(**self._options)
+
+async def _apool() -> AsyncConnectionPool:
+    """Return the async pool for the running event loop, creating it on first use."""
+    global ASYNC_POOL
+    loop = asyncio.get_running_loop()
+    if ASYNC_POOL is None or ASYNC_POOL.loop is not loop:
+        logger.info("Creating async connection pool...")
+        ASYNC_POOL = AsyncConnectionPool(ASYNC_POOL_SIZE, **DB)
+    return ASYNC_POOL
+
+@asynccontextmanager
+async def _atransaction():
+    """Async unit of work, see _transaction. The connection is rolled back by the pool on error."""
+    pool = await _apool()
+    try:
+        async with pool.connection() as conn:
+            cur = await _AsyncRetryingCursor.open(conn, dictionary=True)
+            yield cur
+            await conn.commit()
+    except mysql.connector.Error as e:
+        logger.error(f"Transaction error: {e}")
+        raise HTTPException(500, f"Database error: {e}") from e
+
+async def _ainsert(sql: str, params: tuple) -> Dict[str, int]:
+    async with _atransaction() as cur:
+        await cur.execute(sql, params)
+        return {"id": cur.lastrowid}
+
+async def _aselect(sql: str, params: tuple) -> List[Dict[str, Any]]:
+    pool = await _apool()
+    try:
+        async with pool.connection() as conn:
+            cur = await _AsyncRetryingCursor.open(conn, dictionary=True)
+            await cur.execute(sql, params)
+            return await cur.fetchall()
+    except mysql.connector.Error as e:
+        logger.error(f"Select error: {sql} - {e}")
+        raise HTTPException(500, f"Database error: {e}")
+
+EVENT_INSERT_SQL = "INSERT INTO mailbox_events(device_id,event_type,occurred_at) VALUES (%s,%s,%s)"
+EVENT_TYPES = ("open", "close")
+
+# Errors caused by the rows themselves (unknown device, bad value, no partition for the date),
+# which fail again however often they are retried
+ROW_REJECTED_ERRNOS = {1048, 1264, 1265, 1292, 1366, 1452, 1526}
+
+def _rejected_row_error(exc: BaseException) -> Optional[mysql.connector.Error]:
+    """The MySQL error behind `exc` if it was caused by the data written, else None"""
+    cause = exc.__cause__ if isinstance(exc, HTTPException) else exc
+    if isinstance(cause, (mysql.connector.IntegrityError, mysql.connector.DataError)):
+        return cause
+    if isinstance(cause, mysql.connector.Error) and cause.errno in ROW_REJECTED_ERRNOS:
+        return cause
+    return None
+
+def _multi_row(sql: str, rows: List[tuple]) -> Tuple[str, tuple]:
+    """Expand a single-row INSERT ... VALUES (...) into one multi-row statement and its params
+    (what executemany() sends), so it can go into a _run_script batch"""
+    values = re.search(r"VALUES\s*(\([^)]*\))", sql)
+    expanded = sql[:values.start(1)] + ",".join([values.group(1)] * len(rows)) + sql[values.end(1):]
+    return expanded, tuple(value for row in rows for value in row)
+
+async def _run_script(cur, statements: List[Tuple[str, tuple]]) -> List[Any]:
+    """Send (sql, params) statements to the server as one multi-statement query, one round trip.
+
+    Returns, per statement, its rows if it produced a result set, else the id it generated
+    (cursor.lastrowid of its own OK packet). Every result is read, so an error in any
+    statement is raised here; the caller's transaction then rolls back the earlier ones.
+    """
+    await cur.execute(
+        ";\n".join(sql.strip() for sql, _ in statements),
+        tuple(value for _, params in statements for value in params),
+    )
+    results = []
+    while True:
+        results.append(await cur.fetchall() if cur.with_rows else cur.lastrowid)
+        if not await cur.nextset():
+            return results
+
+async def _write_event_batch(rows: List[tuple], touch_device_ids: List[int]) -> List[int]:
+    """Write a batch of mailbox events with their summary and rollup updates in one commit.
+
+    The transaction is two round trips whatever the batch size (see _run_script): the event
+    INSERTs with the device_summary read (FOR UPDATE), then the merged recent_events windows,
+    the multi-row hourly and daily rollup upserts and, for device reports, the last_seen
+    update. Each event is its own single-row INSERT so its id comes from its own OK packet;
+    ids of a multi-row INSERT aren't guaranteed to be consecutive (innodb_autoinc_lock_mode=2).
+    Returns the new event ids in row order.
+    """
+    device_ids = sorted({r[0] for r in rows})
+    placeholders = ','.join(['%s'] * len(device_ids))
+    async with _atransaction() as cur:
+        results = await _run_script(cur, [(EVENT_INSERT_SQL, row) for row in rows] + [(
+            f"SELECT device_id, recent_events FROM device_summary WHERE device_id IN ({placeholders}) FOR UPDATE",
+            tuple(device_ids),
+        )])
+        event_ids, summaries = results[:-1], results[-1]
+        hourly, daily = _rollup_rows(rows)
+        writes = _merge_recent_events(rows, event_ids, summaries) + [
+            _multi_row(ROLLUP_HOURLY_UPSERT_SQL, hourly),
+            _multi_row(ROLLUP_DAILY_UPSERT_SQL, daily),
+        ]
+        if touch_device_ids:
+            writes.append((
+                f"UPDATE devices SET last_seen=NOW() WHERE id IN ({','.join(['%s'] * len(touch_device_ids))})",
+                tuple(touch_device_ids),
+            ))
+        await _run_script(cur, writes)
+    await asyncio.to_thread(_push_to_dashboards, "events", [
+        {"id": event_id, "device_id": device_id, "event_type": event_type, "occurred_at": occurred_at}
+        for event_id, (device_id, event_type, occurred_at) in zip(event_ids, rows)
+    ])
+    return event_ids
+
+class WriteBehindBuffer:
+    """Per-process write-behind buffer, shared by mailbox events and health samples.
+
+    Rows are collected until max_size are pending or max_wait_ms has passed since the first
+    one arrived, and are then written by the subclass's _write_batch. Callers that need the
+    result (e.g. the row id) await the future returned when adding. A batch the database
+    rejects because of its data is split until the offending rows are isolated; those are
+    logged and dropped so they can't hold up the rest. Fire-and-forget rows are re-queued
+    after other failures, within EVENT_FLUSH_MAX_RETRIES and EVENT_BUFFER_MAX_ROWS.
+    """
+
+    label = "row"  # For log messages
+
+    def __init__(self, max_size: int, max_wait_ms: int):
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self._rows: List[tuple] = []
+        self._waiters: List[Optional[asyncio.Future]] = []
+        self._attempts: List[int] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    async def _write_batch(self, rows: List[tuple]) -> List[Any]:
+        """Write rows in one transaction and return a result per row"""
+        raise NotImplementedError
+
+    def _append(self, row: tuple, wait: bool) -> Optional[asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future() if wait else None
+        self._rows.append(row)
+        self._waiters.append(fut)
+        self._attempts.append(0)
+
+        if len(self._rows) >= self.max_size:
+            self._schedule_flush(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._schedule_flush, loop)
+        return fut
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self) -> int:
+        """Wait for flushes already in flight, then write what is left. Call before the
+        invocation ends: a task started by the size threshold may still be mid-transaction."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        return await self.flush()
+
+    async def _write(self, rows: List[tuple]) -> List[Any]:
+        """Write rows, bisecting around rows the database rejects. Never raises; returns
+        the result or the exception for each row."""
+        try:
+            return await self._write_batch(rows)
+        except Exception as e:
+            if len(rows) == 1 or _rejected_row_error(e) is None:
+                return [e] * len(rows)
+            middle = len(rows) // 2
+            return await self._write(rows[:middle]) + await self._write(rows[middle:])
+
+    async def flush(self) -> int:
+        """Write everything currently buffered. Never raises; returns the number of rows written."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows:
+            return 0
+
+        rows, waiters, attempts = self._rows, self._waiters, self._attempts
+        self._rows, self._waiters, self._attempts = [], [], []
+        results = await self._write(rows)
+
+        written = 0
+        for row, fut, attempt, result in zip(rows, waiters, attempts, results):
+            if not isinstance(result, Exception):
+                written += 1
+                if fut is not None and not fut.done():
+                    fut.set_result(result)
+                continue
+            rejected = _rejected_row_error(result)
+            if rejected is not None:
+                logger.error(f"Dropping {self.label} {row}, rejected by the database: {rejected}")
+                self.dropped += 1
+                if fut is not None and not fut.done():
+                    fut.set_exception(HTTPException(status_code=400, detail=f"{self.label.capitalize()} rejected: {rejected}"))
+            elif fut is not None:
+                if not fut.done():
+                    fut.set_exception(result)
+            elif attempt + 1 < EVENT_FLUSH_MAX_RETRIES and len(self._rows) < EVENT_BUFFER_MAX_ROWS:
+                # Nobody is waiting on this row, keep it for the next flush
+                self._rows.append(row)
+                self._waiters.append(None)
+                self._attempts.append(attempt + 1)
+            else:
+                logger.error(f"Dropping {self.label} {row} after {attempt + 1} failed flushes: {result}")
+                self.dropped += 1
+        if self._rows and self._timer is None:
+            # Re-queued rows get their own flush instead of waiting for the next add()
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_wait, self._schedule_flush, loop)
+
+        if written:
+            logger.info(f"Flushed {written} buffered {self.label}s")
+        if written < len(rows):
+            logger.error(f"Failed to write {len(rows) - written} of {len(rows)} buffered {self.label}s")
+        return written
+
+class EventBuffer(WriteBehindBuffer):
+    """Write-behind buffer for mailbox events (EVENT_ACK_MODE commit/buffered); resolves to the
+    new event id. Rows carry whether the report also bumps the device's last_seen."""
+
+    label = "event"
+
+    def add(self, device_id: int, event_type: str, occurred_at: datetime,
+            touch_device: bool = False, wait: bool = True) -> Optional[asyncio.Future]:
+        return self._append((device_id, event_type, occurred_at, touch_device), wait)
+
+    async def _write_batch(self, rows: List[tuple]) -> List[Any]:
+        return await _write_event_batch([row[:3] for row in rows], sorted({row[0] for row in rows if row[3]}))
+
+event_buffer = EventBuffer(EVENT_BATCH_MAX_SIZE, EVENT_BATCH_MAX_WAIT_MS)
+
+async def _record_events(rows: List[tuple], response: Response, touch_device: bool = False) -> List[int]:
+    """Persist (device_id, event_type, occurred_at) rows according to EVENT_ACK_MODE.
+
+    Returns the new event ids, or an empty list when the events were only queued.
+    """
+    if EVENT_ACK_MODE == "buffered":
+        for device_id, event_type, occurred_at in rows:
+            event_buffer.add(device_id, event_type, occurred_at, touch_device, wait=False)
+        response.status_code = 202
+        return []
+
+    if EVENT_ACK_MODE == "commit":
+        futures = [
+            event_buffer.add(device_id, event_type, occurred_at, touch_device)
+            for device_id, event_type, occurred_at in rows
+        ]
+        return list(await asyncio.gather(*futures))
+
+    touch = sorted({r[0] for r in rows}) if touch_device else []
+    return await _write_event_batch(rows, touch)
+
+def _month_start(day: date, offset: int = 0) -> date:
+    """First day of the month `offset` months after the month containing `day`"""
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+def _partition_definition(month: date) -> str:
+    upper = _month_start(month, 1)
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{upper.isoformat()}'))"
+
+def _initial_partitions(first_month: Optional[date] = None) -> str:
+    """Monthly partitions from first_month (default: the current month) through
+    PARTITION_MONTHS_AHEAD, plus a catch-all. The first one also holds anything older."""
+    this_month = _month_start(datetime.utcnow().date())
+    month = min(_month_start(first_month or this_month), this_month)
+    parts = []
+    while month <= _month_start(this_month, PARTITION_MONTHS_AHEAD):
+        parts.append(_partition_definition(month))
+        month = _month_start(month, 1)
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ", ".join(parts)
+
+# Hourly and daily event counts per device and type, so historical charts never scan raw events
+ROLLUP_HOURLY_UPSERT_SQL = """
+    INSERT INTO event_rollups_hourly (device_id, bucket, event_type, event_count) VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE event_count=event_count + VALUES(event_count)
+"""
+ROLLUP_DAILY_UPSERT_SQL = """
+    INSERT INTO event_rollups_daily (device_id, bucket, event_type, event_count) VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE event_count=event_count + VALUES(event_count)
+"""
+ROLLUP_HOURLY_DECREMENT_SQL = """
+    UPDATE event_rollups_hourly SET event_count=GREATEST(event_count - 1, 0)
+    WHERE device_id=%s AND bucket=%s AND event_type=%s
+"""
+ROLLUP_DAILY_DECREMENT_SQL = """
+    UPDATE event_rollups_daily SET event_count=GREATEST(event_count - 1, 0)
+    WHERE device_id=%s AND bucket=%s AND event_type=%s
+"""
+
+# One-off backfill, run by the baseline schema migration while the rollup tables are empty
+ROLLUP_BACKFILL_SQL = [
+    """
+    INSERT INTO event_rollups_hourly (device_id, bucket, event_type, event_count)
+    SELECT device_id, TIMESTAMPADD(HOUR, HOUR(occurred_at), DATE(occurred_at)) AS bucket, event_type, COUNT(*)
+    FROM mailbox_events GROUP BY device_id, bucket, event_type
+    """,
+    """
+    INSERT INTO event_rollups_daily (device_id, bucket, event_type, event_count)
+    SELECT device_id, DATE(occurred_at) AS bucket, event_type, COUNT(*)
+    FROM mailbox_events GROUP BY device_id, bucket, event_type
+    """,
+]
+
+def _rollup_buckets(occurred_at: datetime) -> Tuple[datetime, date]:
+    # mysql-connector stores the wall-clock time and drops tzinfo
+    ts = occurred_at.replace(tzinfo=None)
+    return ts.replace(minute=0, second=0, microsecond=0), ts.date()
+
+def _rollup_rows(rows: List[tuple]) -> Tuple[List[tuple], List[tuple]]:
+    """Aggregate (device_id, event_type, occurred_at) rows into hourly and daily count upserts"""
+    hourly: Dict[tuple, int] = {}
+    daily: Dict[tuple, int] = {}
+    for device_id, event_type, occurred_at in rows:
+        hour, day = _rollup_buckets(occurred_at)
+        hourly[(device_id, hour, event_type)] = hourly.get((device_id, hour, event_type), 0) + 1
+        daily[(device_id, day, event_type)] = daily.get((device_id, day, event_type), 0) + 1
+    return (
+        [key + (count,) for key, count in hourly.items()],
+        [key + (count,) for key, count in daily.items()],
+    )
+
+# Per-device summary (device_summary) kept up to date on the write paths, so dashboards and
+# device summaries are a single indexed lookup. A row whose recent_events is NULL (or a missing
+# row) is treated as stale and rebuilt from the raw tables with bounded, indexed reads.
+RECENT_EVENTS_PER_DEVICE = 5
+
+SUMMARY_REFRESH_EVENTS_SQL = f"""
+    INSERT INTO device_summary (device_id, recent_events)
+    SELECT %s, COALESCE(JSON_ARRAYAGG(JSON_OBJECT(
+        'id', e.id, 'device_id', e.device_id, 'event_type', e.event_type, 'occurred_at', e.occurred_at
+    )), JSON_ARRAY())
+    FROM (
+        SELECT id, device_id, event_type, occurred_at FROM mailbox_events
+        WHERE device_id=%s ORDER BY occurred_at DESC, id DESC LIMIT {RECENT_EVENTS_PER_DEVICE}
+    ) e
+    ON DUPLICATE KEY UPDATE recent_events=VALUES(recent_events)
+"""
+
+SUMMARY_SET_EVENTS_SQL = """
+    INSERT INTO device_summary (device_id, recent_events) VALUES (%s,%s)
+    ON DUPLICATE KEY UPDATE recent_events=VALUES(recent_events)
+"""
+
+SUMMARY_ADD_IMAGE_SQL = """
+    INSERT INTO device_summary (device_id, last_image_id, last_image_url, last_image_at)
+    VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE
+        last_image_id=IF(last_image_at IS NULL OR VALUES(last_image_at) >= last_image_at, VALUES(last_image_id), last_image_id),
+        last_image_url=IF(last_image_at IS NULL OR VALUES(last_image_at) >= last_image_at, VALUES(last_image_url), last_image_url),
+        last_image_at=IF(last_image_at IS NULL OR VALUES(last_image_at) >= last_image_at, VALUES(last_image_at), last_image_at)
+"""
+
+SUMMARY_REFRESH_IMAGE_SQL = """
+    INSERT INTO device_summary (device_id, last_image_id, last_image_url, last_image_at)
+    SELECT %s, i.id, i.image_url, i.captured_at
+    FROM (SELECT 1) one
+    LEFT JOIN (
+        SELECT id, image_url, captured_at FROM images
+        WHERE device_id=%s ORDER BY captured_at DESC, id DESC LIMIT 1
+    ) i ON TRUE
+    ON DUPLICATE KEY UPDATE
+        last_image_id=VALUES(last_image_id),
+        last_image_url=VALUES(last_image_url),
+        last_image_at=VALUES(last_image_at)
+"""
+
+SUMMARY_ADD_NOTIFICATIONS_SQL = """
+    INSERT INTO device_summary (device_id, notification_count) VALUES (%s, GREATEST(%s, 0))
+    ON DUPLICATE KEY UPDATE notification_count=GREATEST(notification_count + %s, 0)
+"""
+
+SUMMARY_COUNT_NOTIFICATIONS_SQL = """
+    INSERT INTO device_summary (device_id, notification_count)
+    SELECT %s, COUNT(*) FROM notifications WHERE device_id=%s
+    ON DUPLICATE KEY UPDATE notification_count=VALUES(notification_count)
+"""
+
+# One-off set-based backfill, run by the baseline schema migration while device_summary is empty
+SUMMARY_BACKFILL_SQL = [
+    """
+    INSERT IGNORE INTO device_summary (device_id, recent_events, notification_count)
+    SELECT d.id, JSON_ARRAY(), (SELECT COUNT(*) FROM notifications n WHERE n.device_id = d.id)
+    FROM devices d
+    """,
+    f"""
+    UPDATE device_summary s JOIN (
+        SELECT device_id, JSON_ARRAYAGG(JSON_OBJECT(
+            'id', id, 'device_id', device_id, 'event_type', event_type, 'occurred_at', occurred_at
+        )) AS recent
+        FROM (
+            SELECT id, device_id, event_type, occurred_at,
+                   ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY occurred_at DESC, id DESC) AS rn
+            FROM mailbox_events
+        ) e WHERE e.rn <= {RECENT_EVENTS_PER_DEVICE}
+        GROUP BY device_id
+    ) r ON r.device_id = s.device_id
+    SET s.recent_events = r.recent
+    """,
+    """
+    UPDATE device_summary s JOIN (
+        SELECT id, device_id, image_url, captured_at,
+               ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY captured_at DESC, id DESC) AS rn
+        FROM images
+    ) i ON i.device_id = s.device_id AND i.rn = 1
+    SET s.last_image_id = i.id, s.last_image_url = i.image_url, s.last_image_at = i.captured_at
+    """,
+]
+
+SUMMARY_COLUMNS = """
+    s.recent_events AS summary_recent_events,
+    s.last_image_id AS summary_last_image_id,
+    s.last_image_url AS summary_last_image_url,
+    s.last_image_at AS summary_last_image_at,
+    s.notification_count AS summary_notification_count,
+    s.updated_at AS summary_updated_at
+"""
+
+def _summary_rebuild_statements(device_id: int) -> List[Tuple[str, tuple]]:
+    return [
+        (SUMMARY_REFRESH_EVENTS_SQL, (device_id, device_id)),
+        (SUMMARY_REFRESH_IMAGE_SQL, (device_id, device_id)),
+        (SUMMARY_COUNT_NOTIFICATIONS_SQL, (device_id, device_id)),
+    ]
+
+def _decode_recent_events(value) -> Optional[List[Dict[str, Any]]]:
+    """Parse the recent_events JSON column into event rows, newest first. None means stale."""
+    if value is None:
+        return None
+    events = json.loads(value) if isinstance(value, (str, bytes, bytearray)) else value
+    for e in events:
+        if isinstance(e["occurred_at"], str):
+            e["occurred_at"] = datetime.fromisoformat(e["occurred_at"])
+    events.sort(key=lambda e: (e["occurred_at"], e["id"]), reverse=True)
+    return events
+
+def _split_summary(row: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Separate the summary_* columns added by SUMMARY_COLUMNS from a devices row"""
+    summary = {k[len("summary_"):]: row.pop(k) for k in list(row) if k.startswith("summary_")}
+    summary["recent_events"] = _decode_recent_events(summary.get("recent_events"))
+    return row, summary
+
+def _summary_latest_image(device_id: int, summary: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if not summary.get("last_image_id"):
+        return None
+    return {
+        "id": summary["last_image_id"],
+        "device_id": device_id,
+        "image_url": summary["last_image_url"],
+        "captured_at": summary["last_image_at"],
+    }
+
+def _merge_recent_events(rows: List[tuple], event_ids: List[int],
+                         summaries: List[Dict[str, Any]]) -> List[Tuple[str, tuple]]:
+    """Statements folding newly inserted events into each device's recent_events window, given
+    the device_summary rows read (FOR UPDATE) in the same transaction"""
+    new_events: Dict[int, List[Dict[str, Any]]] = {}
+    for event_id, (device_id, event_type, occurred_at) in zip(event_ids, rows):
+        new_events.setdefault(device_id, []).append({
+            "id": event_id,
+            "device_id": device_id,
+            "event_type": event_type,
+            # mysql-connector stores the wall-clock time and drops tzinfo
+            "occurred_at": occurred_at.replace(tzinfo=None),
+        })
+    current = {r["device_id"]: _decode_recent_events(r["recent_events"]) for r in summaries}
+
+    statements, updates = [], []
+    for device_id, events in new_events.items():
+        existing = current.get(device_id)
+        if existing is None:
+            # No usable summary yet, rebuild the window from the events table instead
+            statements.append((SUMMARY_REFRESH_EVENTS_SQL, (device_id, device_id)))
+            continue
+        merged = sorted(existing + events, key=lambda e: (e["occurred_at"], e["id"]), reverse=True)
+        updates.append((device_id, json.dumps(merged[:RECENT_EVENTS_PER_DEVICE], default=str)))
+    if updates:
+        statements.append(_multi_row(SUMMARY_SET_EVENTS_SQL, updates))
+    return statements
+
+# ---------------------------------------------------------------------------
+# Device telemetry
+# ---------------------------------------------------------------------------
+
+# Raw samples: a device reporting twice within a second keeps the later values
+TELEMETRY_INSERT_SQL = """
+    INSERT INTO device_telemetry (device_id, recorded_at, battery_level, signal_strength, temperature_dc)
+    VALUES (%s,%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE battery_level=VALUES(battery_level), signal_strength=VALUES(signal_strength),
+                            temperature_dc=VALUES(temperature_dc)
+"""
+
+def _rollup_merge(metric: str) -> str:
+    # LEAST/GREATEST return NULL if either side is, so a missing side defers to the other
+    return (
+        f"{metric}_min=LEAST(COALESCE({metric}_min, VALUES({metric}_min)), COALESCE(VALUES({metric}_min), {metric}_min)), "
+        f"{metric}_max=GREATEST(COALESCE({metric}_max, VALUES({metric}_max)), COALESCE(VALUES({metric}_max), {metric}_max)), "
+        f"{metric}_sum={metric}_sum + VALUES({metric}_sum), "
+        f"{metric}_count={metric}_count + VALUES({metric}_count)"
+    )
+
+TELEMETRY_METRICS = ("battery", "signal", "temperature")
+TELEMETRY_ROLLUP_UPSERT_SQL = f"""
+    INSERT INTO telemetry_rollups_hourly (device_id, bucket,
+        battery_min, battery_max, battery_sum, battery_count,
+        signal_min, signal_max, signal_sum, signal_count,
+        temperature_min, temperature_max, temperature_sum, temperature_count)
+    VALUES (%s,%s, %s,%s,%s,%s, %s,%s,%s,%s, %s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE {', '.join(_rollup_merge(m) for m in TELEMETRY_METRICS)}
+"""
+
+def _telemetry_rollups(rows: List[tuple]) -> List[tuple]:
+    """Pre-aggregate (device_id, recorded_at, battery, signal, temperature_dc) samples into
+    one upsert row per device and hour: (min, max, sum, count) for each metric."""
+    buckets: Dict[Tuple[int, datetime], List[List[int]]] = {}
+    for device_id, recorded_at, *values in rows:
+        key = (device_id, recorded_at.replace(minute=0, second=0, microsecond=0))
+        per_metric = buckets.setdefault(key, [[] for _ in TELEMETRY_METRICS])
+        for samples, value in zip(per_metric, values):
+            if value is not None:
+                samples.append(value)
+    upserts = []
+    for (device_id, bucket), per_metric in buckets.items():
+        row: List[Any] = [device_id, bucket]
+        for samples in per_metric:
+            row += [min(samples), max(samples), sum(samples), len(samples)] if samples else [None, None, 0, 0]
+        upserts.append(tuple(row))
+    return upserts
+
+def _telemetry_statements(rows: List[tuple]) -> List[Tuple[str, tuple]]:
+    """Statements appending raw samples and folding them into the hourly rollups.
+
+    The raw insert keeps the later of two samples for the same device and second, so the
+    rows are deduplicated the same way first; otherwise the rollups would count both.
+    """
+    rows = list({(row[0], row[1]): row for row in rows}.values())
+    return [_multi_row(TELEMETRY_INSERT_SQL, rows), _multi_row(TELEMETRY_ROLLUP_UPSERT_SQL, _telemetry_rollups(rows))]
+
+async def _write_telemetry_batch(rows: List[tuple]) -> None:
+    """Write buffered samples and their rollups in one round trip and commit"""
+    async with _atransaction() as cur:
+        await _run_script(cur, _telemetry_statements(rows))
+
+class TelemetryBuffer(WriteBehindBuffer):
+    """Write-behind buffer for health samples (TELEMETRY_WRITE_BEHIND); nobody waits on a sample"""
+
+    label = "telemetry sample"
+
+    def add(self, row: tuple) -> None:
+        self._append(row, wait=False)
+
+    async def _write_batch(self, rows: List[tuple]) -> List[Any]:
+        await _write_telemetry_batch(rows)
+        return [None] * len(rows)
+
+telemetry_buffer = TelemetryBuffer(EVENT_BATCH_MAX_SIZE, EVENT_BATCH_MAX_WAIT_MS)
+
+# ---------------------------------------------------------------------------
+# Image storage
+# ---------------------------------------------------------------------------
+
+# Served by idx_images_device_captured, used when the device_summary pointer is missing
+LATEST_IMAGE_SQL = """
+    SELECT id, image_url, captured_at FROM images
+    WHERE device_id=%s ORDER BY captured_at DESC, id DESC LIMIT 1
+"""
+# Served by idx_images_device_hash_captured, used to deduplicate uploads
+IMAGE_BY_HASH_SQL = """
+    SELECT id, image_url, captured_at FROM images
+    WHERE device_id=%s AND content_sha256=%s ORDER BY captured_at DESC, id DESC LIMIT 1
+"""
+
+def _s3():
+    """Return the shared S3 client, creating it on first use"""
+    global s3_client
+    if s3_client is None:
+        import boto3
+        aws_region = os.getenv("AWS_REGION", "us-west-1")
+        logger.info(f"Initializing S3 client with region: {aws_region}")
+        s3_client = boto3.client("s3", region_name=aws_region)
+    return s3_client
+
+def _apigw():
+    """Return the API Gateway management client for DASHBOARD_PUSH_ENDPOINT, creating it on first use"""
+    global apigw_client
+    if apigw_client is None:
+        import boto3
+        apigw_client = boto3.client("apigatewaymanagementapi", endpoint_url=DASHBOARD_PUSH_ENDPOINT)
+    return apigw_client
+
+def _sns():
+    """Return the shared SNS client, creating it on first use"""
+    global sns_client
+    if sns_client is None:
+        import boto3
+        sns_client = boto3.client("sns")
+    return sns_client
+
+def _upload_transfer_config():
+    """TransferConfig for proxied uploads (boto3 is only imported once an upload happens)"""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=IMAGE_UPLOAD_CHUNK_MB * 1024 * 1024,
+        multipart_chunksize=IMAGE_UPLOAD_CHUNK_MB * 1024 * 1024,
+        max_concurrency=IMAGE_UPLOAD_CONCURRENCY,
+    )
+
+def _s3_bucket() -> str:
+    bucket = os.getenv("S3_BUCKET")
+    if not bucket:
+        logger.error("S3_BUCKET environment variable not set")
+        raise HTTPException(status_code=500, detail="S3 bucket not configured")
+    return bucket
+
+def _s3_url(bucket: str, key: str) -> str:
+    return f"https://{bucket}.s3.amazonaws.com/{key}"
+
+def _image_key(device_id: int, filename: str) -> str:
+    """Build the object key for a new capture, device prefixed so keys never collide across devices"""
+    timestamp = int(datetime.utcnow().timestamp())
+    safe_filename = ''.join(c for c in (filename or "") if c.isalnum() or c in '._-') or "image.jpg"
+    return f"{device_id}/{timestamp}_{safe_filename}"
+
+def _parse_s3_url(url: str) -> Optional[Tuple[str, str]]:
+    """Split an https://<bucket>.s3.amazonaws.com/<key> image URL into (bucket, key)"""
+    parts = url.replace("https://", "").split(".")
+    if len(parts) >= 3 and parts[1] == "s3":
+        return parts[0], "/".join(url.split("/")[3:])
+    return None
+
+async def _latest_image(device_id: int) -> Optional[Dict[str, Any]]:
+    """Resolve a device's most recent image from metadata, never by listing the bucket"""
+    rows = await _aselect(
+        "SELECT last_image_id, last_image_url, last_image_at FROM device_summary WHERE device_id=%s",
+        (device_id,),
+    )
+    if rows and rows[0]["last_image_id"]:
+        return _summary_latest_image(device_id, {
+            "last_image_id": rows[0]["last_image_id"],
+            "last_image_url": rows[0]["last_image_url"],
+            "last_image_at": rows[0]["last_image_at"],
+        })
+    rows = await _aselect(LATEST_IMAGE_SQL, (device_id,))
+    if not rows:
+        return None
+    return {"device_id": device_id, **rows[0]}
+
+async def _register_image(device_id: int, url: str, captured_at: datetime,
+                          content_sha256: Optional[str] = None,
+                          perceptual_hash: Optional[int] = None) -> Dict[str, int]:
+    """Record an uploaded object in images and move the device's latest image pointer"""
+    async with _atransaction() as cur:
+        await cur.execute(
+            "INSERT INTO images(device_id,image_url,captured_at,content_sha256,perceptual_hash) VALUES (%s,%s,%s,%s,%s)",
+            (device_id, url, captured_at, content_sha256, perceptual_hash),
+        )
+        result = {"id": cur.lastrowid}
+        await cur.execute(SUMMARY_ADD_IMAGE_SQL, (device_id, result["id"], url, captured_at))
+    await asyncio.to_thread(_push_to_dashboards, "images", [
+        {"id": result["id"], "device_id": device_id, "image_url": url, "captured_at": captured_at}
+    ])
+    return result
+
+def _delete_s3_keys(bucket: str, keys: List[str]) -> int:
+    """Remove keys with delete_objects, S3_DELETE_BATCH per call. Returns how many S3 accepted."""
+    deleted = 0
+    for i in range(0, len(keys), S3_DELETE_BATCH):
+        batch = keys[i:i + S3_DELETE_BATCH]
+        response = _s3().delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+        errors = response.get("Errors", [])
+        for error in errors[:5]:
+            logger.warning(f"Failed to delete S3 object {error.get('Key')}: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+    for k in keys:
+        derivative_cache.pop(k)
+    return deleted
+
+def _purge_s3_objects(orphaned: Dict[str, List[str]]) -> int:
+    """Best effort: anything left behind is picked up by run_image_gc"""
+    deleted = 0
+    for bucket, keys in orphaned.items():
+        try:
+            deleted += _delete_s3_keys(bucket, keys)
+        except Exception as e:
+            logger.warning(f"Failed to delete {len(keys)} S3 objects from {bucket}: {e}")
+    return deleted
+
+def _purge_s3_prefix(bucket: str, prefix: str) -> int:
+    deleted = 0
+    try:
+        for page in _s3().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            keys = [obj["Key"] for obj in page.get("Contents", [])]
+            if keys:
+                deleted += _delete_s3_keys(bucket, keys)
+    except Exception as e:
+        logger.warning(f"Failed to purge S3 prefix {prefix}: {e}")
+    return deleted
+
+def _delete_image_rows(cur, image_ids: List[int]) -> Tuple[List[int], Dict[str, List[str]]]:
+    """Delete images rows inside a transaction.
+
+    Returns the ids that existed and, per bucket, the object keys (originals plus derivatives)
+    that no remaining row references. The caller deletes those once the transaction is over,
+    so no connection is held during S3 calls.
+    """
+    placeholders = ','.join(['%s'] * len(image_ids))
+    cur.execute(
+        f"SELECT id, device_id, image_url FROM images WHERE id IN ({placeholders}) FOR UPDATE",
+        tuple(image_ids),
+    )
+    rows = cur.fetchall()
+    if not rows:
+        return [], {}
+    found = [r["id"] for r in rows]
+    cur.execute(f"DELETE FROM images WHERE id IN ({','.join(['%s'] * len(found))})", tuple(found))
+
+    # Deduplicated uploads share one object, only release it with its last reference
+    urls = list({r["image_url"] for r in rows})
+    device_ids = list({r["device_id"] for r in rows})
+    cur.execute(
+        f"""
+        SELECT DISTINCT image_url FROM images
+        WHERE device_id IN ({','.join(['%s'] * len(device_ids))})
+        AND image_url IN ({','.join(['%s'] * len(urls))})
+        """,
+        tuple(device_ids) + tuple(urls),
+    )
+    still_used = {r["image_url"] for r in cur.fetchall()}
+    # Point each summary at the next most recent image
+    for device_id in device_ids:
+        cur.execute(SUMMARY_REFRESH_IMAGE_SQL, (device_id, device_id))
+
+    orphaned: Dict[str, List[str]] = {}
+    for url in urls:
+        location = None if url in still_used else _parse_s3_url(url)
+        if location:
+            orphaned.setdefault(location[0], []).extend(_image_object_keys(location[1]))
+    return found, orphaned
+
+def _hash_upload(fileobj) -> str:
+    """SHA-256 of a spooled upload, read in chunks and rewound for the S3 transfer"""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def _perceptual_hash(fileobj) -> Optional[int]:
+    """64-bit difference hash (dHash) of an image, None if it can't be decoded"""
+    try:
+        from PIL import Image
+        fileobj.seek(0)
+        with Image.open(fileobj) as img:
+            img.draft("L", (64, 64))
+            pixels = list(img.convert("L").resize((9, 8)).getdata())
+    except Exception as e:
+        logger.warning(f"Perceptual hash unavailable: {e}")
+        return None
+    finally:
+        fileobj.seek(0)
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+async def _find_duplicate_image(device_id: int, content_sha256: str,
+                                perceptual_hash: Optional[int]) -> Optional[Dict[str, Any]]:
+    """Return an existing images row whose object can stand in for this upload"""
+    rows = await _aselect(IMAGE_BY_HASH_SQL, (device_id, content_sha256))
+    if rows:
+        match = rows[0]
+        match["retry"] = datetime.utcnow() - match["captured_at"] <= timedelta(seconds=IMAGE_DEDUP_RETRY_SECONDS)
+        return match
+    if perceptual_hash is None or IMAGE_PERCEPTUAL_DEDUP_DISTANCE <= 0:
+        return None
+    rows = await _aselect(
+        """
+        SELECT id, image_url, captured_at, perceptual_hash FROM images
+        WHERE device_id=%s ORDER BY captured_at DESC, id DESC LIMIT 1
+        """,
+        (device_id,),
+    )
+    if rows and rows[0]["perceptual_hash"] is not None:
+        distance = bin(int(rows[0]["perceptual_hash"]) ^ perceptual_hash).count("1")
+        if distance <= IMAGE_PERCEPTUAL_DEDUP_DISTANCE:
+            match = rows[0]
+            match["retry"] = False
+            return match
+    return None
+
+def _presigned_get(url: str) -> str:
+    location = _parse_s3_url(url)
+    if not location:
+        raise HTTPException(status_code=500, detail="Image location not recognised")
+    return _presigned_get_object(*location)
+
+def _presigned_get_object(bucket: str, key: str) -> str:
+    return _s3().generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=IMAGE_URL_EXPIRY_SECONDS,
+    )
+
+def _derived_key(key: str, size: int, fmt: str) -> str:
+    """Deterministic key for a resized copy: 7/1700000000_cam.jpg -> 7/_derived/160/1700000000_cam.webp"""
+    device_prefix, _, name = key.partition("/")
+    return f"{device_prefix}/_derived/{size}/{name.rsplit('.', 1)[0]}.{fmt}"
+
+def _image_object_keys(key: str) -> List[str]:
+    """The original object plus every derivative that may have been generated for it"""
+    return [key] + [_derived_key(key, size, fmt) for size in IMAGE_THUMBNAIL_SIZES for fmt in IMAGE_THUMBNAIL_FORMATS]
+
+def _render_derivative(bucket: str, key: str, size: int, fmt: str) -> str:
+    """Make sure a thumbnail exists in S3 and return its key. Blocking, run it in a worker thread."""
+    from botocore.exceptions import ClientError
+
+    derived = _derived_key(key, size, fmt)
+    try:
+        _s3().head_object(Bucket=bucket, Key=derived)
+        return derived
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+            raise
+
+    from PIL import Image  # Only needed for thumbnails, keep it off the import path
+
+    original = _s3().get_object(Bucket=bucket, Key=key)["Body"].read()
+    with Image.open(BytesIO(original)) as img:
+        img.draft("RGB", (size, size))  # Lets JPEG decode at a reduced scale
+        thumb = img.convert("RGB")
+    thumb.thumbnail((size, size))
+    out = BytesIO()
+    thumb.save(out, format=fmt.upper(), quality=80)
+    out.seek(0)
+    _s3().put_object(
+        Bucket=bucket,
+        Key=derived,
+        Body=out,
+        ContentType=IMAGE_THUMBNAIL_FORMATS[fmt],
+        CacheControl="public, max-age=31536000, immutable",
+    )
+    logger.info(f"Generated {size}px {fmt} derivative {derived}")
+    return derived
+
+async def _ensure_derivative(bucket: str, key: str, size: int, fmt: str) -> str:
+    """Key of the derivative, rendered in a worker thread (S3 reads and Pillow both block)"""
+    derived = _derived_key(key, size, fmt)
+    entry, _ = await derivative_cache.get_or_load(
+        derived, lambda: asyncio.to_thread(_render_derivative, bucket, key, size, fmt)
+    )
+    return entry["data"]
+
+async def _pregenerate_thumbnail(bucket: str, key: str) -> None:
+    """Best effort: a failure here must never fail the upload itself"""
+    if not IMAGE_THUMBNAIL_ON_UPLOAD or not IMAGE_THUMBNAIL_SIZES:
+        return
+    try:
+        await _ensure_derivative(bucket, key, IMAGE_THUMBNAIL_SIZES[0], "jpeg")
+    except Exception as e:
+        logger.warning(f"Thumbnail generation failed for {key}: {e}")
+
+# ---------------------------------------------------------------------------
+# Dashboard push
+# ---------------------------------------------------------------------------
+
+def _push_to_dashboards(kind: str, items: List[Dict[str, Any]]) -> int:
+    """Post new rows (each with a device_id) to the WebSocket connections of their owners.
+
+    One indexed query finds the connections, then each gets a single message
+    {"type": kind, "items": [...]} with the rows of its devices. Best effort: the rows are
+    committed already, so failures are logged, and connections API Gateway reports gone are
+    forgotten. Blocking, async callers run it in a thread. Returns the messages delivered.
+    """
+    if not DASHBOARD_PUSH_ENDPOINT or not items:
+        return 0
+    device_ids = sorted({item["device_id"] for item in items})
+    try:
+        rows = _select(
+            "SELECT d.id AS device_id, c.connection_id FROM devices d "
+            "JOIN dashboard_connections c ON c.clerk_id = d.clerk_id "
+            f"WHERE d.id IN ({','.join(['%s'] * len(device_ids))})",
+            tuple(device_ids),
+        )
+    except HTTPException as e:
+        logger.warning(f"Dashboard push skipped, connection lookup failed: {e.detail}")
+        return 0
+
+    per_connection: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        per_connection.setdefault(row["connection_id"], []).extend(
+            item for item in items if item["device_id"] == row["device_id"]
+        )
+    delivered, gone = 0, []
+    for connection_id, payload in per_connection.items():
+        try:
+            _apigw().post_to_connection(
+                ConnectionId=connection_id,
+                Data=json.dumps({"type": kind, "items": payload}, default=str).encode(),
+            )
+            delivered += 1
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == "GoneException":
+                gone.append(connection_id)
+            else:
+                logger.warning(f"Dashboard push to {connection_id} failed: {e}")
+    if gone:
+        _insert(
+            f"DELETE FROM dashboard_connections WHERE connection_id IN ({','.join(['%s'] * len(gone))})",
+            tuple(gone),
+        )
+    return delivered
+
+def handle_websocket(event, context):
+    """API Gateway WebSocket routes for dashboard push.
+
+    $connect registers the connection for ?clerk_id=..., $disconnect forgets it; anything the
+    dashboard sends is ignored. Connections are trusted with a clerk_id the same way
+    GET /dashboard/{clerk_id} is.
+    """
+    if POOL is None:
+        init_pool()
+    request = event.get("requestContext", {})
+    route, connection_id = request.get("routeKey"), request.get("connectionId")
+    if route == "$connect":
+        clerk_id = (event.get("queryStringParameters") or {}).get("clerk_id")
+        if not clerk_id:
+            return {"statusCode": 400, "body": "clerk_id is required"}
+        _insert(
+            "INSERT INTO dashboard_connections (connection_id, clerk_id) VALUES (%s,%s) "
+            "ON DUPLICATE KEY UPDATE clerk_id=VALUES(clerk_id)",
+            (connection_id, clerk_id),
+        )
+    elif route == "$disconnect":
+        _insert("DELETE FROM dashboard_connections WHERE connection_id=%s", (connection_id,))
+    return {"statusCode": 200}
+
 class DevicePayload(BaseModel):
     email: str
     clerk_id: str
     name: str
+    serial_number: Optional[str] = None  # PUT /devices/{id} keeps the current one when omitted
     location: Optional[str] = None
     is_active: Optional[bool] = True
     mail_delivered_notify: Optional[bool] = True
@@ -315,13 +2051,18 @@ class DevicePayload(BaseModel):
     capture_image_on_delivery: Optional[bool] = True
 
 class DeviceBatchPayload(BaseModel):
-    devices: List[DevicePayload]
+    # Items are validated one by one in create_devices_batch, so a bad item fails alone
+    # instead of the request; the schema still documents them as DevicePayload
+    devices: List[Dict[str, Any]] = Field(json_schema_extra={"items": {"$ref": "#/components/schemas/DevicePayload"}})
 
 class MailboxEventPayload(BaseModel):
     device_id: int
-    event_type: str
+    event_type: Literal["open", "close"]
     timestamp: Optional[datetime] = None
 
+class MailboxEventBatchPayload(BaseModel):
+    events: List[MailboxEventPayload]
+
 class DeviceStatusResponse(BaseModel):
     id: int
     is_active: bool
@@ -335,6 +2076,19 @@ class DeviceHealthPayload(BaseModel):
     temperature: Optional[float] = None
     firmware_version: Optional[str] = None
 
+class ImageUploadUrlPayload(BaseModel):
+    device_id: int
+    filename: str = "image.jpg"
+    content_type: str = "image/jpeg"
+
+class ImageUploadCompletePayload(BaseModel):
+    device_id: int
+    key: str
+    captured_at: Optional[datetime] = None
+
+class ImageBulkDeletePayload(BaseModel):
+    image_ids: List[int]
+
 class NotificationPayload(BaseModel):
     device_id: int
     notification_type: str
@@ -367,20 +2121,18 @@ class DeviceSettingsPayload(BaseModel):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize boto3 clients for reuse across requests
-    global s3_client, sns_client
-    if s3_client is None:
-        s3_client = boto3.client("s3")
-    if sns_client is None:
-        sns_client = boto3.client("sns")
-        
+    # boto3 clients are created on first use (or at import with STARTUP_MODE=eager)
     init_pool()
     try:
         yield
     finally:
-        # mysql-connector pool objects don't have close(); just drop the reference
-        global POOL
-        POOL = None
+        # Lambda freezes the container once the invocation ends, so never leave events or samples
+        # buffered. Mangum runs this after every invocation, before the response goes out.
+        await event_buffer.drain()
+        await telemetry_buffer.drain()
+        # The pool is kept for the next invocation of this warm container; connections that
+        # died while it was frozen are caught by DB_VALIDATION_POLICY and the cursor retry
+        logger.debug(f"Connection pool metrics: {DB_METRICS}")
 
 app = FastAPI(title="Smart Mailbox Monitor API", version="1.0.0", lifespan=lifespan)
 
@@ -391,63 +2143,193 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "X-Cache", "X-Cache-Expires", "ETag", "Last-Modified"],
 )
 
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
 async def landing_page():
     return "<html><body><h1>Smart Mailbox Monitor API</h1><ul><li><a href='/docs'>Swagger UI</a></li><li><a href='/redoc'>ReDoc</a></li></ul></body></html>"
 
+@app.get("/metrics/db", response_model=Dict[str, Any])
+async def db_metrics():
+    """Connection validation counters for this container since it started"""
+    return {"policy": DB_VALIDATION_POLICY, "ping_idle_seconds": DB_PING_IDLE_SECONDS, **DB_METRICS}
+
+DEVICE_INSERT_SQL = """
+    INSERT INTO devices(
+        clerk_id,
+        email,
+        name,
+        serial_number,
+        location,
+        is_active,
+        mail_delivered_notify,
+        mailbox_opened_notify,
+        mail_removed_notify,
+        battery_low_notify,
+        push_notifications,
+        email_notifications,
+        check_interval,
+        battery_threshold,
+        capture_image_on_open,
+        capture_image_on_delivery
+    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+"""
+# Devices left without a serial by the backfill get one here, so /device/lookup can find them
+DEVICE_UPDATE_SQL = """
+    UPDATE devices SET 
+        name=%s,
+        serial_number=COALESCE(%s, serial_number),
+        location=%s,
+        is_active=%s,
+        mail_delivered_notify=%s,
+        mailbox_opened_notify=%s,
+        mail_removed_notify=%s,
+        battery_low_notify=%s,
+        push_notifications=%s,
+        email_notifications=%s,
+        check_interval=%s,
+        battery_threshold=%s,
+        capture_image_on_open=%s,
+        capture_image_on_delivery=%s,
+        last_seen=NOW() 
+    WHERE id=%s AND clerk_id=%s
+"""
+DEVICE_SUMMARY_INIT_SQL = "INSERT INTO device_summary(device_id,recent_events,notification_count) VALUES (%s,JSON_ARRAY(),0)"
+DEVICE_BATCH_LIMIT = 500  # Maximum number of devices accepted by POST /devices/batch
+
+def _device_row(p: DevicePayload) -> tuple:
+    return (
+        p.clerk_id, 
+        p.email, 
+        p.name, 
+        p.serial_number,
+        p.location, 
+        p.is_active,
+        p.mail_delivered_notify,
+        p.mailbox_opened_notify,
+        p.mail_removed_notify,
+        p.battery_low_notify,
+        p.push_notifications,
+        p.email_notifications,
+        p.check_interval,
+        p.battery_threshold,
+        p.capture_image_on_open,
+        p.capture_image_on_delivery
+    )
+
 @app.post("/devices")
 def create_device(p: DevicePayload):
-    result = _insert(
-        """
-        INSERT INTO devices(
-            clerk_id,
-            email,
-            name,
-            location,
-            is_active,
-            mail_delivered_notify,
-            mailbox_opened_notify,
-            mail_removed_notify,
-            battery_low_notify,
-            push_notifications,
-            email_notifications,
-            check_interval,
-            battery_threshold,
-            capture_image_on_open,
-            capture_image_on_delivery
-        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """,
-        (
-            p.clerk_id, 
-            p.email, 
-            p.name, 
-            p.location, 
-            p.is_active,
-            p.mail_delivered_notify,
-            p.mailbox_opened_notify,
-            p.mail_removed_notify,
-            p.battery_low_notify,
-            p.push_notifications,
-            p.email_notifications,
-            p.check_interval,
-            p.battery_threshold,
-            p.capture_image_on_open,
-            p.capture_image_on_delivery
-        ),
-    )
+    with _transaction() as cur:
+        try:
+            cur.execute(DEVICE_INSERT_SQL, _device_row(p))
+        except mysql.connector.IntegrityError as e:
+            if e.errno == 1062:  # Duplicate entry for clerk_id or serial_number
+                raise HTTPException(status_code=409, detail="A device with this clerk_id or serial number already exists")
+            if e.errno == 1452:  # devices.serial_number references device_serials in the Next.js schema
+                raise HTTPException(status_code=400, detail=f"Serial number {p.serial_number} is not registered")
+            raise
+        result = {"id": cur.lastrowid}
+        cur.execute(DEVICE_SUMMARY_INIT_SQL, (result["id"],))
     
     # Invalidate dashboard cache for this user to reflect the new device
     invalidate_caches(clerk_id=p.clerk_id)
     
     return result
 
+@app.post("/devices/batch", response_model=Dict[str, Any])
+def create_devices_batch(p: DeviceBatchPayload):
+    """Provision many devices with one multi-row INSERT and a single commit.
+
+    Items that fail validation, would break a unique key (clerk_id or serial_number, against
+    existing devices or earlier items in the batch) or name a serial missing from
+    device_serials (Next.js schema) are reported per item and skipped; the rest are created.
+    The new ids are read back by clerk_id rather than derived from lastrowid.
+    """
+    if not p.devices:
+        raise HTTPException(status_code=400, detail="No devices provided")
+    if len(p.devices) > DEVICE_BATCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {DEVICE_BATCH_LIMIT} devices per batch")
+
+    results: List[Dict[str, Any]] = [{"index": i} for i in range(len(p.devices))]
+    devices: Dict[int, DevicePayload] = {}
+    for i, item in enumerate(p.devices):
+        try:
+            devices[i] = DevicePayload.model_validate(item)
+        except ValidationError as e:
+            results[i]["error"] = "; ".join(
+                ": ".join(filter(None, ['.'.join(str(part) for part in err['loc']), err['msg']]))
+                for err in e.errors()
+            )
+
+    accepted: List[int] = []
+    if devices:
+        with _transaction() as cur:
+            clerk_ids = sorted({d.clerk_id for d in devices.values()})
+            serials = sorted({d.serial_number for d in devices.values() if d.serial_number})
+            # Lock the keys we are about to claim so a concurrent insert can't slip in between
+            cur.execute(
+                f"SELECT clerk_id FROM devices WHERE clerk_id IN ({','.join(['%s'] * len(clerk_ids))}) FOR UPDATE",
+                tuple(clerk_ids),
+            )
+            taken_clerks = {r["clerk_id"] for r in cur.fetchall()}
+            taken_serials: set = set()
+            registered_serials: Optional[set] = None
+            if serials:
+                placeholders = ','.join(['%s'] * len(serials))
+                cur.execute(
+                    f"SELECT serial_number FROM devices WHERE serial_number IN ({placeholders}) FOR UPDATE",
+                    tuple(serials),
+                )
+                taken_serials = {r["serial_number"] for r in cur.fetchall()}
+                try:
+                    cur.execute(
+                        f"SELECT serial_number FROM device_serials WHERE serial_number IN ({placeholders})",
+                        tuple(serials),
+                    )
+                    registered_serials = {r["serial_number"] for r in cur.fetchall()}
+                except mysql.connector.Error as e:
+                    if e.errno != 1146:  # No device_serials table, serials aren't checked
+                        raise
+
+            for i, device in devices.items():
+                if device.clerk_id in taken_clerks:
+                    results[i]["error"] = f"A device already exists for clerk_id {device.clerk_id}"
+                elif device.serial_number and device.serial_number in taken_serials:
+                    results[i]["error"] = f"Serial number {device.serial_number} is already registered"
+                elif device.serial_number and registered_serials is not None \
+                        and device.serial_number not in registered_serials:
+                    results[i]["error"] = f"Serial number {device.serial_number} is not registered"
+                else:
+                    accepted.append(i)
+                    taken_clerks.add(device.clerk_id)
+                    if device.serial_number:
+                        taken_serials.add(device.serial_number)
+
+            if accepted:
+                cur.executemany(DEVICE_INSERT_SQL, [_device_row(devices[i]) for i in accepted])
+                new_clerks = [devices[i].clerk_id for i in accepted]
+                cur.execute(
+                    f"SELECT id, clerk_id FROM devices WHERE clerk_id IN ({','.join(['%s'] * len(new_clerks))})",
+                    tuple(new_clerks),
+                )
+                ids = {r["clerk_id"]: r["id"] for r in cur.fetchall()}
+                for i in accepted:
+                    results[i]["id"] = ids[devices[i].clerk_id]
+                cur.executemany(DEVICE_SUMMARY_INIT_SQL, [(results[i]["id"],) for i in accepted])
+
+    for clerk_id in sorted({devices[i].clerk_id for i in accepted}):
+        invalidate_caches(clerk_id=clerk_id)
+    
+    return {"created": len(accepted), "failed": len(p.devices) - len(accepted), "results": results}
+
 @app.get("/devices", response_model=List[Dict[str, Any]])
-def list_devices(name: str):
-    return _select(
-        "SELECT * FROM devices WHERE name=%s ORDER BY created_at DESC",
-        (name,),
+def list_devices(name: str, response: Response, limit: int = PAGE_SIZE_DEFAULT,
+                 cursor: Optional[str] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None):
+    return _select_page(
+        "devices", "created_at", "name=%s", (name,), response,
+        limit, cursor, since, until,
     )
 
 @app.get("/devices/{device_id}", response_model=Dict[str, Any])
@@ -462,63 +2344,67 @@ def get_device(device_id: int, clerk_id: str):
 
 @app.put("/devices/{device_id}", response_model=Dict[str, int])
 def update_device(device_id: int, p: DevicePayload):
-    result = _insert(
-        """
-        UPDATE devices SET 
-            name=%s,
-            location=%s,
-            is_active=%s,
-            mail_delivered_notify=%s,
-            mailbox_opened_notify=%s,
-            mail_removed_notify=%s,
-            battery_low_notify=%s,
-            push_notifications=%s,
-            email_notifications=%s,
-            check_interval=%s,
-            battery_threshold=%s,
-            capture_image_on_open=%s,
-            capture_image_on_delivery=%s,
-            last_seen=NOW() 
-        WHERE id=%s AND clerk_id=%s
-        """,
-        (
-            p.name, 
-            p.location, 
-            p.is_active, 
-            p.mail_delivered_notify,
-            p.mailbox_opened_notify,
-            p.mail_removed_notify,
-            p.battery_low_notify,
-            p.push_notifications,
-            p.email_notifications,
-            p.check_interval,
-            p.battery_threshold,
-            p.capture_image_on_open,
-            p.capture_image_on_delivery,
-            device_id, 
-            p.clerk_id
-        ),
-    )
+    previous_serial = None
+    with _transaction() as cur:
+        if p.serial_number:
+            # The old serial's lookup cache entry must go if it changes
+            cur.execute(
+                "SELECT serial_number FROM devices WHERE id=%s AND clerk_id=%s FOR UPDATE",
+                (device_id, p.clerk_id),
+            )
+            rows = cur.fetchall()
+            previous_serial = rows[0]["serial_number"] if rows else None
+        try:
+            cur.execute(DEVICE_UPDATE_SQL, (
+                p.name, 
+                p.serial_number,
+                p.location, 
+                p.is_active, 
+                p.mail_delivered_notify,
+                p.mailbox_opened_notify,
+                p.mail_removed_notify,
+                p.battery_low_notify,
+                p.push_notifications,
+                p.email_notifications,
+                p.check_interval,
+                p.battery_threshold,
+                p.capture_image_on_open,
+                p.capture_image_on_delivery,
+                device_id, 
+                p.clerk_id
+            ))
+        except mysql.connector.IntegrityError as e:
+            if e.errno == 1062:
+                raise HTTPException(status_code=409, detail=f"Serial number {p.serial_number} is already registered")
+            if e.errno == 1452:
+                raise HTTPException(status_code=400, detail=f"Serial number {p.serial_number} is not registered")
+            raise
+        result = {"id": cur.lastrowid}
     
     # Invalidate relevant caches to ensure data consistency
-    invalidate_caches(device_id=device_id, clerk_id=p.clerk_id)
+    invalidate_caches(device_id=device_id, clerk_id=p.clerk_id, serial_number=previous_serial)
     
     return result
 
 @app.delete("/devices/{device_id}", response_model=Dict[str, int])
 def delete_device(device_id: int, clerk_id: str):
-    with _pool() as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM devices WHERE id=%s AND clerk_id=%s", 
-                       (device_id, clerk_id))
-            conn.commit()
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Device not found")
-            return {"id": device_id}
-        except mysql.connector.Error as e:
-            logger.error(f"Delete error: {e}")
-            raise HTTPException(500, f"Database error: {e}")
+    with _transaction() as cur:
+        cur.execute("SELECT serial_number FROM devices WHERE id=%s AND clerk_id=%s FOR UPDATE",
+                    (device_id, clerk_id))
+        device = cur.fetchone()
+        if device is None:
+            raise HTTPException(status_code=404, detail="Device not found")
+        cur.execute("DELETE FROM devices WHERE id=%s", (device_id,))
+        # Partitioned tables have no ON DELETE CASCADE
+        cur.execute("DELETE FROM mailbox_events WHERE device_id=%s", (device_id,))
+        cur.execute("DELETE FROM notifications WHERE device_id=%s", (device_id,))
+        cur.execute("DELETE FROM device_telemetry WHERE device_id=%s", (device_id,))
+    invalidate_caches(clerk_id=clerk_id, serial_number=device["serial_number"])
+    # images rows went with the cascade; their objects (and thumbnails) live under the device prefix
+    bucket = os.getenv("S3_BUCKET")
+    if bucket:
+        _purge_s3_prefix(bucket, f"{device_id}/")
+    return {"id": device_id}
 
 @app.patch("/devices/{device_id}/status", response_model=Dict[str, int])
 def update_device_status(device_id: int, p: DeviceStatusPayload):
@@ -536,88 +2422,107 @@ def device_heartbeat(device_id: int, p: HeartbeatPayload):
     )
 
 @app.post("/mailbox/events", response_model=Dict[str, int])
-def create_event(p: MailboxEventPayload):
+async def create_event(p: MailboxEventPayload, response: Response):
     ts = p.timestamp or datetime.utcnow()
-    return _insert(
-        "INSERT INTO mailbox_events(device_id,event_type,occurred_at) VALUES (%s,%s,%s)",
-        (p.device_id, p.event_type, ts),
-    )
+    ids = await _record_events([(p.device_id, p.event_type, ts)], response)
+    return {"id": ids[0]} if ids else {"queued": 1}
+
+@app.post("/mailbox/events/batch", response_model=Dict[str, Any])
+async def create_events_batch(p: MailboxEventBatchPayload, response: Response):
+    """Record many events at once (e.g. a device replaying its offline backlog) with one commit"""
+    if not p.events:
+        raise HTTPException(status_code=400, detail="No events provided")
+    if len(p.events) > EVENT_BATCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {EVENT_BATCH_LIMIT} events per batch")
+
+    now = datetime.utcnow()
+    rows = [(e.device_id, e.event_type, e.timestamp or now) for e in p.events]
+    ids = await _record_events(rows, response)
+    return {"ids": ids, "queued": 0 if ids else len(rows)}
 
 @app.get("/mailbox/events", response_model=List[Dict[str, Any]])
-def list_events(device_id: int):
-    return _select(
-        "SELECT * FROM mailbox_events WHERE device_id=%s ORDER BY occurred_at DESC",
-        (device_id,),
+def list_events(device_id: int, response: Response, limit: int = PAGE_SIZE_DEFAULT,
+                cursor: Optional[str] = None, since: Optional[datetime] = None,
+                until: Optional[datetime] = None):
+    return _select_page(
+        "mailbox_events", "occurred_at", "device_id=%s", (device_id,), response,
+        limit, cursor, since, until,
     )
 
 @app.delete("/mailbox/events/{event_id}", response_model=Dict[str, int])
 def delete_event(event_id: int):
-    with _pool() as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM mailbox_events WHERE id=%s", (event_id,))
-            conn.commit()
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Event not found")
-            return {"id": event_id}
-        except mysql.connector.Error as e:
-            logger.error(f"Delete error: {e}")
-            raise HTTPException(500, f"Database error: {e}")
+    with _transaction() as cur:
+        cur.execute("SELECT device_id, event_type, occurred_at FROM mailbox_events WHERE id=%s", (event_id,))
+        rows = cur.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Event not found")
+        device_id, event_type = rows[0]["device_id"], rows[0]["event_type"]
+        cur.execute("DELETE FROM mailbox_events WHERE id=%s", (event_id,))
+        # Keep the device's recent events window and rollups in step
+        cur.execute(SUMMARY_REFRESH_EVENTS_SQL, (device_id, device_id))
+        hour, day = _rollup_buckets(rows[0]["occurred_at"])
+        cur.execute(ROLLUP_HOURLY_DECREMENT_SQL, (device_id, hour, event_type))
+        cur.execute(ROLLUP_DAILY_DECREMENT_SQL, (device_id, day, event_type))
+    return {"id": event_id}
 
 @app.post("/mailbox/images", response_model=Dict[str, int])
 async def upload_image(device_id: int, file: UploadFile = File(...)):
+    """Store a frame sent through the API. On Lambda the body is limited to 6 MB and buffered
+    in memory; devices with larger frames use /mailbox/images/upload-url instead."""
     try:
-        # Use global client or create a new one with explicit region
-        global s3_client
-        if s3_client is None:
-            # Get AWS region from environment or use default
-            aws_region = os.getenv("AWS_REGION", "us-west-1")
-            logger.info(f"Initializing S3 client with region: {aws_region}")
-            s3_client = boto3.client("s3", region_name=aws_region)
-        
         # Get bucket name and log for debugging
-        bucket = os.getenv("S3_BUCKET")
-        if not bucket:
-            logger.error("S3_BUCKET environment variable not set")
-            raise HTTPException(status_code=500, detail="S3 bucket not configured")
-            
+        bucket = _s3_bucket()
         logger.info(f"Using S3 bucket: {bucket}")
         
         # Generate unique key for the file
-        timestamp = int(datetime.utcnow().timestamp())
-        safe_filename = ''.join(c for c in file.filename if c.isalnum() or c in '._-')
-        key = f"{device_id}/{timestamp}_{safe_filename}"
+        key = _image_key(device_id, file.filename)
         logger.info(f"Uploading file to S3 with key: {key}")
         
-        # Read file content into memory for better error handling
-        file_content = await file.read()
-        if not file_content:
+        # Check the size without reading the spooled upload into memory
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+        file.file.seek(0)
+        if not size:
             logger.error("Empty file content")
             raise HTTPException(status_code=400, detail="Empty file")
+        
+        # Skip the PUT when this device already stored the same (or a near-identical) frame
+        content_sha256 = await asyncio.to_thread(_hash_upload, file.file)
+        perceptual_hash = None
+        if IMAGE_PERCEPTUAL_DEDUP_DISTANCE > 0:
+            perceptual_hash = await asyncio.to_thread(_perceptual_hash, file.file)
+        duplicate = await _find_duplicate_image(device_id, content_sha256, perceptual_hash)
+        if duplicate and duplicate["retry"]:
+            logger.info(f"Upload repeats image {duplicate['id']}, treating it as a retry")
+            return {"id": duplicate["id"], "duplicate_of": duplicate["id"]}
+        if duplicate:
+            logger.info(f"Upload duplicates image {duplicate['id']}, reusing {duplicate['image_url']}")
+            result = await _register_image(device_id, duplicate["image_url"], datetime.utcnow(),
+                                           content_sha256, perceptual_hash)
+            result["duplicate_of"] = duplicate["id"]
+            return result
             
-        # Upload to S3 with proper content type
-        from io import BytesIO
+        # Stream to S3 with proper content type; runs in a worker thread so the loop stays free
         content_type = file.content_type or "application/octet-stream"
-        logger.info(f"Uploading file with content type: {content_type}")
-        s3_client.upload_fileobj(
-            BytesIO(file_content), 
-            bucket, 
-            key, 
-            ExtraArgs={"ContentType": content_type}
+        logger.info(f"Uploading {size} bytes with content type: {content_type}")
+        await asyncio.to_thread(
+            _s3().upload_fileobj,
+            file.file,
+            bucket,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=_upload_transfer_config(),
         )
         
         # Construct URL and save to database
-        url = f"https://{bucket}.s3.amazonaws.com/{key}"
+        url = _s3_url(bucket, key)
         logger.info(f"File uploaded successfully, URL: {url}")
-        ts = datetime.utcnow()
         
         # Insert into database
         try:
-            result = _insert(
-                "INSERT INTO images(device_id,image_url,captured_at) VALUES (%s,%s,%s)",
-                (device_id, url, ts),
-            )
+            result = await _register_image(device_id, url, datetime.utcnow(), content_sha256, perceptual_hash)
             logger.info(f"Image record created with ID: {result.get('id')}")
+            await _pregenerate_thumbnail(bucket, key)
             return result
         except Exception as db_error:
             logger.error(f"Database error after successful upload: {db_error}")
@@ -631,33 +2536,36 @@ async def upload_image(device_id: int, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error uploading image: {str(e)}")
 
 @app.get("/mailbox/images", response_class=StreamingResponse)
-async def list_images(device_id: int):
+async def list_images(device_id: int, request: Request):
     """Return the latest image for a device as raw binary"""
     try:
-        global s3_client
-        if s3_client is None:
-            aws_region = os.getenv("AWS_REGION", "us-west-1")
-            logger.info(f"Initializing S3 client with region: {aws_region}")
-            s3_client = boto3.client("s3", region_name=aws_region)
-        bucket_name = os.getenv("S3_BUCKET")
-        if not bucket_name:
-            logger.error("S3_BUCKET environment variable not set")
-            raise HTTPException(status_code=500, detail="S3 bucket not configured")
-
-        prefix = f"{device_id}/"
-        listing = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        contents = listing.get("Contents", [])
-        if not contents:
+        image = await _latest_image(device_id)
+        if not image:
             raise HTTPException(status_code=404, detail="No images found for this device")
 
-        # Sort by LastModified descending and pick the most recent
-        contents.sort(key=lambda obj: obj.get("LastModified"), reverse=True)
-        key = contents[0]["Key"]
+        # An images row never changes content, so its id is a strong validator
+        headers = {
+            "ETag": f'"image-{image["id"]}"',
+            "Last-Modified": _http_date(image["captured_at"]),
+            "Cache-Control": "private, no-cache",
+        }
+        if _not_modified(request, headers["ETag"], image["captured_at"]):
+            return _not_modified_response(headers)
+
+        if IMAGE_DELIVERY_MODE == "presigned":
+            # Send the viewer straight to S3 so the bytes never pass through the function
+            return RedirectResponse(_presigned_get(image["image_url"]), status_code=307)
+
+        location = _parse_s3_url(image["image_url"])
+        if not location:
+            logger.error(f"Unrecognised image URL for image {image['id']}: {image['image_url']}")
+            raise HTTPException(status_code=500, detail="Image location not recognised")
+        bucket_name, key = location
         logger.info(f"Streaming image from S3 key: {key}")
-        s3_obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+        s3_obj = await asyncio.to_thread(_s3().get_object, Bucket=bucket_name, Key=key)
         stream = s3_obj["Body"]
         content_type = s3_obj.get("ContentType", "application/octet-stream")
-        return StreamingResponse(stream, media_type=content_type)
+        return StreamingResponse(stream, media_type=content_type, headers=headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -665,105 +2573,277 @@ async def list_images(device_id: int):
         raise HTTPException(status_code=500, detail=f"Error streaming image: {e}")
 
 @app.get("/mailbox/images/latest", response_class=StreamingResponse)
-async def get_latest_image(device_id: int):
+async def get_latest_image(device_id: int, request: Request):
     """Stream the latest image for a device as raw binary"""
-    return await list_images(device_id)
+    return await list_images(device_id, request)
+
+@app.get("/mailbox/images/latest/url", response_model=Dict[str, Any])
+async def get_latest_image_url(device_id: int):
+    """Return a short-lived download URL for the latest image instead of its bytes"""
+    image = await _latest_image(device_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="No images found for this device")
+    return {
+        "id": image["id"],
+        "captured_at": image["captured_at"],
+        "url": _presigned_get(image["image_url"]),
+        "expires_in": IMAGE_URL_EXPIRY_SECONDS,
+    }
+
+@app.get("/mailbox/images/{image_id}/thumbnail", response_class=StreamingResponse)
+async def get_image_thumbnail(image_id: int, request: Request, size: Optional[int] = None,
+                              format: str = "jpeg"):
+    """Serve a resized copy of an image, generating and storing it on first request"""
+    size = size or (IMAGE_THUMBNAIL_SIZES[0] if IMAGE_THUMBNAIL_SIZES else 0)
+    if size not in IMAGE_THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {IMAGE_THUMBNAIL_SIZES}")
+    if format not in IMAGE_THUMBNAIL_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {list(IMAGE_THUMBNAIL_FORMATS)}")
+
+    rows = await _aselect("SELECT image_url, captured_at FROM images WHERE id=%s", (image_id,))
+    if not rows:
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers = {
+        "ETag": f'"image-{image_id}-{size}-{format}"',
+        "Last-Modified": _http_date(rows[0]["captured_at"]),
+        "Cache-Control": "private, max-age=86400",
+    }
+    if _not_modified(request, headers["ETag"], rows[0]["captured_at"]):
+        return _not_modified_response(headers)
+    location = _parse_s3_url(rows[0]["image_url"])
+    if not location:
+        raise HTTPException(status_code=500, detail="Image location not recognised")
+    bucket, key = location
+
+    try:
+        derived = await _ensure_derivative(bucket, key, size, format)
+        if IMAGE_DELIVERY_MODE == "presigned":
+            return RedirectResponse(_presigned_get_object(bucket, derived), status_code=307)
+        s3_obj = await asyncio.to_thread(_s3().get_object, Bucket=bucket, Key=derived)
+        return StreamingResponse(
+            s3_obj["Body"],
+            media_type=IMAGE_THUMBNAIL_FORMATS[format],
+            headers=headers,
+        )
+    except ImportError:
+        logger.error("Pillow is not installed, thumbnails are unavailable")
+        raise HTTPException(status_code=501, detail="Thumbnail support not installed")
+    except Exception as e:
+        logger.error(f"Error serving thumbnail for image {image_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error serving thumbnail: {e}")
+
+@app.post("/mailbox/images/upload-url", response_model=Dict[str, Any])
+def create_image_upload_url(p: ImageUploadUrlPayload):
+    """Issue a presigned PUT so the device uploads straight to S3, then calls /complete.
+
+    The image bytes never pass through the function, so this is the path for frames above the
+    6 MB Function URL body limit and the one that keeps the API's memory independent of size.
+    """
+    key = _image_key(p.device_id, p.filename)
+    url = _s3().generate_presigned_url(
+        "put_object",
+        Params={"Bucket": _s3_bucket(), "Key": key, "ContentType": p.content_type},
+        ExpiresIn=IMAGE_URL_EXPIRY_SECONDS,
+    )
+    return {
+        "upload_url": url,
+        "key": key,
+        "headers": {"Content-Type": p.content_type},
+        "expires_in": IMAGE_URL_EXPIRY_SECONDS,
+    }
+
+@app.post("/mailbox/images/complete", response_model=Dict[str, int])
+async def complete_image_upload(p: ImageUploadCompletePayload):
+    """Register an object uploaded through a presigned URL"""
+    if not p.key.startswith(f"{p.device_id}/"):
+        raise HTTPException(status_code=400, detail="Key does not belong to this device")
+    if p.key.startswith(f"{p.device_id}/_derived/"):
+        raise HTTPException(status_code=400, detail="Key is a derived image, not an upload")
+    bucket = _s3_bucket()
+    try:
+        await asyncio.to_thread(_s3().head_object, Bucket=bucket, Key=p.key)
+    except Exception as e:
+        logger.warning(f"Upload completion for missing object {p.key}: {e}")
+        raise HTTPException(status_code=404, detail="Uploaded object not found")
+    result = await _register_image(p.device_id, _s3_url(bucket, p.key), p.captured_at or datetime.utcnow())
+    await _pregenerate_thumbnail(bucket, p.key)
+    return result
 
 @app.delete("/mailbox/images/{image_id}", response_model=Dict[str, int])
 def delete_image(image_id: int):
-    # First get the image URL to delete from S3
-    with _pool() as conn:
-        try:
-            cur = conn.cursor(dictionary=True)
-            cur.execute("SELECT image_url FROM images WHERE id=%s", (image_id,))
-            result = cur.fetchone()
-            if not result:
-                raise HTTPException(status_code=404, detail="Image not found")
-            
-            # Parse the S3 URL to get bucket and key
-            url = result["image_url"]
-            parts = url.replace("https://", "").split(".")
-            if len(parts) >= 3 and parts[1] == "s3":
-                bucket = parts[0]
-                key = "/".join(url.split("/")[3:])
-                
-                # Delete from S3
-                try:
-                    global s3_client
-                    if s3_client is None:
-                        s3_client = boto3.client("s3")
-                    s3_client.delete_object(Bucket=bucket, Key=key)
-                except Exception as e:
-                    logger.warning(f"Failed to delete S3 object: {e}")
-            
-            # Delete from database
-            cur.execute("DELETE FROM images WHERE id=%s", (image_id,))
-            conn.commit()
-            return {"id": image_id}
-        except mysql.connector.Error as e:
-            logger.error(f"Delete error: {e}")
-            raise HTTPException(500, f"Database error: {e}")
+    with _transaction() as cur:
+        deleted, orphaned = _delete_image_rows(cur, [image_id])
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Image not found")
+    # S3 cleanup happens after the connection has gone back to the pool
+    _purge_s3_objects(orphaned)
+    return {"id": image_id}
+
+@app.post("/mailbox/images/bulk-delete", response_model=Dict[str, Any])
+def bulk_delete_images(p: ImageBulkDeletePayload):
+    """Delete up to IMAGE_BULK_DELETE_LIMIT images in one transaction and batch their S3 deletes"""
+    image_ids = list(dict.fromkeys(p.image_ids))
+    if not image_ids:
+        return {"deleted": [], "objects_deleted": 0}
+    if len(image_ids) > IMAGE_BULK_DELETE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {IMAGE_BULK_DELETE_LIMIT} images per request")
+    with _transaction() as cur:
+        deleted, orphaned = _delete_image_rows(cur, image_ids)
+    return {"deleted": deleted, "objects_deleted": _purge_s3_objects(orphaned)}
+
+@app.delete("/devices/{device_id}/images", response_model=Dict[str, Any])
+def delete_device_images(device_id: int, clerk_id: str, before: Optional[datetime] = None):
+    """Delete all of a device's images (optionally only those captured before a time)"""
+    if not _select("SELECT id FROM devices WHERE id=%s AND clerk_id=%s", (device_id, clerk_id)):
+        raise HTTPException(status_code=404, detail="Device not found")
+    sql = "SELECT id FROM images WHERE device_id=%s"
+    params: tuple = (device_id,)
+    if before is not None:
+        sql += " AND captured_at < %s"
+        params += (before,)
+    sql += f" ORDER BY id LIMIT {IMAGE_BULK_DELETE_LIMIT}"
+
+    deleted_count, objects_deleted = 0, 0
+    while True:
+        # One short transaction per chunk; S3 deletes run between them with no connection held
+        with _transaction() as cur:
+            cur.execute(sql, params)
+            ids = [r["id"] for r in cur.fetchall()]
+            deleted, orphaned = _delete_image_rows(cur, ids) if ids else ([], {})
+        deleted_count += len(deleted)
+        objects_deleted += _purge_s3_objects(orphaned)
+        if len(ids) < IMAGE_BULK_DELETE_LIMIT:
+            break
+    return {"deleted": deleted_count, "objects_deleted": objects_deleted}
 
 @app.post("/mailbox/notifications", response_model=Dict[str, int])
 def create_notification(p: NotificationPayload):
-    # Insert notification record
-    rec = _insert(
-        "INSERT INTO notifications(device_id,notification_type) VALUES (%s,%s)",
-        (p.device_id, p.notification_type),
-    )
+    # Insert notification record and bump the device's notification count
+    with _transaction() as cur:
+        cur.execute(
+            "INSERT INTO notifications(device_id,notification_type) VALUES (%s,%s)",
+            (p.device_id, p.notification_type),
+        )
+        rec = {"id": cur.lastrowid}
+        cur.execute(SUMMARY_ADD_NOTIFICATIONS_SQL, (p.device_id, 1, 1))
+    _push_to_dashboards("notifications", [
+        {"id": rec["id"], "device_id": p.device_id, "notification_type": p.notification_type}
+    ])
     # Publish notification event to SNS for async processing
-    global sns_client
-    if sns_client is None:
-        sns_client = boto3.client("sns")  # Only create if it doesn't exist
     topic_arn = os.getenv("NOTIFICATION_TOPIC_ARN")
     message = json.dumps({
         "notification_id": rec["id"],
         "device_id": p.device_id,
         "notification_type": p.notification_type,
     })
-    sns_client.publish(TopicArn=topic_arn, Message=message)
+    _sns().publish(TopicArn=topic_arn, Message=message)
     return rec
 
 @app.get("/mailbox/notifications", response_model=List[Dict[str, Any]])
-def list_notifications(device_id: int):
-    return _select(
-        "SELECT * FROM notifications WHERE device_id=%s ORDER BY sent_at DESC",
-        (device_id,),
+def list_notifications(device_id: int, response: Response, limit: int = PAGE_SIZE_DEFAULT,
+                       cursor: Optional[str] = None, since: Optional[datetime] = None,
+                       until: Optional[datetime] = None):
+    return _select_page(
+        "notifications", "sent_at", "device_id=%s", (device_id,), response,
+        limit, cursor, since, until,
     )
 
 @app.delete("/mailbox/notifications/{notification_id}", response_model=Dict[str, int])
 def delete_notification(notification_id: int):
-    with _pool() as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM notifications WHERE id=%s", (notification_id,))
-            conn.commit()
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Notification not found")
-            return {"id": notification_id}
-        except mysql.connector.Error as e:
-            logger.error(f"Delete error: {e}")
-            raise HTTPException(500, f"Database error: {e}")
+    with _transaction() as cur:
+        cur.execute("SELECT device_id FROM notifications WHERE id=%s", (notification_id,))
+        rows = cur.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Notification not found")
+        cur.execute("DELETE FROM notifications WHERE id=%s", (notification_id,))
+        cur.execute(SUMMARY_ADD_NOTIFICATIONS_SQL, (rows[0]["device_id"], -1, -1))
+    return {"id": notification_id}
 
 @app.post("/devices/{device_id}/health", response_model=Dict[str, str])
-def update_device_health(device_id: int, p: DeviceHealthPayload):
+async def update_device_health(device_id: int, p: DeviceHealthPayload):
     """Endpoint for IoT devices to report their health metrics"""
-    # First check if this device exists and belongs to the clerk
-    results = _select(
-        "SELECT id FROM devices WHERE id=%s AND clerk_id=%s",
-        (device_id, p.clerk_id),
-    )
-    if not results:
-        raise HTTPException(status_code=404, detail="Device not found")
-        
-    # For now just store basic info, but in future could store health metrics in a separate table
-    _insert(
-        "UPDATE devices SET last_seen=NOW() WHERE id=%s",
-        (device_id,),
-    )
+    # Out-of-range values would fail the whole buffered batch, so reject them up front
+    if p.battery_level is not None and not 0 <= p.battery_level <= 100:
+        raise HTTPException(status_code=400, detail="battery_level must be between 0 and 100")
+    if p.signal_strength is not None and not -32768 <= p.signal_strength <= 32767:
+        raise HTTPException(status_code=400, detail="signal_strength out of range")
+    if p.temperature is not None and not -3276.8 <= p.temperature <= 3276.7:
+        raise HTTPException(status_code=400, detail="temperature out of range")
+    
+    temperature_dc = round(p.temperature * 10) if p.temperature is not None else None
+    sample = None
+    if (p.battery_level, p.signal_strength, temperature_dc) != (None, None, None):
+        sample = (device_id, datetime.utcnow().replace(microsecond=0),
+                  p.battery_level, p.signal_strength, temperature_dc)
+
+    async with _atransaction() as cur:
+        # First check if this device exists and belongs to the clerk
+        await cur.execute(
+            "SELECT id FROM devices WHERE id=%s AND clerk_id=%s",
+            (device_id, p.clerk_id),
+        )
+        if not await cur.fetchall():
+            raise HTTPException(status_code=404, detail="Device not found")
+            
+        statements = [(
+            "UPDATE devices SET last_seen=NOW(), firmware_version=COALESCE(%s, firmware_version) WHERE id=%s",
+            (p.firmware_version[:32] if p.firmware_version else None, device_id),
+        )]
+        if sample and not TELEMETRY_WRITE_BEHIND:
+            statements += _telemetry_statements([sample])
+        await _run_script(cur, statements)
     
+    if sample and TELEMETRY_WRITE_BEHIND:
+        # Written behind, batched with other reports and the hourly rollup
+        telemetry_buffer.add(sample)
     return {"status": "updated"}
 
+@app.get("/devices/{device_id}/telemetry", response_model=List[Dict[str, Any]])
+def get_device_telemetry(device_id: int, resolution: str = "hour", since: Optional[datetime] = None,
+                         until: Optional[datetime] = None):
+    """Health history. "raw" reads samples (kept TELEMETRY_RETENTION_DAYS); "hour" and "day"
+    read the hourly rollups, so trends over months never touch raw samples."""
+    if resolution not in ("raw", "hour", "day"):
+        raise HTTPException(status_code=400, detail="resolution must be 'raw', 'hour' or 'day'")
+    ts_column = "recorded_at" if resolution == "raw" else "bucket"
+    clauses = ["device_id=%s"]
+    params: List[Any] = [device_id]
+    if since:
+        clauses.append(f"{ts_column} >= %s")
+        params.append(since)
+    if until:
+        clauses.append(f"{ts_column} < %s")
+        params.append(until)
+    where = " AND ".join(clauses)
+
+    if resolution == "raw":
+        return _select(
+            "SELECT recorded_at, battery_level, signal_strength, temperature_dc / 10 AS temperature "
+            f"FROM device_telemetry WHERE {where} ORDER BY recorded_at",
+            tuple(params),
+        )
+    if resolution == "hour":
+        return _select(
+            "SELECT bucket, "
+            "battery_min, battery_max, battery_sum / NULLIF(battery_count, 0) AS battery_avg, "
+            "signal_min, signal_max, signal_sum / NULLIF(signal_count, 0) AS signal_avg, "
+            "temperature_min / 10 AS temperature_min, temperature_max / 10 AS temperature_max, "
+            "temperature_sum / NULLIF(temperature_count, 0) / 10 AS temperature_avg "
+            f"FROM telemetry_rollups_hourly WHERE {where} ORDER BY bucket",
+            tuple(params),
+        )
+    return _select(
+        "SELECT DATE(bucket) AS bucket, "
+        "MIN(battery_min) AS battery_min, MAX(battery_max) AS battery_max, "
+        "SUM(battery_sum) / NULLIF(SUM(battery_count), 0) AS battery_avg, "
+        "MIN(signal_min) AS signal_min, MAX(signal_max) AS signal_max, "
+        "SUM(signal_sum) / NULLIF(SUM(signal_count), 0) AS signal_avg, "
+        "MIN(temperature_min) / 10 AS temperature_min, MAX(temperature_max) / 10 AS temperature_max, "
+        "SUM(temperature_sum) / NULLIF(SUM(temperature_count), 0) / 10 AS temperature_avg "
+        f"FROM telemetry_rollups_hourly WHERE {where} GROUP BY DATE(bucket) ORDER BY DATE(bucket)",
+        tuple(params),
+    )
+
 @app.post("/devices/{device_id}/notification-preferences", response_model=Dict[str, str])
 def set_notification_preferences(device_id: int, p: NotificationPreferences):
     """Set notification preferences for a device"""
@@ -774,42 +2854,59 @@ def set_notification_preferences(device_id: int, p: NotificationPreferences):
 @app.get("/devices/{device_id}/summary", response_model=Dict[str, Any])
 def get_device_summary(device_id: int, clerk_id: str):
     """Get a comprehensive summary of device status, events, and notifications for frontend dashboards"""
-    # First check if this device exists and belongs to the clerk
-    device = _select(
-        "SELECT * FROM devices WHERE id=%s AND clerk_id=%s",
-        (device_id, clerk_id),
-    )
-    if not device:
-        raise HTTPException(status_code=404, detail="Device not found")
-    
-    # Get latest event
-    latest_event = _select(
-        "SELECT * FROM mailbox_events WHERE device_id=%s ORDER BY occurred_at DESC LIMIT 1",
-        (device_id,),
-    )
-    
-    # Get latest image
-    latest_image = _select(
-        "SELECT * FROM images WHERE device_id=%s ORDER BY captured_at DESC LIMIT 1",
-        (device_id,),
-    )
-    
-    # Get notification count
-    notification_count = _select(
-        "SELECT COUNT(*) as count FROM notifications WHERE device_id=%s",
-        (device_id,),
-    )
+    query = f"""
+        SELECT d.*, {SUMMARY_COLUMNS}
+        FROM devices d LEFT JOIN device_summary s ON s.device_id = d.id
+        WHERE d.id=%s AND d.clerk_id=%s
+    """
+    with _transaction() as cur:
+        # One indexed lookup: the device row plus its precomputed summary
+        cur.execute(query, (device_id, clerk_id))
+        rows = cur.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Device not found")
+        
+        device, summary = _split_summary(rows[0])
+        if summary["recent_events"] is None:
+            # Summary missing or stale, rebuild it from the raw tables once
+            for sql, params in _summary_rebuild_statements(device_id):
+                cur.execute(sql, params)
+            cur.execute(query, (device_id, clerk_id))
+            device, summary = _split_summary(cur.fetchall()[0])
     
     # Combine all data
+    recent_events = summary["recent_events"] or []
     return {
-        "device": device[0] if device else None,
-        "latest_event": latest_event[0] if latest_event else None,
-        "latest_image": latest_image[0] if latest_image else None,
-        "notification_count": notification_count[0]["count"] if notification_count else 0,
+        "device": device,
+        "latest_event": recent_events[0] if recent_events else None,
+        "latest_image": _summary_latest_image(device_id, summary),
+        "notification_count": summary["notification_count"] or 0,
     }
 
+@app.get("/devices/{device_id}/event-counts", response_model=List[Dict[str, Any]])
+def get_event_counts(device_id: int, resolution: str = "day", since: Optional[datetime] = None,
+                     until: Optional[datetime] = None):
+    """Event counts per hour or day and event type, read from the rollup tables"""
+    if resolution not in ("hour", "day"):
+        raise HTTPException(status_code=400, detail="resolution must be 'hour' or 'day'")
+    table = "event_rollups_hourly" if resolution == "hour" else "event_rollups_daily"
+    
+    clauses = ["device_id=%s"]
+    params: List[Any] = [device_id]
+    if since:
+        clauses.append("bucket >= %s")
+        params.append(since if resolution == "hour" else since.date())
+    if until:
+        clauses.append("bucket < %s")
+        params.append(until if resolution == "hour" else until.date())
+    return _select(
+        f"SELECT bucket, event_type, event_count FROM {table} "
+        f"WHERE {' AND '.join(clauses)} ORDER BY bucket",
+        tuple(params),
+    )
+
 @app.post("/iot/report", response_model=Dict[str, str])
-def iot_report_status(request: Request):
+async def iot_report_status(request: Request, response: Response):
     """
     Simplified endpoint for IoT devices to report status with minimal payload.
     This reduces battery usage and bandwidth for IoT devices.
@@ -825,146 +2922,127 @@ def iot_report_status(request: Request):
         # Convert abbreviated parameters to proper format
         device_id = int(device_id)
         event_type = "open" if event == "o" else "close" if event == "c" else event
+        if event_type not in EVENT_TYPES:
+            raise HTTPException(status_code=400, detail="Unknown event type")
         
-        # Insert event
-        _insert(
-            "INSERT INTO mailbox_events(device_id,event_type,occurred_at) VALUES (%s,%s,NOW())",
-            (device_id, event_type),
-        )
-        
-        # Update device last_seen
-        _insert(
-            "UPDATE devices SET last_seen=NOW() WHERE id=%s",
-            (device_id,),
-        )
+        # Insert event and bump the device's last_seen
+        ids = await _record_events([(device_id, event_type, datetime.utcnow())], response, touch_device=True)
         
-        return {"status": "ok"}
+        return {"status": "ok" if ids else "queued"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in IoT report: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/dashboard/{clerk_id}", response_model=Dict[str, Any])
-def get_user_dashboard(clerk_id: str, response: Response):
+async def get_user_dashboard(clerk_id: str, request: Request, response: Response):
     """
     Comprehensive dashboard endpoint that combines multiple data sources
     into a single API call for frontend efficiency.
     Uses caching to improve performance for repeated requests.
     """
-    # Check if we have a valid cached response
-    cache_key = f"dashboard_{clerk_id}"
-    cached_data = dashboard_cache.get(cache_key)
-    
-    if cached_data:
-        # Check if the cache is still valid
-        if datetime.utcnow() < cached_data['expires_at']:
-            logger.info(f"Cache hit for dashboard {clerk_id}")
-            # Add cache-related headers
-            response.headers["X-Cache"] = "HIT"
-            response.headers["X-Cache-Expires"] = cached_data['expires_at'].isoformat()
-            return cached_data['data']
-        else:
-            # Cache expired
-            logger.info(f"Cache expired for dashboard {clerk_id}")
-            dashboard_cache.pop(cache_key, None)
-    
-    # Cache miss or expired, generate fresh data
-    response.headers["X-Cache"] = "MISS"
-    
-    # Get all user devices
-    devices = _select(
-        "SELECT * FROM devices WHERE clerk_id=%s ORDER BY last_seen DESC",
-        (clerk_id,),
+    entry, status = await dashboard_cache.get_or_load(
+        f"dashboard_{clerk_id}", lambda: _build_dashboard(clerk_id)
     )
+    if status == "HIT":
+        logger.info(f"Cache hit for dashboard {clerk_id}")
+    
+    # Add cache-related headers; clients revalidate with If-None-Match or If-Modified-Since
+    last_modified = entry['data'].get("last_modified")
+    headers = {
+        "X-Cache": status,
+        "X-Cache-Expires": entry['expires_at'].isoformat(),
+        "ETag": _cached_etag(entry),
+        "Cache-Control": "private, no-cache",
+    }
+    if last_modified:
+        headers["Last-Modified"] = _http_date(last_modified)
+    if _not_modified(request, headers["ETag"], last_modified):
+        return _not_modified_response(headers)
+    response.headers.update(headers)
+    return entry['data']
+
+async def _build_dashboard(clerk_id: str) -> Dict[str, Any]:
+    # Get all user devices together with their precomputed summaries
+    query = f"""
+        SELECT d.*, {SUMMARY_COLUMNS}
+        FROM devices d LEFT JOIN device_summary s ON s.device_id = d.id
+        WHERE d.clerk_id=%s ORDER BY d.last_seen DESC
+    """
+    rows = await _aselect(query, (clerk_id,))
     
-    if not devices:
-        result = {
+    if not rows:
+        return {
             "devices": [],
             "recent_events": [],
             "recent_images": [],
-            "notification_count": 0
+            "notification_count": 0,
+            "last_modified": None,
         }
-        # Cache the empty result too
-        dashboard_cache[cache_key] = {
-            'data': result,
-            'expires_at': datetime.utcnow() + timedelta(seconds=CACHE_TTL_SECONDS)
-        }
-        return result
-    
-    # Get device IDs
-    device_ids = [d["id"] for d in devices]
-    device_ids_str = ','.join(['%s'] * len(device_ids))
-    
-    # Get recent events (last 5 per device)
-    recent_events_query = f"""
-        SELECT e.* FROM (
-            SELECT *, ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY occurred_at DESC) as rn
-            FROM mailbox_events
-            WHERE device_id IN ({device_ids_str})
-        ) e WHERE e.rn <= 5
-        ORDER BY occurred_at DESC
-    """
-    recent_events = _select(recent_events_query, tuple(device_ids))
     
-    # Get recent images (last image per device)
-    recent_images_query = f"""
-        SELECT i.* FROM (
-            SELECT *, ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY captured_at DESC) as rn
-            FROM images
-            WHERE device_id IN ({device_ids_str})
-        ) i WHERE i.rn = 1
-    """
-    recent_images = _select(recent_images_query, tuple(device_ids))
+    stale = [r["id"] for r in rows if r["summary_recent_events"] is None]
+    if stale:
+        # Devices without a usable summary yet, rebuild them once from the raw tables
+        async with _atransaction() as cur:
+            for device_id in stale:
+                for sql, params in _summary_rebuild_statements(device_id):
+                    await cur.execute(sql, params)
+        rows = await _aselect(query, (clerk_id,))
     
-    # Get notification counts
-    notification_count = _select(
-        f"SELECT COUNT(*) as count FROM notifications WHERE device_id IN ({device_ids_str})",
-        tuple(device_ids),
-    )
+    devices = []
+    recent_events = []
+    recent_images = []
+    notification_count = 0
+    # Every change to the dashboard bumps its device's or summary's updated_at
+    last_modified = None
+    for row in rows:
+        device, summary = _split_summary(row)
+        devices.append(device)
+        for ts in (device.get("updated_at"), summary.get("updated_at")):
+            if ts and (last_modified is None or ts > last_modified):
+                last_modified = ts
+        # Last 5 events and last image per device
+        recent_events.extend(summary["recent_events"] or [])
+        latest_image = _summary_latest_image(device["id"], summary)
+        if latest_image:
+            recent_images.append(latest_image)
+        notification_count += summary["notification_count"] or 0
+    recent_events.sort(key=lambda e: e["occurred_at"], reverse=True)
     
-    result = {
+    logger.info(f"Generated fresh dashboard data for {clerk_id}")
+    return {
         "devices": devices,
         "recent_events": recent_events,
         "recent_images": recent_images,
-        "notification_count": notification_count[0]["count"] if notification_count else 0
+        "notification_count": notification_count,
+        "last_modified": last_modified,
     }
-    
-    # Store in cache with expiration time
-    expiry_time = datetime.utcnow() + timedelta(seconds=CACHE_TTL_SECONDS)
-    dashboard_cache[cache_key] = {
-        'data': result,
-        'expires_at': expiry_time
-    }
-    
-    # Add expiry info to response headers
-    response.headers["X-Cache-Expires"] = expiry_time.isoformat()
-    
-    logger.info(f"Generated fresh dashboard data for {clerk_id}")
-    return result
 
 @app.get("/devices/{device_id}/settings", response_model=Dict[str, Any])
-def get_device_settings(device_id: int, clerk_id: str, response: Response):
+async def get_device_settings(device_id: int, clerk_id: str, request: Request, response: Response):
     """Get notification and device settings for a specific device"""
-    # Check if we have a valid cached response
-    cache_key = f"settings_{device_id}_{clerk_id}"
-    cached_data = settings_cache.get(cache_key)
-    
-    if cached_data:
-        # Check if the cache is still valid
-        if datetime.utcnow() < cached_data['expires_at']:
-            logger.info(f"Cache hit for device settings {device_id}")
-            # Add cache-related headers
-            response.headers["X-Cache"] = "HIT"
-            response.headers["X-Cache-Expires"] = cached_data['expires_at'].isoformat()
-            return cached_data['data']
-        else:
-            # Cache expired
-            logger.info(f"Cache expired for device settings {device_id}")
-            settings_cache.pop(cache_key, None)
-    
-    # Cache miss or expired, generate fresh data
-    response.headers["X-Cache"] = "MISS"
+    entry, status = await settings_cache.get_or_load(
+        f"settings_{device_id}_{clerk_id}", lambda: _load_device_settings(device_id, clerk_id)
+    )
+    if status == "HIT":
+        logger.info(f"Cache hit for device settings {device_id}")
     
-    results = _select(
+    # Add cache-related headers; the settings live on the devices row, so its updated_at dates them
+    headers = {
+        "X-Cache": status,
+        "X-Cache-Expires": entry['expires_at'].isoformat(),
+        "ETag": _cached_etag(entry),
+        "Last-Modified": _http_date(entry['data']["updated_at"]),
+        "Cache-Control": "private, no-cache",
+    }
+    if _not_modified(request, headers["ETag"], entry['data']["updated_at"]):
+        return _not_modified_response(headers)
+    response.headers.update(headers)
+    return entry['data']
+
+async def _load_device_settings(device_id: int, clerk_id: str) -> Dict[str, Any]:
+    results = await _aselect(
         """
         SELECT 
             mail_delivered_notify,
@@ -976,7 +3054,8 @@ def get_device_settings(device_id: int, clerk_id: str, response: Response):
             check_interval,
             battery_threshold,
             capture_image_on_open,
-            capture_image_on_delivery
+            capture_image_on_delivery,
+            updated_at
         FROM devices 
         WHERE id=%s AND clerk_id=%s
         """,
@@ -985,21 +3064,11 @@ def get_device_settings(device_id: int, clerk_id: str, response: Response):
     if not results:
         raise HTTPException(status_code=404, detail="Device not found")
     
-    # Store in cache with expiration time
-    expiry_time = datetime.utcnow() + timedelta(seconds=CACHE_TTL_SECONDS)
-    settings_cache[cache_key] = {
-        'data': results[0],
-        'expires_at': expiry_time
-    }
-    
-    # Add expiry info to response headers
-    response.headers["X-Cache-Expires"] = expiry_time.isoformat()
     logger.info(f"Generated fresh settings data for device {device_id}")
-    
     return results[0]
 
 @app.put("/devices/{device_id}/settings", response_model=Dict[str, str])
-def update_device_settings(device_id: int, p: DeviceSettingsPayload):
+async def update_device_settings(device_id: int, p: DeviceSettingsPayload):
     """Update device settings without changing other device properties"""
     # Build the update query dynamically based on what was provided
     set_parts = []
@@ -1054,7 +3123,7 @@ def update_device_settings(device_id: int, p: DeviceSettingsPayload):
     
     # Build and execute the query
     query = f"UPDATE devices SET {', '.join(set_parts)} WHERE id=%s AND clerk_id=%s"
-    _insert(query, tuple(params))
+    await _ainsert(query, tuple(params))
     
     # Invalidate relevant caches to ensure data consistency
     invalidate_caches(device_id=device_id, clerk_id=p.clerk_id)
@@ -1063,143 +3132,781 @@ def update_device_settings(device_id: int, p: DeviceSettingsPayload):
 
 @app.get("/device/lookup", response_model=Dict[str, Any])
 def lookup_device_by_serial(serial_id: str):
-    """Lookup device by Series ID and return device_id and clerk_id"""
-    try:
-        # Search for the device with this serial ID in the devices table
-        # Assuming serial_id is stored in the 'name' field for now
-        # You might want to add a dedicated serial_id column to the devices table
-        results = _select(
-            "SELECT id, clerk_id FROM devices WHERE name LIKE %s",
-            (f"%{serial_id}%",),
-        )
+    """Lookup device by serial number and return device_id and clerk_id"""
+    entry = device_lookup_cache.get(serial_id)
+    if entry is None:
+        try:
+            results = _select(
+                "SELECT id, clerk_id FROM devices WHERE serial_number=%s",
+                (serial_id,),
+            )
+        except Exception as e:
+            logger.error(f"Error looking up device by serial ID: {e}")
+            raise HTTPException(status_code=500, detail=f"Database error: {e}")
         
+        # Misses aren't cached, a device can be registered right before it boots
         if not results:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        # Return the first matching device
-        return {
+        entry = device_lookup_cache.set(serial_id, {
             "device_id": results[0]["id"],
             "clerk_id": results[0]["clerk_id"]
-        }
-    except Exception as e:
-        logger.error(f"Error looking up device by serial ID: {e}")
-        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+        })
+    return entry["data"]
 
 handler = Mangum(app)
 
 def process_notification(event, context):
-    # Process SNS notification events and send emails
-    # Initialize boto3 clients if needed
-    global s3_client
-    if s3_client is None:
-        s3_client = boto3.client("s3")
-        
+    """Process SNS notification events and send emails.
+
+    Records are coalesced first, then all emails for the invocation go out concurrently.
+    Returns a per-record report; records that still failed after retries are listed there.
+    """
     # Initialize the database pool if needed
     if POOL is None:
         init_pool()
         
+    records = []
+    report = {"sent": 0, "held": 0, "failed": []}
     for record in event.get("Records", []):
+        message_id = record.get("Sns", {}).get("MessageId")
         try:
             payload = json.loads(record["Sns"]["Message"])
-            device_id = payload.get("device_id")
-            notification_type = payload.get("notification_type")
-            
-            # Fetch user's email from devices table
-            rows = _select(
-                "SELECT email FROM devices WHERE id = %s",
-                (device_id,),
-            )
-            to_addresses = [r["email"] for r in rows if r.get("email")]
-            
-            if to_addresses:
-                # Get the MailerSend credentials
-                api_key = os.getenv("mail_api")
-                from_email = os.getenv("mail_username")
-                from_name = os.getenv("mail_from_name", "Mail Guard")
-                
-                # Log API key information (partial, for debugging)
-                logger.info(f"Using MailerSend API key: {api_key[:5]}...{api_key[-4:]}")
-                
-                # Initialize the mailer client
-                try:
-                    mailer = emails.NewEmail(api_key)
-                    mail_body = {}
-                    
-                    # Set sender
-                    mailer.set_mail_from({
-                        "email": from_email,
-                        "name": from_name
-                    }, mail_body)
-                    
-                    # Set recipients
-                    recipients = [{"email": addr} for addr in to_addresses]
-                    mailer.set_mail_to(recipients, mail_body)
-                    
-                    # Set subject and content with better formatting
-                    timestamp = datetime.utcnow()
-                    formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                    subject = f"📬 Mailbox Alert: {notification_type}"
-                    
-                    # Create HTML content with better formatting
-                    html_content = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6;">
-                        <h2 style="color: #3366cc;">Mailbox Notification</h2>
-                        <p>Your mailbox (ID: {device_id}) has detected an event:</p>
-                        <div style="background-color: #f5f5f5; padding: 15px; border-left: 4px solid #3366cc; margin: 10px 0;">
-                            <strong>Event Type:</strong> {notification_type}<br/>
-                            <strong>Time:</strong> {formatted_time}<br/>
-                        </div>
-                        <p>Check your Mail Guard app for more details.</p>
-                    </body>
-                    </html>
-                    """
-                    
-                    # Plain text version
-                    text_content = f"""
-                    Mailbox Notification
-                    
-                    Your mailbox (ID: {device_id}) has detected an event:
-                    Event Type: {notification_type}
-                    Time: {formatted_time}
-                    
-                    Check your Mail Guard app for more details.
-                    """
-                    
-                    mailer.set_subject(subject, mail_body)
-                    mailer.set_html_content(html_content, mail_body)
-                    mailer.set_plaintext_content(text_content, mail_body)
-                    
-                    # Send the email
-                    response = mailer.send(mail_body)
-                    logger.info(f"Email sent to {len(to_addresses)} recipients for device {device_id}. Response: {response}")
-                except Exception as email_error:
-                    logger.error(f"Error sending email: {email_error}")
-                    # Continue to next record
-                    continue
+            records.append((message_id, int(payload["device_id"]), payload.get("notification_type")))
         except Exception as e:
             logger.error(f"Error processing notification: {e}")
             # Continue processing other records even if one fails
+            report["failed"].append({"message_id": message_id, "error": str(e)})
             continue
+    
+    try:
+        jobs, report["held"], unknown = _coalesce_notifications(records)
+    except Exception as e:
+        logger.error(f"Error coalescing notifications: {e}")
+        jobs, unknown = [], {m: (d, str(e)) for m, d, _ in records}
+    report["failed"].extend({"message_id": m, "device_id": d, "error": error} for m, (d, error) in unknown.items())
+    
+    dispatched = _send_notification_emails(jobs)
+    report["sent"] = dispatched["sent"]
+    report["failed"].extend(dispatched["failed"])
+    if report["failed"]:
+        logger.error(f"{len(report['failed'])} notification(s) failed: {report['failed']}")
+    return report
+
+def _coalesce_notifications(records: List[Tuple[Any, int, str]]
+                            ) -> Tuple[List[Tuple[Any, int, Dict[str, int]]], int, Dict[Any, Tuple[int, str]]]:
+    """Record (message id, device_id, notification_type) records against their devices'
+    dispatch windows.
+
+    Returns the email jobs to send now (at most one per device), how many records were held
+    for a later digest, and the records of unknown devices by message id. Each device's notification_dispatch row is read and written
+    once, all in a single transaction, however many records the batch holds.
+    """
+    if NOTIFY_COALESCE_SECONDS <= 0:
+        return [(message_id, device_id, {notification_type: 1})
+                for message_id, device_id, notification_type in records], 0, {}
+    by_device: Dict[int, List[Tuple[Any, str]]] = {}
+    for message_id, device_id, notification_type in records:
+        by_device.setdefault(device_id, []).append((message_id, notification_type))
+    if not by_device:
+        return [], 0, {}
+
+    now = datetime.utcnow()
+    window = timedelta(seconds=NOTIFY_COALESCE_SECONDS)
+    device_ids = sorted(by_device)  # Lock rows in a fixed order
+    placeholders = ','.join(['%s'] * len(device_ids))
+    jobs, held, unknown = [], 0, {}
+    with _transaction() as cur:
+        cur.executemany("INSERT IGNORE INTO notification_dispatch (device_id) VALUES (%s)",
+                        [(device_id,) for device_id in device_ids])
+        cur.execute(
+            f"SELECT device_id, last_sent_at, pending_since, pending FROM notification_dispatch "
+            f"WHERE device_id IN ({placeholders}) FOR UPDATE",
+            tuple(device_ids),
+        )
+        states = {r["device_id"]: r for r in cur.fetchall()}
+        sent, pending_updates = [], []
+        for device_id in device_ids:
+            state = states.get(device_id)
+            if state is None:
+                # INSERT IGNORE skipped it: the device doesn't exist
+                for message_id, _ in by_device[device_id]:
+                    unknown[message_id] = (device_id, f"Device {device_id} not found")
+                continue
+            pending = json.loads(state["pending"]) if state["pending"] else {}
+            for _, notification_type in by_device[device_id]:
+                pending[notification_type] = pending.get(notification_type, 0) + 1
+            last_sent_at = state["last_sent_at"]
+            if not NOTIFY_DIGEST and (last_sent_at is None or now - last_sent_at >= window):
+                # The window is open: this batch's records for the device go out as one email
+                sent.append((now, device_id))
+                job_id = ",".join(str(message_id) for message_id, _ in by_device[device_id])
+                jobs.append((job_id, device_id, pending))
+            else:
+                pending_updates.append((state["pending_since"] or now, json.dumps(pending), device_id))
+                held += len(by_device[device_id])
+                logger.info(f"Holding {len(by_device[device_id])} notification(s) for device {device_id} until its window closes")
+        if sent:
+            cur.executemany(
+                "UPDATE notification_dispatch SET last_sent_at=%s, pending_since=NULL, pending=NULL WHERE device_id=%s",
+                sent,
+            )
+        if pending_updates:
+            cur.executemany(
+                "UPDATE notification_dispatch SET pending_since=%s, pending=%s WHERE device_id=%s",
+                pending_updates,
+            )
+    return jobs, held, unknown
+
+def flush_notification_digests() -> Dict[str, int]:
+    """Send the held notifications of every device whose window has closed"""
+    report = {"devices": 0, "notifications": 0}
+    if NOTIFY_COALESCE_SECONDS <= 0:
+        return report
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=NOTIFY_COALESCE_SECONDS)
+    # Digest windows run from the first held event, coalesce windows from the last email
+    opened_at = "pending_since" if NOTIFY_DIGEST else "COALESCE(last_sent_at, pending_since)"
+    due = _select(
+        f"SELECT device_id FROM notification_dispatch WHERE pending_since IS NOT NULL AND {opened_at} <= %s",
+        (cutoff,),
+    )
+    jobs = []
+    for row in due:
+        with _transaction() as cur:
+            cur.execute(
+                f"SELECT pending FROM notification_dispatch WHERE device_id=%s "
+                f"AND pending_since IS NOT NULL AND {opened_at} <= %s FOR UPDATE",
+                (row["device_id"], cutoff),
+            )
+            state = cur.fetchone()
+            if not state:
+                continue  # Already flushed by a concurrent run or a newer notification
+            cur.execute(
+                "UPDATE notification_dispatch SET last_sent_at=%s, pending_since=NULL, pending=NULL WHERE device_id=%s",
+                (now, row["device_id"]),
+            )
+        counts = json.loads(state["pending"]) if state["pending"] else {}
+        if counts:
+            jobs.append((f"digest-{row['device_id']}", row["device_id"], counts))
+            report["notifications"] += sum(counts.values())
+    dispatched = _send_notification_emails(jobs)
+    report["devices"] = dispatched["sent"]
+    report["failed"] = len(dispatched["failed"])
+    return report
+
+def _mailer() -> Tuple[Any, Any]:
+    """Return the shared MailerSend client and requests session, creating them on first use"""
+    global mail_client, mail_session
+    if mail_client is None:
+        from mailersend import emails
+        api_key = os.getenv("mail_api")
+        # Log API key information (partial, for debugging)
+        logger.info(f"Using MailerSend API key: {api_key[:5]}...{api_key[-4:]}")
+        mail_client = emails.NewEmail(api_key)
+    if mail_session is None:
+        import requests
+        mail_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=EMAIL_MAX_CONCURRENCY)
+        mail_session.mount("https://", adapter)
+    return mail_client, mail_session
+
+def _notification_email(device_id: int, counts: Dict[str, int], to_addresses: List[str]) -> Dict[str, Any]:
+    """Build the MailerSend message for one notification, or a digest when counts hold several"""
+    mailer, _ = _mailer()
+    from_email = os.getenv("mail_username")
+    from_name = os.getenv("mail_from_name", "Mail Guard")
+    mail_body = {}
+    
+    # Set sender
+    mailer.set_mail_from({
+        "email": from_email,
+        "name": from_name
+    }, mail_body)
+    
+    # Set recipients
+    recipients = [{"email": addr} for addr in to_addresses]
+    mailer.set_mail_to(recipients, mail_body)
+    
+    # Set subject and content with better formatting
+    timestamp = datetime.utcnow()
+    formatted_time = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    total = sum(counts.values())
+    if total == 1:
+        notification_type = next(iter(counts))
+        subject = f"📬 Mailbox Alert: {notification_type}"
+        intro = "has detected an event"
+        html_events = f"<strong>Event Type:</strong> {notification_type}<br/>"
+        text_events = f"Event Type: {notification_type}"
+    else:
+        subject = f"📬 Mailbox Alert: {total} events"
+        intro = f"has detected {total} events"
+        html_events = "".join(f"<strong>{t}:</strong> {n}<br/>" for t, n in counts.items())
+        text_events = "\n    ".join(f"{t}: {n}" for t, n in counts.items())
+    
+    # Create HTML content with better formatting
+    html_content = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; line-height: 1.6;">
+        <h2 style="color: #3366cc;">Mailbox Notification</h2>
+        <p>Your mailbox (ID: {device_id}) {intro}:</p>
+        <div style="background-color: #f5f5f5; padding: 15px; border-left: 4px solid #3366cc; margin: 10px 0;">
+            {html_events}
+            <strong>Time:</strong> {formatted_time}<br/>
+        </div>
+        <p>Check your Mail Guard app for more details.</p>
+    </body>
+    </html>
+    """
+    
+    # Plain text version
+    text_content = f"""
+    Mailbox Notification
+    
+    Your mailbox (ID: {device_id}) {intro}:
+    {text_events}
+    Time: {formatted_time}
+    
+    Check your Mail Guard app for more details.
+    """
+    
+    mailer.set_subject(subject, mail_body)
+    mailer.set_html_content(html_content, mail_body)
+    mailer.set_plaintext_content(text_content, mail_body)
+    return mail_body
+
+def _post_email(mail_body: Dict[str, Any]) -> str:
+    """Send one message, retrying 429, 5xx and network errors with exponential backoff and jitter"""
+    import requests
+
+    mailer, session = _mailer()
+    for attempt in range(1, EMAIL_MAX_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            response = session.post(
+                f"{mailer.api_base}/email",
+                headers=mailer.headers_default,
+                json=mail_body,
+                timeout=EMAIL_TIMEOUT_SECONDS,
+            )
+            if response.status_code < 300:
+                return f"{response.status_code}"
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            if response.status_code != 429 and response.status_code < 500:
+                raise RuntimeError(error)  # Rejected message, retrying won't help
+            retry_after = response.headers.get("Retry-After")
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt == EMAIL_MAX_ATTEMPTS:
+            raise RuntimeError(f"Giving up after {attempt} attempts: {error}")
+        delay = EMAIL_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        delay = min(EMAIL_BACKOFF_MAX_SECONDS, delay) * random.uniform(0.8, 1.2)
+        logger.warning(f"Email send attempt {attempt} failed ({error}), retrying in {delay:.2f}s")
+        time.sleep(delay)
+
+def _notification_recipients(device_ids: List[int]) -> Dict[int, List[str]]:
+    """Email addresses per device: cached ones first, the rest in a single IN (...) query"""
+    recipients: Dict[int, List[str]] = {}
+    missing = []
+    for device_id in dict.fromkeys(device_ids):
+        entry = recipient_cache.get(str(device_id))
+        if entry is None:
+            missing.append(device_id)
+        else:
+            recipients[device_id] = entry["data"]
+    if missing:
+        placeholders = ','.join(['%s'] * len(missing))
+        rows = _select(f"SELECT id, email FROM devices WHERE id IN ({placeholders})", tuple(missing))
+        found = {device_id: [] for device_id in missing}  # Unknown devices are cached as "no recipients"
+        for r in rows:
+            if r.get("email"):
+                found[r["id"]].append(r["email"])
+        for device_id, addresses in found.items():
+            recipient_cache.set(str(device_id), addresses)
+        recipients.update(found)
+    return recipients
+
+def _send_notification_emails(jobs: List[Tuple[Any, int, Dict[str, int]]]) -> Dict[str, Any]:
+    """Email each (job id, device_id, counts) concurrently. Returns the sent count and per-job failures."""
+    result = {"sent": 0, "failed": []}
+    if not jobs:
+        return result
+    futures = []
+    try:
+        recipients = _notification_recipients([device_id for _, device_id, _ in jobs])
+    except Exception as e:
+        logger.error(f"Error looking up notification recipients: {e}")
+        result["failed"] = [{"message_id": j, "device_id": d, "error": str(e)} for j, d, _ in jobs]
+        return result
+    for job_id, device_id, counts in jobs:
+        try:
+            to_addresses = recipients.get(device_id, [])
+            if not to_addresses:
+                continue
+            mail_body = _notification_email(device_id, counts, to_addresses)
+        except Exception as e:
+            logger.error(f"Error preparing email for device {device_id}: {e}")
+            result["failed"].append({"message_id": job_id, "device_id": device_id, "error": str(e)})
+            continue
+        futures.append((job_id, device_id, len(to_addresses), email_executor.submit(_post_email, mail_body)))
+    
+    for job_id, device_id, recipient_count, future in futures:
+        try:
+            response = future.result()
+            logger.info(f"Email sent to {recipient_count} recipients for device {device_id}. Response: {response}")
+            result["sent"] += 1
+        except Exception as e:
+            logger.error(f"Error sending email for device {device_id}: {e}")
+            result["failed"].append({"message_id": job_id, "device_id": device_id, "error": str(e)})
+    return result
+
+RETENTION_POLICIES = [
+    # (table, timestamp column, retention in days)
+    ("mailbox_events", "occurred_at", EVENT_RETENTION_DAYS),
+    ("notifications", "sent_at", NOTIFICATION_RETENTION_DAYS),
+    ("event_rollups_hourly", "bucket", ROLLUP_HOURLY_RETENTION_DAYS),
+    ("device_telemetry", "recorded_at", TELEMETRY_RETENTION_DAYS),
+    ("telemetry_rollups_hourly", "bucket", TELEMETRY_ROLLUP_RETENTION_DAYS),
+]
+
+# device_summary counters derived from a pruned table, recounted for the devices that lost rows
+RETENTION_SUMMARY_REFRESH_SQL = {
+    "notifications": SUMMARY_COUNT_NOTIFICATIONS_SQL,
+}
+
+# Tables meant to be range-partitioned by month. Deployments whose tables predate partitioning
+# convert them with `python main.py partition` (see partition_table); until then their
+# retention runs as chunked DELETEs and run_maintenance reports and logs that.
+# device_telemetry has been partitioned since it was introduced.
+PARTITIONED_TABLES = ("mailbox_events", "notifications")
+
+def _partition_names(cur, table: str) -> List[str]:
+    cur.execute(
+        """
+        SELECT PARTITION_NAME FROM INFORMATION_SCHEMA.PARTITIONS
+        WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND PARTITION_NAME IS NOT NULL
+        """,
+        (DB['database'], table),
+    )
+    return [r["PARTITION_NAME"] for r in cur.fetchall()]
+
+def partition_table(conn, table: str, column: str, retention_days: int) -> Dict[str, Any]:
+    """Convert an unpartitioned events or notifications table to monthly RANGE partitions.
+
+    A partitioned table can't have foreign keys and its primary key must include the
+    partitioning column, so the device_id foreign key is dropped (delete_device removes the
+    rows itself) and the primary key widened to (id, column), matching the layout of freshly
+    created tables. Rows past retention all land in the first partition, which the next
+    maintenance run drops. The ALTER copies the whole table and blocks writes to it meanwhile,
+    so this is an operator step for a quiet period, not part of the 5-minute maintenance job.
+    """
+    cur = _RetryingCursor(conn, dictionary=True)
+    if _partition_names(cur, table):
+        return {"partitioned": False, "reason": "already partitioned"}
+    cur.execute(
+        """
+        SELECT CONSTRAINT_NAME FROM INFORMATION_SCHEMA.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA=%s AND TABLE_NAME=%s
+        """,
+        (DB['database'], table),
+    )
+    foreign_keys = [r["CONSTRAINT_NAME"] for r in cur.fetchall()]
+    for name in foreign_keys:
+        logger.info(f"Dropping foreign key {name} on {table}")
+        cur.execute(f"ALTER TABLE {table} DROP FOREIGN KEY {name}")
+
+    cur.execute(f"SELECT MIN({column}) AS oldest FROM {table}")
+    oldest = cur.fetchone()["oldest"]
+    first_month = oldest.date() if oldest else None
+    if retention_days > 0:
+        cutoff_month = (datetime.utcnow() - timedelta(days=retention_days)).date()
+        first_month = max(first_month or cutoff_month, cutoff_month)
+    partitions = _initial_partitions(first_month)
+    logger.info(f"Partitioning {table} by month on {column}, this copies the table")
+    started = time.perf_counter()
+    cur.execute(
+        f"ALTER TABLE {table} MODIFY {column} DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        f"DROP PRIMARY KEY, ADD PRIMARY KEY (id, {column}) "
+        f"PARTITION BY RANGE (TO_DAYS({column})) ({partitions})"
+    )
+    return {
+        "partitioned": True,
+        "dropped_foreign_keys": foreign_keys,
+        "partitions": partitions.count("PARTITION "),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+def _maintain_table(conn, table: str, column: str, retention_days: int) -> Dict[str, Any]:
+    """Keep future monthly partitions ready and remove data older than the retention period.
 
-def invalidate_caches(device_id=None, clerk_id=None):
+    Partitioned tables lose whole months with DROP PARTITION. Tables created before
+    partitioning was introduced fall back to small chunked DELETEs. Summary counters fed by
+    the table are recounted afterwards for the devices that lost rows.
+    """
+    result: Dict[str, Any] = {"created": [], "dropped": [], "deleted_rows": 0}
+    cur = _RetryingCursor(conn, dictionary=True)
+    names = _partition_names(cur, table)
+    months = sorted(name for name in names if name != "pmax")
+    partitioned = bool(names)
+    if table in PARTITIONED_TABLES:
+        result["retention"] = "drop_partition" if partitioned else "delete"
+        if not partitioned:
+            logger.warning(f"{table} is not partitioned, retention falls back to chunked DELETEs; "
+                           f"convert it with `python main.py partition {table}`")
+
+    if partitioned:
+        this_month = _month_start(datetime.utcnow().date())
+        last = datetime.strptime(months[-1][1:], "%Y%m").date() if months else _month_start(this_month, -1)
+        for i in range(PARTITION_MONTHS_AHEAD + 1):
+            month = _month_start(this_month, i)
+            if month <= last:
+                continue
+            cur.execute(
+                f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO "
+                f"({_partition_definition(month)}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+            )
+            result["created"].append(f"p{month:%Y%m}")
+
+    if retention_days <= 0:
+        return result
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    affected: List[int] = []
+    if partitioned:
+        # A monthly partition can go once everything it may hold is older than the cutoff
+        expired = [
+            name for name in months
+            if _month_start(datetime.strptime(name[1:], "%Y%m").date(), 1) <= cutoff.date()
+        ]
+        if expired:
+            boundary = _month_start(datetime.strptime(expired[-1][1:], "%Y%m").date(), 1)
+            affected = _summary_devices_before(cur, table, column, boundary)
+            cur.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+            result["dropped"] = expired
+    else:
+        affected = _summary_devices_before(cur, table, column, cutoff)
+        while True:
+            cur.execute(
+                f"DELETE FROM {table} WHERE {column} < %s LIMIT {RETENTION_DELETE_CHUNK}",
+                (cutoff,),
+            )
+            deleted = cur.rowcount
+            conn.commit()
+            result["deleted_rows"] += deleted
+            if deleted < RETENTION_DELETE_CHUNK:
+                break
+
+    if affected:
+        cur.executemany(RETENTION_SUMMARY_REFRESH_SQL[table], [(d, d) for d in affected])
+        conn.commit()
+        result["summaries_refreshed"] = len(affected)
+    return result
+
+def _summary_devices_before(cur, table: str, column: str, before) -> List[int]:
+    """Devices whose device_summary counts include rows of `table` older than `before`"""
+    if table not in RETENTION_SUMMARY_REFRESH_SQL:
+        return []
+    cur.execute(
+        f"SELECT DISTINCT t.device_id FROM {table} t JOIN devices d ON d.id = t.device_id "
+        f"WHERE t.{column} < %s",
+        (before,),
+    )
+    return [r["device_id"] for r in cur.fetchall()]
+
+def run_migrations(event, context):
+    """Deploy-time job: apply pending schema migrations before the API functions update.
+
+    Runs with a 5 minute timeout, so a long ALTER doesn't hold up a request's cold start
+    (those functions use INIT_SCHEMA=check). Also reachable as run_maintenance's "migrate" job.
+    """
+    if POOL is None:
+        init_pool()
+    with _pool() as conn:
+        version = migrate_schema(conn)
+    return {"schema_version": version}
+
+def run_maintenance(event, context):
+    """Scheduled job: roll partitions forward and apply the retention policies"""
+    if (event or {}).get("job") == "image_gc":
+        return run_image_gc(event, context)
+    if (event or {}).get("job") == "migrate":
+        return run_migrations(event, context)
+    if POOL is None:
+        init_pool()
+    if (event or {}).get("job") == "explain":
+        report = explain_hot_queries()
+        logger.info(f"Hot query plans: {report}")
+        return report
+    if (event or {}).get("job") == "notification_digest":
+        report = flush_notification_digests()
+        logger.info(f"Notification digests sent: {report}")
+        return report
+    
+    report = {}
+    with _pool() as conn:
+        for table, column, retention_days in RETENTION_POLICIES:
+            try:
+                report[table] = _maintain_table(conn, table, column, retention_days)
+            except mysql.connector.Error as e:
+                logger.error(f"Maintenance of {table} failed: {e}")
+                report[table] = {"error": str(e)}
+    logger.info(f"Maintenance finished: {report}")
+    return report
+
+def _live_image_names(bucket: str, prefix: str) -> Optional[set]:
+    """Object names (key minus the device prefix) still referenced by a device's images rows.
+
+    None means the prefix isn't a device id and must be left alone.
+    """
+    if not prefix.isdigit():
+        return None
+    names = set()
+    for row in _select("SELECT image_url FROM images WHERE device_id=%s", (int(prefix),)):
+        location = _parse_s3_url(row["image_url"])
+        if location and location[0] == bucket:
+            names.add(location[1].partition("/")[2])
+    return names
+
+def _gc_state() -> Dict[str, Any]:
+    rows = _select("SELECT resume_after, last_completed_at FROM maintenance_state WHERE job='image_gc'", ())
+    return rows[0] if rows else {"resume_after": None, "last_completed_at": None}
+
+def _save_gc_state(resume_after: Optional[str]) -> None:
+    """Remember where an unfinished pass stopped, or (None) that the pass completed now"""
+    _insert(
+        """
+        INSERT INTO maintenance_state (job, resume_after, last_completed_at) VALUES ('image_gc', %s, %s)
+        ON DUPLICATE KEY UPDATE resume_after=VALUES(resume_after),
+                                last_completed_at=COALESCE(VALUES(last_completed_at), last_completed_at)
+        """,
+        (resume_after, None if resume_after else datetime.utcnow()),
+    )
+
+def run_image_gc(event, context):
+    """Scheduled job: reconcile the bucket with the images table and delete orphaned objects.
+
+    Keys are listed in order, so each device prefix is contiguous and its referenced
+    names are loaded once. Derivatives are kept while their original is referenced.
+    When the invocation is about to time out the run stops after the current page, and the
+    next one continues from there (stored in maintenance_state). A new pass only starts
+    IMAGE_GC_INTERVAL_DAYS after the last one completed, so the job can be scheduled daily.
+    Pass {"dry_run": true} to only report what would be deleted (progress isn't saved),
+    {"start_after": "<key>"} to start from a given key, or {"force": true} to start a
+    new pass early.
+    """
+    if POOL is None:
+        init_pool()
+    event = event or {}
+    dry_run = bool(event.get("dry_run"))
+    bucket = os.getenv("S3_BUCKET")
+    if not bucket:
+        logger.error("S3_BUCKET environment variable not set")
+        return {"error": "S3 bucket not configured"}
+
+    state = _gc_state()
+    start_after = event.get("start_after") or state["resume_after"]
+    if not start_after and not event.get("force") and state["last_completed_at"] and \
+            datetime.utcnow() - state["last_completed_at"] < timedelta(days=IMAGE_GC_INTERVAL_DAYS):
+        logger.info(f"Image GC pass completed at {state['last_completed_at']}, nothing to do yet")
+        return {"skipped": True, "last_completed_at": state["last_completed_at"].isoformat()}
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=IMAGE_GC_MIN_AGE_HOURS)
+    report = {"scanned": 0, "orphaned": 0, "deleted": 0, "dry_run": dry_run,
+              "started_after": start_after, "complete": True}
+    current_prefix, live, live_stems = None, None, set()
+    pending: List[str] = []
+
+    def flush():
+        if pending and not dry_run:
+            report["deleted"] += _delete_s3_keys(bucket, pending)
+        pending.clear()
+
+    def out_of_time() -> bool:
+        remaining = context.get_remaining_time_in_millis() if context else None
+        return remaining is not None and remaining < IMAGE_GC_TIME_MARGIN_SECONDS * 1000
+
+    pages = _s3().get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, **({"StartAfter": start_after} if start_after else {})
+    )
+    for page in pages:
+        for obj in page.get("Contents", []):
+            report["scanned"] += 1
+            last_key = obj["Key"]
+            if obj["LastModified"] > cutoff:
+                continue
+            prefix, _, name = obj["Key"].partition("/")
+            if prefix != current_prefix:
+                current_prefix = prefix
+                live = _live_image_names(bucket, prefix)
+                live_stems = {n.rsplit(".", 1)[0] for n in live or ()}
+            if live is None:
+                continue
+            if name.startswith("_derived/"):
+                # _derived/<size>/<stem>.<fmt>
+                if name.split("/", 2)[-1].rsplit(".", 1)[0] in live_stems:
+                    continue
+            elif name in live:
+                continue
+            report["orphaned"] += 1
+            pending.append(obj["Key"])
+            if len(pending) >= S3_DELETE_BATCH:
+                flush()
+        if page.get("IsTruncated") and out_of_time():
+            report["complete"] = False
+            report["resume_after"] = last_key
+            break
+    flush()
+    if not dry_run:
+        _save_gc_state(report.get("resume_after"))
+    if not report["complete"]:
+        logger.warning(f"Image GC stopped before the timeout, next run resumes after {report['resume_after']}")
+    logger.info(f"Image GC finished: {report}")
+    return report
+
+def invalidate_caches(device_id=None, clerk_id=None, serial_number=None):
     """Helper function to invalidate related caches when data changes"""
     invalidated = []
     
+    if serial_number:
+        if device_lookup_cache.pop(serial_number):
+            logger.info(f"Invalidating device lookup cache for serial {serial_number}")
+            invalidated.append(f"device_lookup_{serial_number}")
+    
     if device_id and clerk_id:
         # Invalidate device-specific settings
         settings_cache_key = f"settings_{device_id}_{clerk_id}"
-        if settings_cache.get(settings_cache_key):
+        if settings_cache.pop(settings_cache_key):
             logger.info(f"Invalidating settings cache for device {device_id}")
-            settings_cache.pop(settings_cache_key, None)
             invalidated.append(settings_cache_key)
     
     if clerk_id:
         # Invalidate user dashboard data
         dashboard_cache_key = f"dashboard_{clerk_id}"
-        if dashboard_cache.get(dashboard_cache_key):
+        if dashboard_cache.pop(dashboard_cache_key):
             logger.info(f"Invalidating dashboard cache for user {clerk_id}")
-            dashboard_cache.pop(dashboard_cache_key, None)
             invalidated.append(dashboard_cache_key)
     
-    return invalidated
\ No newline at end of file
+    return invalidated
+
+# Query shapes the API runs on every request, with sample parameters for EXPLAIN
+_SAMPLE_TS = datetime(2000, 1, 1)
+HOT_QUERIES: List[Tuple[str, str, tuple]] = [
+    ("list_devices", _page_sql("devices", "created_at", ["name=%s"]), ("sample", 51)),
+    ("list_devices next page", _page_sql("devices", "created_at", ["name=%s", _page_cursor_clause("created_at")]),
+     ("sample", _SAMPLE_TS, _SAMPLE_TS, 1, 51)),
+    ("list_events", _page_sql("mailbox_events", "occurred_at", ["device_id=%s"]), (1, 51)),
+    ("list_events next page", _page_sql("mailbox_events", "occurred_at", ["device_id=%s", _page_cursor_clause("occurred_at")]),
+     (1, _SAMPLE_TS, _SAMPLE_TS, 1, 51)),
+    ("list_notifications", _page_sql("notifications", "sent_at", ["device_id=%s"]), (1, 51)),
+    ("list_notifications next page", _page_sql("notifications", "sent_at", ["device_id=%s", _page_cursor_clause("sent_at")]),
+     (1, _SAMPLE_TS, _SAMPLE_TS, 1, 51)),
+    ("latest image", LATEST_IMAGE_SQL, (1,)),
+    ("image by content hash", IMAGE_BY_HASH_SQL, (1, "0" * 64)),
+    ("notification count", "SELECT COUNT(*) FROM notifications WHERE device_id=%s", (1,)),
+    ("device by serial", "SELECT id, clerk_id FROM devices WHERE serial_number=%s", ("sample",)),
+    ("devices by clerk", "SELECT id FROM devices WHERE clerk_id=%s", ("sample",)),
+    ("daily event counts", "SELECT bucket, event_type, event_count FROM event_rollups_daily "
+                           "WHERE device_id=%s AND bucket >= %s ORDER BY bucket", (1, _SAMPLE_TS.date())),
+    ("hourly telemetry", "SELECT bucket, battery_min FROM telemetry_rollups_hourly "
+                         "WHERE device_id=%s AND bucket >= %s ORDER BY bucket", (1, _SAMPLE_TS)),
+]
+
+def explain_hot_queries() -> List[Dict[str, Any]]:
+    """EXPLAIN every HOT_QUERIES entry and flag full table scans and filesorts.
+
+    Run it against a database with representative data: on near-empty tables the optimizer
+    may legitimately prefer a scan. tests/test_query_plans.py seeds such a database and fails
+    on any flagged access. Returns one row per table access with an 'ok' flag.
+    """
+    report = []
+    with _pool() as conn:
+        cur = _RetryingCursor(conn, dictionary=True)
+        for name, sql, params in HOT_QUERIES:
+            cur.execute(f"EXPLAIN {sql}", params)
+            for row in cur.fetchall():
+                issues = []
+                if row["type"] == "ALL":
+                    issues.append("full table scan")
+                if "filesort" in (row["Extra"] or ""):
+                    issues.append("filesort")
+                report.append({
+                    "query": name,
+                    "table": row["table"],
+                    "type": row["type"],
+                    "key": row["key"],
+                    "issues": issues,
+                    "ok": not issues,
+                })
+    return report
+
+def _preload_clients():
+    """STARTUP_MODE=eager: pay for the heavy imports and client setup during init"""
+    _s3()
+    _sns()
+    _upload_transfer_config()
+    import mailersend.emails, requests  # noqa: F401
+
+if STARTUP_MODE == "eager":
+    _preload_clients()
+
+logger.info(f"main imported in {(time.perf_counter() - _IMPORT_STARTED) * 1000:.0f} ms (STARTUP_MODE={STARTUP_MODE})")
+
+def import_report(top: int = 20) -> List[Tuple[str, float]]:
+    """Import a fresh copy of this module under `python -X importtime` and total the self
+    time per top-level package. Returns (package, milliseconds), slowest first."""
+    import subprocess
+    import sys
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    totals: Dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0.0) + int(self_us) / 1000
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+def _print_explain_report() -> int:
+    init_pool()
+    report = explain_hot_queries()
+    print(f"{'query':<32}{'table':<18}{'type':<8}{'key':<34}issues")
+    for row in report:
+        print(f"{row['query']:<32}{row['table'] or '':<18}{row['type'] or '':<8}{row['key'] or '-':<34}"
+              f"{', '.join(row['issues']) or 'ok'}")
+    return 0 if all(row["ok"] for row in report) else 1
+
+def _partition_tables(tables: List[str]) -> int:
+    init_pool()
+    policies = {table: (column, days) for table, column, days in RETENTION_POLICIES if table in PARTITIONED_TABLES}
+    for table in tables or list(policies):
+        if table not in policies:
+            print(f"{table}: not a partitioned table, expected one of {', '.join(policies)}")
+            return 1
+        with _pool() as conn:
+            print(f"{table}: {partition_table(conn, table, *policies[table])}")
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    # python main.py explain    -> EXPLAIN the hot queries; exits 1 on a full scan or filesort
+    if sys.argv[1:] == ["explain"]:
+        sys.exit(_print_explain_report())
+    # python main.py partition [table ...] -> move tables created before partitioning to
+    # monthly partitions (copies each table; run it in a quiet period, not from Lambda)
+    if sys.argv[1:2] == ["partition"]:
+        sys.exit(_partition_tables(sys.argv[2:]))
+    # python main.py            -> import time per package for the current STARTUP_MODE
+    report = import_report()
+    total = sum(ms for _, ms in report)
+    print(f"{'package':<28}{'ms':>10}{'share':>9}   (STARTUP_MODE={STARTUP_MODE})")
+    for package, ms in report:
+        print(f"{package:<28}{ms:>10.1f}{ms / total:>9.1%}")
+    print(f"{'total (top packages)':<28}{total:>10.1f}")
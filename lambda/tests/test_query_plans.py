@@ -0,0 +1,109 @@
+"""EXPLAIN regression check for the hot queries (main.HOT_QUERIES).
+
+Needs a MySQL server to talk to: the MYSQL_HOST/PORT/USER/PASSWORD settings (environment or
+lambda/.env) are used, but always with the throwaway database MYSQL_TEST_DATABASE (default
+mailguard_plan_test), which is dropped and recreated on every run. Without a reachable server
+the module is skipped.
+
+    cd lambda && MYSQL_HOST=127.0.0.1 MYSQL_PORT=3306 MYSQL_USER=root MYSQL_PASSWORD=... python -m pytest tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mysql.connector  # noqa: E402
+
+import main  # noqa: E402
+
+# main.py loads lambda/.env with override=True, so the test database is forced afterwards
+TEST_DATABASE = os.getenv("MYSQL_TEST_DATABASE") or "mailguard_plan_test"
+main.DB["database"] = TEST_DATABASE
+
+# Enough rows per table that the optimizer picks plans the way it does in production
+DEVICES = 300
+EVENTS_PER_DEVICE = 60
+IMAGES_PER_DEVICE = 10
+NOTIFICATIONS_PER_DEVICE = 20
+TELEMETRY_HOURS = 48
+
+def _connect_server():
+    params = {k: v for k, v in main.DB.items() if k != "database"}
+    return mysql.connector.connect(connection_timeout=5, **params)
+
+def _seed(cur) -> None:
+    now = datetime.utcnow().replace(microsecond=0)
+    cur.executemany(
+        "INSERT INTO devices (clerk_id, email, name, serial_number, created_at) VALUES (%s,%s,%s,%s,%s)",
+        [
+            # A handful of devices share the name the sample queries filter on
+            (f"clerk_{i}", f"user{i}@example.com", "sample" if i <= 5 else f"Mailbox {i % 50}",
+             f"SN{i:06d}", now - timedelta(days=i % 90))
+            for i in range(1, DEVICES + 1)
+        ],
+    )
+    cur.executemany(
+        "INSERT INTO mailbox_events (device_id, event_type, occurred_at) VALUES (%s,%s,%s)",
+        [
+            (d, "open" if n % 2 else "close", now - timedelta(hours=n * 36 + d % 24))
+            for d in range(1, DEVICES + 1) for n in range(EVENTS_PER_DEVICE)
+        ],
+    )
+    cur.executemany(
+        "INSERT INTO images (device_id, image_url, captured_at, content_sha256) VALUES (%s,%s,%s,%s)",
+        [
+            (d, f"https://bucket.s3.amazonaws.com/{d}/{n}.jpg", now - timedelta(days=n * 3), f"{d:032x}{n:032x}")
+            for d in range(1, DEVICES + 1) for n in range(IMAGES_PER_DEVICE)
+        ],
+    )
+    cur.executemany(
+        "INSERT INTO notifications (device_id, notification_type, sent_at) VALUES (%s,%s,%s)",
+        [
+            (d, "mail_delivered", now - timedelta(days=n * 2, hours=d % 24))
+            for d in range(1, DEVICES + 1) for n in range(NOTIFICATIONS_PER_DEVICE)
+        ],
+    )
+    for sql in main.ROLLUP_BACKFILL_SQL:
+        cur.execute(sql)
+    hour = now.replace(minute=0, second=0)
+    cur.executemany(
+        "INSERT INTO telemetry_rollups_hourly (device_id, bucket, battery_min, battery_max, battery_sum, battery_count) "
+        "VALUES (%s,%s,%s,%s,%s,%s)",
+        [
+            (d, hour - timedelta(hours=h), 80, 90, 170, 2)
+            for d in range(1, DEVICES + 1) for h in range(TELEMETRY_HOURS)
+        ],
+    )
+    cur.execute(
+        "ANALYZE TABLE devices, mailbox_events, images, notifications, event_rollups_daily, "
+        "telemetry_rollups_hourly"
+    )
+    cur.fetchall()
+
+@pytest.fixture(scope="module")
+def plan_report():
+    try:
+        server = _connect_server()
+    except mysql.connector.Error as e:
+        pytest.skip(f"No MySQL server for the query plan check: {e}")
+    with server:
+        server.cursor().execute(f"DROP DATABASE IF EXISTS {TEST_DATABASE}")
+
+    os.environ["INIT_SCHEMA"] = "true"
+    main.POOL = None
+    main.init_pool()  # Creates the database and runs every migration
+    with main._pool() as conn:
+        _seed(conn.cursor())
+        conn.commit()
+    return main.explain_hot_queries()
+
+@pytest.mark.parametrize("query", [name for name, _, _ in main.HOT_QUERIES])
+def test_hot_query_uses_an_index(plan_report, query):
+    accesses = [row for row in plan_report if row["query"] == query]
+    assert accesses, f"{query} produced no plan"
+    for row in accesses:
+        assert row["type"] != "ALL", f"{query} scans all of {row['table']}"
+        assert "filesort" not in row["issues"], f"{query} sorts {row['table']} with a filesort"